@@ -2,7 +2,8 @@ __version__ = "14.0.0"
 
 
 import frappe.desk.form.load
-from frappe.query_builder import DocType
+
+from cloud_storage.cloud_storage.attachments import get_attachments
 
 
 @frappe.whitelist()
@@ -14,16 +15,8 @@ def patched_get_attachments(dt, dn):
 			filters={"attached_to_name": dn, "attached_to_doctype": dt},
 		)
 
-	File = DocType("File")
-	FileAssociation = DocType("File Association")
-	return (
-		frappe.qb.from_(FileAssociation)
-		.inner_join(File)
-		.on(File.name == FileAssociation.parent)
-		.select(File.name, File.file_name, File.file_url, File.is_private)
-		.where(FileAssociation.link_doctype == dt)
-		.where(FileAssociation.link_name == dn)
-	).run(as_dict=True)
+	# the sidebar loads the first page with the form and fetches the rest with `get_attachments_page`
+	return get_attachments(dt, dn)["files"]
 
 
 frappe.desk.form.load.get_attachments = patched_get_attachments
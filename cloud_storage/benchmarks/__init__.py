@@ -0,0 +1,150 @@
+"""
+Benchmarks for Cloud Storage, meant to be run against a development site:
+
+	bench --site {site} execute cloud_storage.benchmarks.queries.run --kwargs "{'rows': 100000}"
+
+Synthetic records are created with a `csbench-` prefix and removed when the benchmark finishes.
+"""
+
+import hashlib
+import json
+import statistics
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import frappe
+from frappe.utils import now
+
+PREFIX = "csbench-"
+
+
+def measure(fn: Callable, iterations: int = 100) -> dict:
+	timings = []
+	for _ in range(iterations):
+		start = time.perf_counter()
+		fn()
+		timings.append((time.perf_counter() - start) * 1000)
+	return summarize(timings)
+
+
+def summarize(timings: list) -> dict:
+	"""Summarizes a list of timings in milliseconds"""
+	timings = sorted(timings)
+	return {
+		"iterations": len(timings),
+		"mean_ms": round(statistics.mean(timings), 3),
+		"p50_ms": round(timings[len(timings) // 2], 3),
+		"p95_ms": round(timings[min(int(len(timings) * 0.95), len(timings) - 1)], 3),
+		"max_ms": round(timings[-1], 3),
+	}
+
+
+def synthetic_file(idx: int) -> dict:
+	return {
+		"name": f"{PREFIX}{idx}",
+		"file_name": f"{PREFIX}{idx}.pdf",
+		"s3_key": f"{PREFIX}folder/User/{PREFIX}doc-{idx}/{PREFIX}{idx}.pdf",
+		"sharing_link": str(10**12 + idx),
+		"content_hash": hashlib.md5(str(idx).encode()).hexdigest(),
+		"link_name": f"{PREFIX}doc-{idx // 10}",
+	}
+
+
+def insert_synthetic_files(rows: int, chunk_size: int = 10000) -> None:
+	"""Inserts `rows` Files, each with one File Association; every ten Files share a document"""
+	timestamp = now()
+	for offset in range(0, rows, chunk_size):
+		files, associations = [], []
+		for idx in range(offset, min(offset + chunk_size, rows)):
+			file = synthetic_file(idx)
+			files.append(
+				(
+					file["name"],
+					file["file_name"],
+					f"/api/method/retrieve?key={file['s3_key']}",
+					file["s3_key"],
+					file["sharing_link"],
+					file["content_hash"],
+					1,
+					"Home/Attachments",
+					"User",
+					file["link_name"],
+					"Administrator",
+					"Administrator",
+					timestamp,
+					timestamp,
+				)
+			)
+			associations.append(
+				(
+					f"{PREFIX}{idx}",
+					file["name"],
+					"File",
+					"file_association",
+					1,
+					"User",
+					file["link_name"],
+					"Administrator",
+					timestamp,
+					"Administrator",
+					"Administrator",
+					timestamp,
+					timestamp,
+				)
+			)
+		frappe.db.bulk_insert(
+			"File",
+			[
+				"name",
+				"file_name",
+				"file_url",
+				"s3_key",
+				"sharing_link",
+				"content_hash",
+				"is_private",
+				"folder",
+				"attached_to_doctype",
+				"attached_to_name",
+				"owner",
+				"modified_by",
+				"creation",
+				"modified",
+			],
+			files,
+		)
+		frappe.db.bulk_insert(
+			"File Association",
+			[
+				"name",
+				"parent",
+				"parenttype",
+				"parentfield",
+				"idx",
+				"link_doctype",
+				"link_name",
+				"user",
+				"timestamp",
+				"owner",
+				"modified_by",
+				"creation",
+				"modified",
+			],
+			associations,
+		)
+		frappe.db.commit()
+
+
+def remove_synthetic_files() -> None:
+	frappe.db.sql("DELETE FROM `tabFile Association` WHERE parent LIKE %s", f"{PREFIX}%")
+	frappe.db.sql("DELETE FROM `tabFile Version` WHERE parent LIKE %s", f"{PREFIX}%")
+	frappe.db.sql("DELETE FROM `tabFile` WHERE name LIKE %s", f"{PREFIX}%")
+	frappe.db.commit()
+
+
+def write_results(results: dict, output: Optional[str] = None) -> dict:
+	results = {"site": frappe.local.site, "timestamp": now(), **results}
+	if output:
+		Path(output).write_text(json.dumps(results, indent=2, default=str))
+	print(json.dumps(results, indent=2, default=str))
+	return results
@@ -0,0 +1,90 @@
+from typing import Optional, Sequence
+
+import frappe
+from frappe.model.rename_doc import rename_doc
+
+from cloud_storage.benchmarks import (
+	PREFIX,
+	insert_synthetic_files,
+	measure,
+	remove_synthetic_files,
+	synthetic_file,
+	write_results,
+)
+
+
+def new_duplicate(target: dict, idx: int):
+	return frappe.get_doc(
+		{
+			"doctype": "File",
+			"file_name": target["file_name"],
+			"file_url": f"/api/method/retrieve?key={target['s3_key']}",
+			"content_hash": target["content_hash"],
+			"attached_to_doctype": "User",
+			"attached_to_name": f"{PREFIX}duplicate-{idx}",
+		}
+	)
+
+
+def insert_then_merge(target: dict, idx: int) -> None:
+	"""The previous path: associate the existing File, insert a temporary row and merge it away"""
+	file = new_duplicate(target, idx)
+	file.flags.ignore_permissions = True
+	existing_file = file.get_existing_file()
+	file.name = f"{PREFIX}tmp-{idx}"
+	file.file_url = ""
+	file.db_insert()
+	rename_doc(
+		"File",
+		file.name,
+		existing_file.name,
+		merge=True,
+		force=True,
+		show_alert=False,
+		ignore_permissions=True,
+	)
+
+
+def redirect_insert(target: dict, idx: int) -> None:
+	file = new_duplicate(target, idx)
+	file.insert(ignore_permissions=True)
+
+
+def measure_with_rollback(path, target: dict, iterations: int) -> dict:
+	counter = iter(range(iterations))
+
+	def attempt():
+		path(target, next(counter))
+		frappe.db.rollback()
+
+	return measure(attempt, iterations)
+
+
+def run(
+	sizes: Sequence[int] = (10000, 100000, 1000000),
+	iterations: int = 20,
+	output: Optional[str] = None,
+) -> dict:
+	"""
+	Compares attaching a duplicate upload by inserting and merging a temporary File with
+	redirecting the insert to the existing File, at each of the given numbers of Files.
+	Every attempt is rolled back, so both paths run against the same table.
+	"""
+	if isinstance(sizes, (int, str)):
+		sizes = [sizes]
+	iterations = int(iterations)
+	results = {}
+	for rows in map(int, sizes):
+		remove_synthetic_files()
+		insert_synthetic_files(rows)
+		target = synthetic_file(rows // 2)
+		try:
+			results[rows] = {
+				path.__name__: measure_with_rollback(path, target, iterations)
+				for path in (insert_then_merge, redirect_insert)
+			}
+		finally:
+			remove_synthetic_files()
+
+	return write_results({"benchmark": "dedup", "results": results}, output)
+
@@ -0,0 +1,52 @@
+from typing import Optional
+
+import frappe
+
+from cloud_storage.benchmarks import (
+	insert_synthetic_files,
+	measure,
+	remove_synthetic_files,
+	synthetic_file,
+	write_results,
+)
+
+# the lookups made by retrieve, share, write_file, validate_file_content and get_attachments
+QUERIES = {
+	"file_by_s3_key": "SELECT name, is_private FROM `tabFile` WHERE s3_key = %(s3_key)s",
+	"file_by_sharing_link": "SELECT name, s3_key FROM `tabFile` WHERE sharing_link = %(sharing_link)s",
+	"file_by_content_hash": "SELECT name FROM `tabFile` WHERE content_hash = %(content_hash)s",
+	"file_by_file_name": "SELECT name FROM `tabFile` WHERE file_name = %(file_name)s",
+	"attachments_by_document": """
+		SELECT `tabFile`.name, `tabFile`.file_name, `tabFile`.file_url, `tabFile`.is_private
+		FROM `tabFile Association`
+		INNER JOIN `tabFile` ON `tabFile`.name = `tabFile Association`.parent
+		WHERE `tabFile Association`.parenttype = 'File'
+		AND `tabFile Association`.link_doctype = %(link_doctype)s
+		AND `tabFile Association`.link_name = %(link_name)s
+		ORDER BY `tabFile Association`.creation DESC, `tabFile Association`.name DESC
+		LIMIT 101
+	""",
+}
+
+
+def run(rows: int = 100000, iterations: int = 100, output: Optional[str] = None) -> dict:
+	"""
+	Reports the query plan and latency of the File lookups at a synthetic scale of `rows` Files.
+	Run once before and once after `bench migrate` to compare the plans with and without indexes.
+	"""
+	rows = int(rows)
+	iterations = int(iterations)
+	remove_synthetic_files()
+	insert_synthetic_files(rows)
+	try:
+		results = {}
+		for query_name, query in QUERIES.items():
+			values = {**synthetic_file(rows // 2), "link_doctype": "User"}
+			results[query_name] = {
+				"plan": frappe.db.sql(f"EXPLAIN {query}", values, as_dict=True),
+				**measure(lambda: frappe.db.sql(query, values), iterations),
+			}
+	finally:
+		remove_synthetic_files()
+
+	return write_results({"benchmark": "queries", "rows": rows, "results": results}, output)
@@ -0,0 +1,231 @@
+import contextlib
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional, Sequence
+
+import frappe
+
+from cloud_storage.benchmarks import (
+	PREFIX,
+	insert_synthetic_files,
+	measure,
+	remove_synthetic_files,
+	summarize,
+	synthetic_file,
+	write_results,
+)
+from cloud_storage.benchmarks.dedup import (
+	insert_then_merge,
+	measure_with_rollback,
+	new_duplicate,
+	redirect_insert,
+)
+from cloud_storage.cloud_storage.overrides.file import (
+	PRESIGNED_URL_CACHE_KEY,
+	clear_cloud_storage_client_cache,
+	get_cloud_storage_client,
+	get_duplicate_files,
+)
+
+MB = 1024 * 1024
+BUCKET = "csbench"
+
+
+def get_free_port() -> int:
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def s3_stand_in(endpoint_url: Optional[str] = None, **settings) -> Iterator[dict]:
+	"""
+	Points the site's cloud storage settings at a local S3-compatible server while the benchmarks run.
+	Starts moto's server in this process unless the `endpoint_url` of another one, such as MinIO, is
+	given. Objects written under the benchmark's folder are removed afterwards.
+	"""
+	server = None
+	if not endpoint_url:
+		from moto.server import ThreadedMotoServer
+
+		port = get_free_port()
+		server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+		server.start()
+		endpoint_url = f"http://127.0.0.1:{port}"
+
+	original_settings = frappe.conf.cloud_storage_settings
+	frappe.conf.cloud_storage_settings = {
+		"access_key": "csbench",
+		"secret": "csbench",
+		"region": "us-east-1",
+		"bucket": BUCKET,
+		"folder": f"{PREFIX}folder",
+		**settings,
+		"endpoint_url": endpoint_url,
+	}
+	clear_cloud_storage_client_cache(frappe.local.site)
+	client = get_cloud_storage_client()
+	with contextlib.suppress(client.exceptions.BucketAlreadyOwnedByYou):
+		client.create_bucket(Bucket=client.bucket)
+	try:
+		yield frappe.conf.cloud_storage_settings
+	finally:
+		remove_objects(client)
+		frappe.conf.cloud_storage_settings = original_settings
+		clear_cloud_storage_client_cache(frappe.local.site)
+		if server:
+			server.stop()
+
+
+def remove_objects(client) -> None:
+	paginator = client.get_paginator("list_objects_v2")
+	for page in paginator.paginate(Bucket=client.bucket, Prefix=f"{client.folder}/"):
+		keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+		if keys:
+			client.delete_objects(Bucket=client.bucket, Delete={"Objects": keys, "Quiet": True})
+
+
+def measure_uploads(sizes: Sequence[int], iterations: int) -> dict:
+	"""
+	Times uploads through `write_file` (inserting a File with content) against putting the same
+	content straight into the bucket, which is the floor for the app's overhead
+	"""
+	client = get_cloud_storage_client()
+	results = {}
+	for size in map(int, sizes):
+		write_file_timings, put_object_timings = [], []
+		for idx in range(iterations):
+			# random content, so no upload is merged into an earlier one
+			content = os.urandom(size)
+			file = frappe.get_doc(
+				{
+					"doctype": "File",
+					"file_name": f"{PREFIX}upload-{size}-{idx}.bin",
+					"content": content,
+					"attached_to_doctype": "User",
+					"attached_to_name": "Administrator",
+					"is_private": 1,
+				}
+			)
+			start = time.perf_counter()
+			file.insert(ignore_permissions=True)
+			write_file_timings.append((time.perf_counter() - start) * 1000)
+			frappe.db.rollback()
+
+			start = time.perf_counter()
+			client.put_object(
+				Body=content, Bucket=client.bucket, Key=f"{client.folder}/{PREFIX}put-{size}-{idx}"
+			)
+			put_object_timings.append((time.perf_counter() - start) * 1000)
+
+		results[size] = {
+			name: {**summary, "throughput_mb_per_second": throughput(size, summary)}
+			for name, summary in (
+				("write_file", summarize(write_file_timings)),
+				("put_object", summarize(put_object_timings)),
+			)
+		}
+	return results
+
+
+def throughput(size: int, summary: dict) -> float:
+	return round(size / MB / (summary["p50_ms"] / 1000), 2) if summary["p50_ms"] else 0
+
+
+def measure_retrieve(
+	settings: dict, rows: int, concurrency: Sequence[int], iterations: int
+) -> dict:
+	"""
+	Times signing URLs through `retrieve` from `concurrency` threads at once, each with its own
+	site connection, with the signed URL cache cleared before each call (cold) and kept (warm)
+	"""
+	site = frappe.local.site
+	keys = [synthetic_file(idx)["s3_key"] for idx in range(rows)]
+
+	def worker(thread: int, threads: int, cold: bool) -> list:
+		frappe.init(site=site)
+		frappe.connect()
+		frappe.local.conf.cloud_storage_settings = settings
+		frappe.set_user("Administrator")
+		timings = []
+		try:
+			client = get_cloud_storage_client()
+			for idx in range(iterations):
+				key = keys[(idx * threads + thread) % len(keys)]
+				if cold:
+					frappe.cache().delete_value(PRESIGNED_URL_CACHE_KEY.format(key=key))
+				start = time.perf_counter()
+				client.get_presigned_url(key)
+				timings.append((time.perf_counter() - start) * 1000)
+		finally:
+			frappe.destroy()
+		return timings
+
+	results = {}
+	for threads in map(int, concurrency):
+		results[threads] = {}
+		for label, cold in (("cold", True), ("warm", False)):
+			start = time.perf_counter()
+			with ThreadPoolExecutor(max_workers=threads) as executor:
+				timings = [
+					timing
+					for thread_timings in executor.map(
+						worker, range(threads), [threads] * threads, [cold] * threads
+					)
+					for timing in thread_timings
+				]
+			elapsed = time.perf_counter() - start
+			results[threads][label] = {
+				**summarize(timings),
+				"requests_per_second": round(len(timings) / elapsed, 1),
+			}
+	return results
+
+
+def measure_dedup(target: dict, iterations: int) -> dict:
+	counter = iter(range(iterations))
+	return {
+		"get_duplicate_files": measure(
+			lambda: get_duplicate_files(new_duplicate(target, next(counter))), iterations
+		),
+		"insert_then_merge": measure_with_rollback(insert_then_merge, target, iterations),
+		"redirect_insert": measure_with_rollback(redirect_insert, target, iterations),
+	}
+
+
+def run(
+	upload_sizes: Sequence[int] = (64 * 1024, MB, 8 * MB, 64 * MB),
+	upload_iterations: int = 5,
+	rows: Sequence[int] = (10000, 100000, 1000000),
+	concurrency: Sequence[int] = (1, 4, 16),
+	retrieve_iterations: int = 200,
+	iterations: int = 20,
+	endpoint_url: Optional[str] = None,
+	output: Optional[str] = None,
+) -> dict:
+	"""
+	Measures the upload, retrieve and duplicate-detection paths against a local S3 stand-in: upload
+	throughput at each of `upload_sizes`, and, at each number of synthetic Files in `rows`, retrieve
+	latency at each level of `concurrency` and the cost of duplicate lookups and merges
+	"""
+	if isinstance(rows, (int, str)):
+		rows = [rows]
+	results = {"uploads": {}, "retrieve": {}, "dedup": {}}
+	with s3_stand_in(endpoint_url) as settings:
+		results["uploads"] = measure_uploads(upload_sizes, int(upload_iterations))
+		for count in map(int, rows):
+			remove_synthetic_files()
+			insert_synthetic_files(count)
+			try:
+				results["retrieve"][count] = measure_retrieve(
+					settings, count, concurrency, int(retrieve_iterations)
+				)
+				results["dedup"][count] = measure_dedup(synthetic_file(count // 2), int(iterations))
+			finally:
+				remove_synthetic_files()
+
+	return write_results(
+		{"benchmark": "storage", "endpoint_url": endpoint_url or "moto", "results": results}, output
+	)
@@ -0,0 +1,14 @@
+import frappe
+
+from cloud_storage.cloud_storage.attachments import PAGE_SIZE
+from cloud_storage.cloud_storage.direct_upload import is_direct_upload_enabled
+
+
+def extend_bootinfo(bootinfo: frappe._dict) -> None:
+	settings = frappe.conf.cloud_storage_settings or {}
+	bootinfo.cloud_storage = {
+		"direct_upload": is_direct_upload_enabled(),
+		"direct_upload_threshold": settings.get("direct_upload_threshold", 8 * 1024 * 1024),
+		"direct_upload_concurrency": settings.get("direct_upload_concurrency", 4),
+		"attachments_page_size": PAGE_SIZE,
+	}
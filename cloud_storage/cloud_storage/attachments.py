@@ -0,0 +1,101 @@
+import json
+from typing import Optional, Union
+
+import frappe
+from frappe.query_builder import DocType
+from frappe.query_builder.functions import Count
+
+ATTACHMENTS_CACHE_KEY = "cloud_storage_attachments|{doctype}|{name}"
+ATTACHMENTS_CACHE_TTL = 60 * 60
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def get_attachments(doctype: str, name: str) -> dict:
+	"""
+	Returns the number of Files associated with a document and the first page of them. Both are cached
+	until an association to the document is added or removed.
+	"""
+	cache_key = ATTACHMENTS_CACHE_KEY.format(doctype=doctype, name=name)
+	cached = frappe.cache().get_value(cache_key)
+	if cached:
+		return cached
+
+	attachments = {
+		"count": get_attachment_count(doctype, name),
+		**get_attachment_page(doctype, name, limit=PAGE_SIZE),
+	}
+	frappe.cache().set_value(cache_key, attachments, expires_in_sec=ATTACHMENTS_CACHE_TTL)
+	return attachments
+
+
+def get_attachment_count(doctype: str, name: str) -> int:
+	FileAssociation = DocType("File Association")
+	return (
+		frappe.qb.from_(FileAssociation)
+		.select(Count("*"))
+		.where(FileAssociation.parenttype == "File")
+		.where(FileAssociation.link_doctype == doctype)
+		.where(FileAssociation.link_name == name)
+	).run()[0][0]
+
+
+def get_attachment_page(
+	doctype: str, name: str, after: Optional[list] = None, limit: int = PAGE_SIZE
+) -> dict:
+	"""
+	Returns a page of the Files associated with a document, newest first. Each File carries the `cursor`
+	to pass as `after` for the page following it; pages are sought by (creation, name) on the association
+	so later pages cost the same as the first.
+	"""
+	File = DocType("File")
+	FileAssociation = DocType("File Association")
+	query = (
+		frappe.qb.from_(FileAssociation)
+		.inner_join(File)
+		.on(File.name == FileAssociation.parent)
+		.select(
+			File.name,
+			File.file_name,
+			File.file_url,
+			File.is_private,
+			FileAssociation.creation.as_("association_creation"),
+			FileAssociation.name.as_("association"),
+		)
+		.where(FileAssociation.parenttype == "File")
+		.where(FileAssociation.link_doctype == doctype)
+		.where(FileAssociation.link_name == name)
+		.orderby(FileAssociation.creation, order=frappe.qb.desc)
+		.orderby(FileAssociation.name, order=frappe.qb.desc)
+		.limit(limit + 1)
+	)
+	if after:
+		creation, association = after
+		query = query.where(
+			(FileAssociation.creation < creation)
+			| ((FileAssociation.creation == creation) & (FileAssociation.name < association))
+		)
+
+	rows = query.run(as_dict=True)
+	files = rows[:limit]
+	for file in files:
+		file.cursor = [str(file.pop("association_creation")), file.pop("association")]
+	return {"files": files, "has_more": len(rows) > limit}
+
+
+def clear_attachments_cache(doctype: str, name: str) -> None:
+	frappe.cache().delete_value(ATTACHMENTS_CACHE_KEY.format(doctype=doctype, name=name))
+
+
+@frappe.whitelist()
+def get_attachments_page(
+	doctype: str, name: str, after: Optional[Union[str, list]] = None, limit: int = PAGE_SIZE
+) -> dict:
+	frappe.has_permission(doctype, "read", doc=name, throw=True)
+	if isinstance(after, str):
+		after = json.loads(after)
+	limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+	return {
+		"count": get_attachments(doctype, name)["count"],
+		**get_attachment_page(doctype, name, after, limit),
+	}
@@ -0,0 +1,120 @@
+import gzip
+import shutil
+import tempfile
+from typing import Optional
+
+import frappe
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# media types compressed by default; entries ending in "/" match every subtype
+COMPRESSED_TYPES = [
+	"text/",
+	"application/json",
+	"application/xml",
+	"application/csv",
+	"application/x-ndjson",
+	"application/javascript",
+	"image/svg+xml",
+]
+# content smaller than this isn't worth compressing
+MIN_SIZE = 1024
+# content is stored uncompressed unless compression saves at least this fraction of its size
+MIN_SAVINGS = 0.1
+# streamed uploads are sampled before compressing all of them
+SAMPLE_SIZE = 256 * 1024
+# compressed streams are held in memory up to this size, and on disk beyond it
+SPOOL_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_browser_encoding(encoding: Optional[str]) -> bool:
+	"""
+	Returns whether browsers (and other HTTP clients) can be sent content stored with `encoding`
+	as is. Only `gzip` is decoded everywhere; other encodings are decompressed by the server.
+	"""
+	return not encoding or encoding == "gzip"
+
+
+def get_content_encoding(content_type: Optional[str]) -> Optional[str]:
+	"""Returns the encoding that content of this type is compressed with, or None to store it as is"""
+	settings = frappe.conf.cloud_storage_settings or {}
+	encoding = settings.get("compression")
+	if not content_type or encoding not in ("gzip", "zstd"):
+		return None
+	if encoding == "zstd" and zstandard is None:
+		return None
+
+	media_type = content_type.split(";")[0].strip().lower()
+	for compressed_type in settings.get("compressed_types", COMPRESSED_TYPES):
+		if media_type == compressed_type or (
+			compressed_type.endswith("/") and media_type.startswith(compressed_type)
+		):
+			return encoding
+
+
+def is_worth_compressing(size: int, compressed_size: int) -> bool:
+	return size >= MIN_SIZE and compressed_size <= size * (1 - MIN_SAVINGS)
+
+
+def compress(content: bytes, encoding: str) -> Optional[bytes]:
+	"""Returns the compressed content, or None if it doesn't compress well enough to be worth it"""
+	if len(content) < MIN_SIZE:
+		return None
+	if encoding == "zstd":
+		compressed = zstandard.ZstdCompressor().compress(content)
+	else:
+		# a fixed mtime keeps the output of identical content identical
+		compressed = gzip.compress(content, mtime=0)
+	return compressed if is_worth_compressing(len(content), len(compressed)) else None
+
+
+def compress_stream(stream, encoding: str):
+	"""
+	Returns a seekable file with the compressed content of a seekable stream, or None if a sample of
+	it doesn't compress well enough. The stream is left at its start either way.
+	"""
+	sample = stream.read(SAMPLE_SIZE)
+	stream.seek(0)
+	if compress(sample, encoding) is None:
+		return None
+
+	output = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+	if encoding == "zstd":
+		zstandard.ZstdCompressor().copy_stream(stream, output, read_size=CHUNK_SIZE)
+	else:
+		with gzip.GzipFile(fileobj=output, mode="wb", mtime=0) as compressor:
+			shutil.copyfileobj(stream, compressor, CHUNK_SIZE)
+	size = stream.tell()
+	stream.seek(0)
+
+	if not is_worth_compressing(size, output.tell()):
+		output.close()
+		return None
+	output.seek(0)
+	return output
+
+
+def decompress(content: bytes, encoding: Optional[str]) -> bytes:
+	if encoding == "zstd":
+		# streamed uploads don't record the content size in the frame, so a plain `decompress` fails
+		return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+	if encoding == "gzip":
+		return gzip.decompress(content)
+	return content
+
+
+def open_decompressed(source, encoding: str):
+	"""Decompresses a readable stream into a seekable file, kept in memory up to `SPOOL_SIZE`"""
+	if encoding == "zstd":
+		reader = zstandard.ZstdDecompressor().stream_reader(source)
+	else:
+		reader = gzip.GzipFile(fileobj=source, mode="rb")
+	output = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+	with reader:
+		shutil.copyfileobj(reader, output, CHUNK_SIZE)
+	output.seek(0)
+	return output
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import frappe
+from botocore.exceptions import ClientError
+from redis import Redis
+
+CONTENT_CACHE_METRICS_KEY = "cloud_storage_content_cache_metrics"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def get_cache_size() -> int:
+	"""The byte budget of the local content cache; 0 when the cache is disabled"""
+	settings = frappe.conf.cloud_storage_settings or {}
+	return int(settings.get("content_cache_size", 0) or 0)
+
+
+def get_max_object_size(cache_size: int) -> int:
+	settings = frappe.conf.cloud_storage_settings or {}
+	return int(settings.get("content_cache_max_object_size", cache_size // 10))
+
+
+def get_cache_directory() -> Path:
+	cache_directory = Path(frappe.get_site_path("private", "cloud_storage_cache")).resolve()
+	cache_directory.mkdir(parents=True, exist_ok=True)
+	return cache_directory
+
+
+def get_cache_path(key: str, etag: str) -> Path:
+	# the ETag changes with the object's content, so a new upload or version is never served stale
+	digest = hashlib.sha256(f"{key}|{etag}".encode()).hexdigest()
+	return get_cache_directory() / digest
+
+
+def get_cached_object(client, key: str) -> Optional[Path]:
+	"""
+	Returns the path of a local copy of an object, downloading it on a miss. Returns None if the cache
+	is disabled or the object is too large to be cached, in which case it should be read from the bucket.
+	"""
+	cache_size = get_cache_size()
+	if cache_size <= 0:
+		return None
+
+	head = client.head_object(Bucket=client.bucket, Key=key)
+	if head.get("ContentLength", 0) > get_max_object_size(cache_size):
+		return None
+
+	path = get_cache_path(key, head.get("ETag", "").strip('"'))
+	try:
+		# the modification time orders entries for eviction, least recently used first
+		os.utime(path)
+		record_metric("hits")
+		return path
+	except FileNotFoundError:
+		record_metric("misses")
+
+	temp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+	try:
+		response = client.get_object(Bucket=client.bucket, Key=key, IfMatch=head.get("ETag"))
+		with open(temp_path, "wb") as f:
+			for chunk in response.get("Body").iter_chunks(DOWNLOAD_CHUNK_SIZE):
+				f.write(chunk)
+		# the rename is atomic, so concurrent readers never see a partially written entry
+		os.replace(temp_path, path)
+	except ClientError:
+		# the object changed since it was checked; read it from the bucket this time
+		return None
+	finally:
+		temp_path.unlink(missing_ok=True)
+
+	evict(cache_size)
+	return path
+
+
+def evict(cache_size: int) -> None:
+	"""Removes the least recently used entries until the cache fits in `cache_size` bytes"""
+	entries = []
+	for path in get_cache_directory().iterdir():
+		if path.suffix == ".tmp":
+			continue
+		try:
+			stat = path.stat()
+		except FileNotFoundError:
+			continue
+		entries.append((stat.st_mtime, stat.st_size, path))
+
+	total = sum(size for _, size, _ in entries)
+	for _, size, path in sorted(entries):
+		if total <= cache_size:
+			break
+		# another worker may have evicted the same entry; readers with it open keep their handle
+		path.unlink(missing_ok=True)
+		total -= size
+		record_metric("evictions")
+
+
+def record_metric(name: str) -> None:
+	cache = frappe.cache()
+	cache.hincrby(cache.make_key(CONTENT_CACHE_METRICS_KEY), name, 1)
+
+
+@frappe.whitelist()
+def get_content_cache_metrics() -> dict:
+	frappe.only_for("System Manager")
+
+	cache = frappe.cache()
+	# the counters are plain integers, which the wrapper's `hgetall` would try to unpickle
+	counters = {
+		(name.decode() if isinstance(name, bytes) else name): int(value)
+		for name, value in Redis.hgetall(cache, cache.make_key(CONTENT_CACHE_METRICS_KEY)).items()
+	}
+	entries = [path for path in get_cache_directory().iterdir() if path.suffix != ".tmp"]
+	hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+	return {
+		"hits": hits,
+		"misses": misses,
+		"evictions": counters.get("evictions", 0),
+		"hit_ratio": round(hits / (hits + misses), 3) if hits + misses else 0,
+		"entries": len(entries),
+		"size_bytes": sum(path.stat().st_size for path in entries if path.exists()),
+		"budget_bytes": get_cache_size(),
+		"timestamp": time.time(),
+	}
@@ -0,0 +1,186 @@
+import io
+import json
+from concurrent.futures import ProcessPoolExecutor
+from mimetypes import guess_type
+from typing import Optional
+
+import frappe
+from frappe.query_builder import DocType
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# number of pending Files rendered by a single derivative job; their content is held in memory
+BATCH_SIZE = 20
+# the longest side of each rendition, in pixels
+DERIVATIVE_SIZES = {"thumbnail": 128, "web": 1280}
+DERIVATIVE_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+# decoding stops at this many pixels so a crafted image can't exhaust the worker's memory
+MAX_IMAGE_PIXELS = 64 * 1024 * 1024
+
+
+def is_derivatives_enabled() -> bool:
+	settings = frappe.conf.cloud_storage_settings
+	return bool(
+		settings and not settings.get("use_local", False) and settings.get("derivatives", False)
+	)
+
+
+def get_derivative_sizes() -> dict:
+	return (frappe.conf.cloud_storage_settings or {}).get("derivative_sizes", DERIVATIVE_SIZES)
+
+
+def get_derivative_format() -> str:
+	derivative_format = (frappe.conf.cloud_storage_settings or {}).get("derivative_format", "webp")
+	return derivative_format if derivative_format in DERIVATIVE_FORMATS else "webp"
+
+
+def get_derivative_key(key: str, size: str, derivative_format: str) -> str:
+	# derivatives live under the original's key, so they are listed and removed together with it
+	return f"{key}.derivatives/{size}.{derivative_format}"
+
+
+def get_derivatives(file) -> dict:
+	"""Returns the derivatives recorded on a File, keyed by size name"""
+	derivatives = file.get("derivatives")
+	if not derivatives:
+		return {}
+	return json.loads(derivatives) if isinstance(derivatives, str) else derivatives
+
+
+def queue_derivatives(file) -> None:
+	"""Marks an uploaded image as pending derivative generation and starts a job after commit"""
+	if not is_derivatives_enabled() or not is_image(file):
+		return
+
+	file.db_set("derivative_status", "Pending", update_modified=False)
+	if not frappe.flags.cloud_storage_derivatives_queued:
+		frappe.flags.cloud_storage_derivatives_queued = True
+		frappe.enqueue(
+			"cloud_storage.cloud_storage.derivatives.generate_pending_derivatives",
+			queue="long",
+			enqueue_after_commit=True,
+		)
+
+
+def is_image(file) -> bool:
+	content_type = file.get("content_type") or guess_type(file.file_name or "")[0]
+	return bool(content_type) and content_type.startswith("image/") and "svg" not in content_type
+
+
+def generate_pending_derivatives() -> None:
+	"""
+	Renders the derivatives of pending images in a pool of processes, since decoding and resizing is
+	CPU-bound, then uploads them next to each original and records them on the File
+	"""
+	from cloud_storage.cloud_storage.overrides.file import get_cloud_storage_client
+
+	if not is_derivatives_enabled() or not frappe.db.count("File", {"derivative_status": "Pending"}):
+		return
+
+	client = get_cloud_storage_client()
+	sizes = get_derivative_sizes()
+	derivative_format = get_derivative_format()
+	workers = frappe.conf.cloud_storage_settings.get("derivative_workers", 2)
+	File = DocType("File")
+
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		while True:
+			# the claimed rows stay locked until the batch is committed, so overlapping jobs skip them
+			names = (
+				frappe.qb.from_(File)
+				.select(File.name)
+				.where(File.derivative_status == "Pending")
+				.orderby(File.creation)
+				.limit(BATCH_SIZE)
+				.for_update(skip_locked=True)
+			).run(pluck=True)
+			if not names:
+				break
+
+			files = [frappe.get_doc("File", name) for name in names]
+			contents = [get_file_content(file) for file in files]
+			results = executor.map(
+				render_derivatives, contents, [sizes] * len(files), [derivative_format] * len(files)
+			)
+			for file, (renditions, error) in zip(files, results):
+				if not error:
+					error = store_file_derivatives(client, file, renditions, derivative_format)
+				if error:
+					frappe.log_error(title="Cloud Storage Derivative Error", message=error)
+					file.db_set("derivative_status", "Failed", update_modified=False)
+			frappe.db.commit()
+
+
+def store_file_derivatives(client, file, renditions: dict, derivative_format: str) -> Optional[str]:
+	"""Stores a File's renditions, returning the error instead of raising so the batch carries on"""
+	try:
+		store_derivatives(client, file, renditions, derivative_format)
+	except Exception:
+		return frappe.get_traceback()
+
+
+def get_file_content(file) -> Optional[bytes]:
+	try:
+		return file._get_content_bytes()
+	except Exception:
+		return None
+
+
+def render_derivatives(content: Optional[bytes], sizes: dict, derivative_format: str) -> tuple:
+	"""
+	Returns the encoded renditions of an image and an error, if any. Runs in a worker process, so it
+	only receives and returns plain values. Sizes at or above the image's own size are skipped.
+	"""
+	if not content:
+		return {}, "The File's content could not be read"
+
+	Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+	image_format, _ = DERIVATIVE_FORMATS[derivative_format]
+	renditions = {}
+	try:
+		with Image.open(io.BytesIO(content)) as image:
+			image = ImageOps.exif_transpose(image)
+			if image_format == "JPEG" and image.mode != "RGB":
+				image = image.convert("RGB")
+			elif image.mode not in ("RGB", "RGBA"):
+				image = image.convert("RGBA")
+			for size, longest_side in sizes.items():
+				if max(image.size) <= longest_side:
+					continue
+				rendition = image.copy()
+				rendition.thumbnail((longest_side, longest_side), Image.LANCZOS)
+				output = io.BytesIO()
+				rendition.save(output, format=image_format, quality=80)
+				renditions[size] = {
+					"content": output.getvalue(),
+					"width": rendition.width,
+					"height": rendition.height,
+				}
+	except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError) as e:
+		return {}, str(e)
+	return renditions, None
+
+
+def store_derivatives(client, file, renditions: dict, derivative_format: str) -> None:
+	_, content_type = DERIVATIVE_FORMATS[derivative_format]
+	previous_keys = {derivative["key"] for derivative in get_derivatives(file).values()}
+	derivatives = {}
+	for size, rendition in renditions.items():
+		key = get_derivative_key(file.s3_key, size, derivative_format)
+		client.put_object(
+			Body=rendition["content"], Bucket=client.bucket, Key=key, ContentType=content_type
+		)
+		derivatives[size] = {
+			"key": key,
+			"width": rendition["width"],
+			"height": rendition["height"],
+			"content_type": content_type,
+		}
+
+	# a smaller replacement image may no longer have every size
+	for key in previous_keys - {derivative["key"] for derivative in derivatives.values()}:
+		client.delete_object(Bucket=client.bucket, Key=key)
+
+	file.db_set(
+		{"derivatives": json.dumps(derivatives), "derivative_status": "Generated"},
+		update_modified=False,
+	)
@@ -0,0 +1,150 @@
+import json
+import math
+from typing import Optional, Union
+
+import frappe
+from frappe import _
+from frappe.core.api.file import get_max_file_size
+
+from cloud_storage.cloud_storage.derivatives import queue_derivatives
+from cloud_storage.cloud_storage.overrides.file import (
+	FILE_URL,
+	get_cloud_storage_client,
+	get_unique_file_path,
+	strip_special_chars,
+)
+
+MULTIPART_UPLOAD_CACHE_KEY = "cloud_storage_multipart_upload|{upload_id}"
+# S3 limits for multipart uploads
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+def is_direct_upload_enabled() -> bool:
+	settings = frappe.conf.cloud_storage_settings
+	return bool(
+		settings and not settings.get("use_local", False) and settings.get("direct_upload", False)
+	)
+
+
+@frappe.whitelist()
+def create_multipart_upload(
+	file_name: str,
+	file_size: int,
+	content_type: Optional[str] = None,
+	is_private: Union[int, str] = 1,
+	folder: str = "Home",
+	doctype: Optional[str] = None,
+	docname: Optional[str] = None,
+	fieldname: Optional[str] = None,
+) -> dict:
+	"""
+	Starts a multipart upload for a file that the browser sends straight to the bucket, returning a
+	presigned URL for each part. The upload is finished with `complete_multipart_upload`.
+	"""
+	if not is_direct_upload_enabled():
+		frappe.throw(_("Direct uploads are not enabled"))
+
+	frappe.has_permission("File", "create", throw=True)
+	if doctype and docname:
+		frappe.has_permission(doctype, "write", doc=docname, throw=True)
+
+	file_size = int(file_size)
+	if file_size > get_max_file_size():
+		frappe.throw(_("File size exceeded the maximum allowed size"))
+
+	client = get_cloud_storage_client()
+	file = frappe.new_doc("File")
+	file.update(
+		{
+			"file_name": strip_special_chars(file_name.replace(" ", "_")),
+			"is_private": int(is_private),
+			"folder": folder,
+			"attached_to_doctype": doctype,
+			"attached_to_name": docname,
+			"attached_to_field": fieldname,
+			"file_size": file_size,
+			"content_type": content_type,
+		}
+	)
+	# the upload is completed without further checks, so it must not land on existing content
+	key = get_unique_file_path(client, file)
+
+	part_size = max(client.transfer_config.multipart_chunksize, MIN_PART_SIZE)
+	part_size = max(part_size, math.ceil(file_size / MAX_PARTS))
+	part_count = max(math.ceil(file_size / part_size), 1)
+
+	extra_args = {"ContentType": content_type} if content_type else {}
+	upload = client.create_multipart_upload(Bucket=client.bucket, Key=key, **extra_args)
+	upload_id = upload.get("UploadId")
+	expiration = frappe.conf.cloud_storage_settings.get("upload_expiration", 3600)
+	urls = [
+		client.generate_presigned_url(
+			ClientMethod="upload_part",
+			Params={"Bucket": client.bucket, "Key": key, "UploadId": upload_id, "PartNumber": number},
+			ExpiresIn=expiration,
+		)
+		for number in range(1, part_count + 1)
+	]
+
+	# the planned File is kept server-side, so the browser can only complete uploads it started
+	frappe.cache().set_value(
+		MULTIPART_UPLOAD_CACHE_KEY.format(upload_id=upload_id),
+		{"key": key, "user": frappe.session.user, "file": file.as_dict(no_default_fields=True)},
+		expires_in_sec=expiration,
+	)
+	return {"upload_id": upload_id, "key": key, "part_size": part_size, "urls": urls}
+
+
+@frappe.whitelist()
+def complete_multipart_upload(upload_id: str, parts: Union[str, list]):
+	"""Assembles the uploaded parts and creates the File, with its association and version"""
+	upload = get_multipart_upload(upload_id)
+	if isinstance(parts, str):
+		parts = json.loads(parts)
+	parts = sorted(
+		({"PartNumber": int(part["PartNumber"]), "ETag": part["ETag"]} for part in parts),
+		key=lambda part: part["PartNumber"],
+	)
+
+	client = get_cloud_storage_client()
+	response = client.complete_multipart_upload(
+		Bucket=client.bucket,
+		Key=upload["key"],
+		UploadId=upload_id,
+		MultipartUpload={"Parts": parts},
+	)
+	frappe.cache().delete_value(MULTIPART_UPLOAD_CACHE_KEY.format(upload_id=upload_id))
+
+	# the size declared by the browser was only used to plan the parts
+	head = client.head_object(Bucket=client.bucket, Key=upload["key"])
+	if head["ContentLength"] > get_max_file_size():
+		version = {"VersionId": response["VersionId"]} if response.get("VersionId") else {}
+		client.delete_object(Bucket=client.bucket, Key=upload["key"], **version)
+		frappe.throw(_("File size exceeded the maximum allowed size"))
+
+	file = frappe.get_doc({**upload["file"], "doctype": "File"})
+	file.file_url = FILE_URL.format(path=upload["key"])
+	file.s3_key = upload["key"]
+	file.file_size = head["ContentLength"]
+	if response.get("VersionId"):
+		file.add_file_version(response.get("VersionId"))
+	file.flags.cloud_storage = True
+	file.insert()
+	queue_derivatives(file)
+	return file
+
+
+@frappe.whitelist()
+def abort_multipart_upload(upload_id: str) -> None:
+	upload = get_multipart_upload(upload_id)
+	client = get_cloud_storage_client()
+	client.abort_multipart_upload(Bucket=client.bucket, Key=upload["key"], UploadId=upload_id)
+	frappe.cache().delete_value(MULTIPART_UPLOAD_CACHE_KEY.format(upload_id=upload_id))
+
+
+def get_multipart_upload(upload_id: str) -> dict:
+	upload = frappe.cache().get_value(MULTIPART_UPLOAD_CACHE_KEY.format(upload_id=upload_id))
+	if not upload or upload.get("user") != frappe.session.user:
+		frappe.throw(_("Upload not found or expired"), frappe.DoesNotExistError)
+	return upload
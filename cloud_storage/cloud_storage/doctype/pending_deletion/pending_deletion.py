@@ -0,0 +1,136 @@
+# Copyright (c) 2026, AgriTheory and contributors
+# For license information, please see license.txt
+
+import frappe
+from botocore.exceptions import ClientError
+from frappe.model.document import Document
+from frappe.query_builder import DocType
+from frappe.utils import now_datetime
+
+# the maximum number of keys accepted by a single `delete_objects` request
+BATCH_SIZE = 1000
+
+
+class PendingDeletion(Document):
+	pass
+
+
+def queue_deletion(key: str) -> None:
+	"""
+	Records a key for deletion in the same transaction as the File it belongs to, and schedules a
+	background job to remove it from the bucket once that transaction is committed
+	"""
+	frappe.get_doc({"doctype": "Pending Deletion", "s3_key": key}).insert(ignore_permissions=True)
+	enqueue_pending_deletions()
+
+
+def queue_deletions(keys: list) -> None:
+	"""Records many keys for deletion with a single insert, like `queue_deletion`"""
+	if not keys:
+		return
+	timestamp, user = now_datetime(), frappe.session.user
+	frappe.db.bulk_insert(
+		"Pending Deletion",
+		["name", "s3_key", "status", "attempts", "owner", "modified_by", "creation", "modified"],
+		[
+			(frappe.generate_hash(length=10), key, "Pending", 0, user, user, timestamp, timestamp)
+			for key in keys
+		],
+	)
+	enqueue_pending_deletions()
+
+
+def enqueue_pending_deletions() -> None:
+	if not frappe.flags.cloud_storage_deletion_queued:
+		frappe.flags.cloud_storage_deletion_queued = True
+		frappe.enqueue(
+			"cloud_storage.cloud_storage.doctype.pending_deletion.pending_deletion.process_pending_deletions",
+			queue="long",
+			enqueue_after_commit=True,
+		)
+
+
+def process_pending_deletions() -> None:
+	"""Deletes queued keys from the bucket in batches; failed keys are retried on the next run"""
+	from cloud_storage.cloud_storage.overrides.file import get_cloud_storage_client
+
+	if not frappe.conf.cloud_storage_settings or not frappe.db.count("Pending Deletion"):
+		return
+
+	client = get_cloud_storage_client()
+	max_attempts = frappe.conf.cloud_storage_settings.get("deletion_max_attempts", 5)
+	run_started = now_datetime()
+	PendingDeletion = DocType("Pending Deletion")
+
+	while True:
+		# rows that already failed during this run wait for the next one
+		rows = (
+			frappe.qb.from_(PendingDeletion)
+			.select(PendingDeletion.name, PendingDeletion.s3_key, PendingDeletion.attempts)
+			.where(PendingDeletion.attempts < max_attempts)
+			.where(
+				PendingDeletion.last_attempt.isnull() | (PendingDeletion.last_attempt < run_started)
+			)
+			.orderby(PendingDeletion.creation)
+			.limit(BATCH_SIZE)
+			.for_update(skip_locked=True)
+		).run(as_dict=True)
+		if not rows:
+			break
+
+		# keys are derived from the attached document and file name, so a key queued when a File was
+		# removed may have been written again since by a new upload
+		referenced = get_referenced_keys([row.s3_key for row in rows])
+		skipped = [row.name for row in rows if row.s3_key in referenced]
+		if skipped:
+			frappe.db.delete("Pending Deletion", {"name": ("in", skipped)})
+		rows = [row for row in rows if row.s3_key not in referenced]
+		if not rows:
+			frappe.db.commit()
+			continue
+
+		errors = delete_objects(client, list({row.s3_key for row in rows}))
+		deleted = [row.name for row in rows if row.s3_key not in errors]
+		if deleted:
+			frappe.db.delete("Pending Deletion", {"name": ("in", deleted)})
+		for row in rows:
+			if row.s3_key in errors:
+				frappe.db.set_value(
+					"Pending Deletion",
+					row.name,
+					{
+						"status": "Failed",
+						"attempts": row.attempts + 1,
+						"last_attempt": now_datetime(),
+						"error": errors[row.s3_key],
+					},
+					update_modified=False,
+				)
+		frappe.db.commit()
+
+
+def get_referenced_keys(keys: list) -> set:
+	"""Returns the keys, including those of derivatives, that belong to an existing File"""
+	originals = {key: key.rsplit(".derivatives/", 1)[0] for key in keys}
+	referenced = set(
+		frappe.get_all(
+			"File", filters={"s3_key": ["in", list(set(originals.values()))]}, pluck="s3_key"
+		)
+	)
+	return {key for key, original in originals.items() if original in referenced}
+
+
+def delete_objects(client, keys: list) -> dict:
+	"""Returns a map of keys that could not be deleted to their error messages"""
+	try:
+		response = client.delete_objects(
+			Bucket=client.bucket,
+			Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+		)
+	except ClientError as e:
+		return {key: str(e) for key in keys}
+
+	return {
+		error.get("Key"): f"{error.get('Code')}: {error.get('Message')}"
+		for error in response.get("Errors", [])
+	}
@@ -0,0 +1,211 @@
+import contextlib
+import threading
+import time
+from typing import Iterator, Optional
+
+import frappe
+from botocore.utils import determine_content_length
+from redis import Redis
+from werkzeug.wrappers import Response
+
+S3_METRICS_KEY = "cloud_storage_s3_metrics"
+# upper bounds of the latency histogram's buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_tags = threading.local()
+
+
+@contextlib.contextmanager
+def tag_operations(doctype: Optional[str]) -> Iterator[None]:
+	"""
+	Tags the S3 calls made by this thread with the DocType the File belongs to. Parts uploaded by
+	transfer threads are tagged with an empty DocType.
+	"""
+	previous = getattr(_tags, "doctype", None)
+	_tags.doctype = doctype
+	try:
+		yield
+	finally:
+		_tags.doctype = previous
+
+
+class S3Metrics:
+	"""
+	Records the latency, bytes, retries and errors of every call made by an S3 client through botocore's
+	event hooks. Counters are aggregated in Redis so every worker of the site reports to one endpoint.
+	Handlers may run on transfer threads without a Frappe context, so the site's Redis key and logger
+	are resolved when the client is built.
+	"""
+
+	def __init__(self, site: str, slow_operation_threshold: float = 0) -> None:
+		self.site = site
+		self.cache = frappe.cache()
+		self.key = self.cache.make_key(S3_METRICS_KEY)
+		self.slow_operation_threshold = slow_operation_threshold
+		self.logger = frappe.logger("cloud_storage") if slow_operation_threshold else None
+
+	def register(self, client) -> None:
+		client.meta.events.register("before-call.s3", self.before_call)
+		client.meta.events.register("after-call.s3", self.after_call)
+		client.meta.events.register("after-call-error.s3", self.after_call_error)
+
+		# presigning happens locally and doesn't emit call events
+		generate_presigned_url = client.generate_presigned_url
+
+		def timed_generate_presigned_url(*args, **kwargs):
+			started = time.perf_counter()
+			try:
+				return generate_presigned_url(*args, **kwargs)
+			finally:
+				self.record("GeneratePresignedUrl", time.perf_counter() - started)
+
+		client.generate_presigned_url = timed_generate_presigned_url
+
+	def before_call(self, model, params: dict, context: dict, **kwargs) -> None:
+		context["cloud_storage_started"] = time.perf_counter()
+		# `after-call-error` is emitted without the operation's model
+		context["cloud_storage_operation"] = model.name
+		context["cloud_storage_doctype"] = getattr(_tags, "doctype", None) or ""
+		# the Content-Length header is only set once the request is prepared, after this event
+		context["cloud_storage_bytes"] = determine_content_length(params.get("body")) or 0
+
+	def after_call(self, http_response, parsed: dict, model, context: dict, **kwargs) -> None:
+		transferred = context.get("cloud_storage_bytes", 0)
+		# a HEAD response reports the object's length without sending it
+		if model.http.get("method") != "HEAD":
+			transferred += int(http_response.headers.get("Content-Length", 0) or 0)
+		self.record(
+			model.name,
+			time.perf_counter() - context.get("cloud_storage_started", time.perf_counter()),
+			doctype=context.get("cloud_storage_doctype", ""),
+			transferred=transferred,
+			retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+			error=parsed.get("Error", {}).get("Code"),
+		)
+
+	def after_call_error(self, exception: Exception, context: dict, **kwargs) -> None:
+		self.record(
+			context.get("cloud_storage_operation", ""),
+			time.perf_counter() - context.get("cloud_storage_started", time.perf_counter()),
+			doctype=context.get("cloud_storage_doctype", ""),
+			error=type(exception).__name__,
+		)
+
+	def record(
+		self,
+		operation: str,
+		duration: float,
+		doctype: str = "",
+		transferred: int = 0,
+		retries: int = 0,
+		error: Optional[str] = None,
+	) -> None:
+		labels = f"{operation}|{doctype}"
+		bucket = next((bound for bound in LATENCY_BUCKETS if duration <= bound), "+Inf")
+		try:
+			# one round trip per call
+			pipeline = self.cache.pipeline(transaction=False)
+			pipeline.hincrby(self.key, f"bucket|{labels}|{bucket}", 1)
+			pipeline.hincrby(self.key, f"count|{labels}", 1)
+			pipeline.hincrbyfloat(self.key, f"sum|{labels}", duration)
+			if transferred:
+				pipeline.hincrby(self.key, f"bytes|{labels}", transferred)
+			if retries:
+				pipeline.hincrby(self.key, f"retries|{labels}", retries)
+			if error:
+				pipeline.hincrby(self.key, f"errors|{labels}|{error}", 1)
+			pipeline.execute()
+		except Exception:
+			# metrics must never fail the call they describe
+			pass
+
+		if self.logger and duration >= self.slow_operation_threshold:
+			self.logger.warning(
+				f"Slow S3 operation on {self.site}: {operation} took {duration:.3f}s"
+				f" (doctype: {doctype or '-'}, bytes: {transferred}, retries: {retries},"
+				f" error: {error or '-'})"
+			)
+
+
+def instrument_client(client, config: dict) -> None:
+	if not config.get("metrics", False) and not config.get("slow_operation_threshold"):
+		return
+	site = getattr(frappe.local, "site", None) or ""
+	S3Metrics(site, float(config.get("slow_operation_threshold") or 0)).register(client)
+
+
+def get_metric_values() -> dict:
+	cache = frappe.cache()
+	return {
+		(field.decode() if isinstance(field, bytes) else field): float(value)
+		for field, value in Redis.hgetall(cache, cache.make_key(S3_METRICS_KEY)).items()
+	}
+
+
+def format_labels(**labels) -> str:
+	escaped = {
+		name: str(value).replace("\\", "\\\\").replace('"', '\\"') for name, value in labels.items()
+	}
+	return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def render_metrics(values: dict, site: str) -> str:
+	"""Formats the recorded counters in the Prometheus text exposition format"""
+	histograms, counters = {}, {"bytes": {}, "retries": {}, "errors": {}}
+	for field, value in values.items():
+		kind, operation, doctype, *extra = field.split("|")
+		labels = (operation, doctype)
+		if kind in ("bucket", "count", "sum"):
+			histogram = histograms.setdefault(labels, {"buckets": {}, "count": 0, "sum": 0})
+			if kind == "bucket":
+				histogram["buckets"][extra[0]] = value
+			else:
+				histogram[kind] = value
+		elif kind == "errors":
+			counters["errors"][(*labels, extra[0])] = value
+		elif kind in counters:
+			counters[kind][labels] = value
+
+	lines = [
+		"# HELP cloud_storage_s3_request_duration_seconds Latency of S3 calls",
+		"# TYPE cloud_storage_s3_request_duration_seconds histogram",
+	]
+	for (operation, doctype), histogram in sorted(histograms.items()):
+		cumulative = 0
+		for bound in [*LATENCY_BUCKETS, "+Inf"]:
+			cumulative += histogram["buckets"].get(str(bound), 0)
+			labels = format_labels(site=site, operation=operation, doctype=doctype, le=bound)
+			lines.append(f"cloud_storage_s3_request_duration_seconds_bucket{labels} {cumulative:g}")
+		labels = format_labels(site=site, operation=operation, doctype=doctype)
+		lines.append(f"cloud_storage_s3_request_duration_seconds_count{labels} {histogram['count']:g}")
+		lines.append(f"cloud_storage_s3_request_duration_seconds_sum{labels} {histogram['sum']}")
+
+	for kind, help_text in (
+		("bytes", "Bytes sent and received by S3 calls"),
+		("retries", "Retries of S3 calls"),
+		("errors", "S3 calls that failed, by error code"),
+	):
+		name = f"cloud_storage_s3_{kind}_total"
+		lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} counter"])
+		for key, value in sorted(counters[kind].items()):
+			labels = {"site": site, "operation": key[0], "doctype": key[1]}
+			if kind == "errors":
+				labels["code"] = key[2]
+			lines.append(f"{name}{format_labels(**labels)} {value:g}")
+
+	return "\n".join(lines) + "\n"
+
+
+@frappe.whitelist()
+def get_s3_metrics() -> Response:
+	frappe.only_for("System Manager")
+	return Response(
+		render_metrics(get_metric_values(), frappe.local.site),
+		mimetype="text/plain; version=0.0.4",
+	)
+
+
+@frappe.whitelist()
+def reset_s3_metrics() -> None:
+	frappe.only_for("System Manager")
+	frappe.cache().delete_value(S3_METRICS_KEY)
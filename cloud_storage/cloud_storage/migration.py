@@ -0,0 +1,393 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from mimetypes import guess_type
+from pathlib import Path
+from typing import Optional
+
+import frappe
+from frappe.core.doctype.file.file import get_files_path
+from frappe.query_builder import DocType
+from frappe.utils import now_datetime
+
+from cloud_storage.cloud_storage.attachments import clear_attachments_cache
+from cloud_storage.cloud_storage.overrides.file import (
+	FILE_URL,
+	get_cloud_storage_client,
+	get_unique_file_path,
+)
+
+# number of local Files uploaded between checkpoints
+BATCH_SIZE = 100
+# assumed upload throughput for dry-run estimates, in bytes per second
+ESTIMATED_THROUGHPUT = 20 * 1024 * 1024
+
+
+class HashingReader:
+	"""Reads a file sequentially for an upload while computing its content hash in the same pass"""
+
+	def __init__(self, file) -> None:
+		self.file = file
+		self.hash = hashlib.md5()
+		self.size = 0
+
+	def read(self, size: int = -1) -> bytes:
+		data = self.file.read(size)
+		self.hash.update(data)
+		self.size += len(data)
+		return data
+
+
+def get_checkpoint_path() -> Path:
+	return Path(frappe.get_site_path("private", "cloud_storage_migration.json")).resolve()
+
+
+def load_checkpoint() -> dict:
+	path = get_checkpoint_path()
+	if path.exists():
+		return json.loads(path.read_text())
+	return {"cursor": "", "migrated": 0, "merged": 0, "bytes": 0, "failed": [], "seconds": 0}
+
+
+def save_checkpoint(checkpoint: dict) -> None:
+	path = get_checkpoint_path()
+	temp_path = path.with_suffix(".tmp")
+	temp_path.write_text(json.dumps(checkpoint, indent=2, default=str))
+	os.replace(temp_path, path)
+
+
+def get_local_files(cursor: str = "", limit: int = BATCH_SIZE) -> list:
+	"""Returns the next local Files after `cursor`, ordered by name so an interrupted run can resume"""
+	File = DocType("File")
+	return (
+		frappe.qb.from_(File)
+		.select(
+			File.name,
+			File.file_name,
+			File.file_url,
+			File.is_private,
+			File.content_hash,
+			File.attached_to_doctype,
+			File.attached_to_name,
+			File.attached_to_field,
+			File.owner,
+			File.creation,
+		)
+		.where(File.is_folder == 0)
+		.where(File.name > cursor)
+		.where(File.file_url.like("/files/%") | File.file_url.like("/private/files/%"))
+		.orderby(File.name)
+		.limit(limit)
+	).run(as_dict=True)
+
+
+def get_local_path(file) -> str:
+	if file.file_url.startswith("/private/files/"):
+		return get_files_path(file.file_url[len("/private/files/") :], is_private=1)
+	return get_files_path(file.file_url[len("/files/") :])
+
+
+def migrate_local_files(
+	dry_run: bool = False,
+	workers: Optional[int] = None,
+	batch_size: int = BATCH_SIZE,
+	restart: bool = False,
+) -> dict:
+	"""
+	Uploads existing local Files to the bucket through a pool of `workers` threads, rewriting their
+	URLs and merging those whose content is already in the bucket. Progress is checkpointed after each
+	batch in the site's private directory, so an interrupted run resumes where it stopped; `restart`
+	starts over, retrying Files that failed before. A dry run only reports what would be uploaded.
+	"""
+	if dry_run:
+		return estimate_migration()
+
+	settings = frappe.conf.cloud_storage_settings or {}
+	workers = int(workers or settings.get("migration_workers", 8))
+	client = get_cloud_storage_client()
+	checkpoint = load_checkpoint()
+	if restart:
+		checkpoint.update({"cursor": "", "failed": []})
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		while True:
+			files = get_local_files(checkpoint["cursor"], int(batch_size))
+			if not files:
+				break
+
+			started = time.perf_counter()
+			in_bucket = get_migrated_hashes([file.content_hash for file in files if file.content_hash])
+			assign_keys(client, [file for file in files if file.content_hash not in in_bucket])
+			# uploads run in threads, but database updates stay on this thread's connection
+			results = list(
+				executor.map(
+					lambda file: (
+						# content known to be in the bucket already is merged without uploading it again
+						{"key": None, "content_hash": file.content_hash, "size": 0}
+						if file.content_hash in in_bucket
+						else upload_local_file(client, file)
+					),
+					files,
+				)
+			)
+			for file, result in zip(files, results):
+				if result.get("error"):
+					checkpoint["failed"].append(file.name)
+					frappe.log_error(title="Cloud Storage Migration Error", message=result["error"])
+					continue
+				if merge_duplicate(client, file, result):
+					checkpoint["merged"] += 1
+				else:
+					mark_migrated(file, result)
+					checkpoint["migrated"] += 1
+				checkpoint["bytes"] += result["size"]
+			frappe.db.commit()
+
+			checkpoint["cursor"] = files[-1].name
+			checkpoint["seconds"] += time.perf_counter() - started
+			checkpoint["timestamp"] = now_datetime()
+			save_checkpoint(checkpoint)
+			report_progress(checkpoint)
+
+	return checkpoint
+
+
+def get_migrated_hashes(content_hashes: list) -> set:
+	if not content_hashes:
+		return set()
+	return set(
+		frappe.get_all(
+			"File",
+			filters={"content_hash": ["in", content_hashes], "s3_key": ["is", "set"], "is_folder": 0},
+			pluck="content_hash",
+		)
+	)
+
+
+def assign_keys(client, files: list) -> None:
+	"""
+	Picks the key each File is uploaded to before the batch's uploads start. Files with the same name
+	on the same document, or whose key already belongs to a File in the bucket, would otherwise be
+	written to the same object, so they are renamed with a random suffix. The local path is resolved
+	here as well, since the site isn't available to the upload threads.
+	"""
+	reserved = set()
+	for file in files:
+		file.local_path = get_local_path(file)
+		file.key = get_unique_file_path(client, file, reserved)
+		reserved.add(file.key)
+
+
+def upload_local_file(client, file) -> dict:
+	path = file.key
+	content_type = guess_type(file.file_name or "")[0] or "application/octet-stream"
+	try:
+		with open(file.local_path, "rb") as f:
+			reader = HashingReader(f)
+			client.upload_fileobj(
+				reader,
+				client.bucket,
+				path,
+				ExtraArgs={"ContentType": content_type},
+				Config=client.transfer_config,
+			)
+		response = client.head_object(Bucket=client.bucket, Key=path)
+		return {
+			"key": path,
+			"content_hash": reader.hash.hexdigest(),
+			"size": reader.size,
+			"version_id": response.get("VersionId"),
+		}
+	except Exception:
+		return {"error": frappe.get_traceback()}
+
+
+def merge_duplicate(client, file, result: dict) -> bool:
+	"""
+	If a File with the same content is already in the bucket, moves this File's associations to it,
+	removes this File and its uploaded copy, and returns True
+	"""
+	existing_file = frappe.db.get_value(
+		"File",
+		{
+			"content_hash": result["content_hash"],
+			"name": ["!=", file.name],
+			"s3_key": ["is", "set"],
+			"is_folder": 0,
+		},
+		["name", "s3_key", "file_url"],
+		as_dict=True,
+	)
+	if not existing_file:
+		return False
+
+	for link_doctype, link_name in get_associations(file.name, file):
+		add_association(existing_file.name, link_doctype, link_name, file)
+	update_attached_field(file, existing_file.file_url)
+	frappe.db.delete("File Association", {"parent": file.name, "parenttype": "File"})
+	frappe.db.delete("File Version", {"parent": file.name, "parenttype": "File"})
+	frappe.db.delete("File", {"name": file.name})
+	# the upload may have been written to the existing File's own key
+	if result["key"] and result["key"] != existing_file.s3_key:
+		client.delete_object(Bucket=client.bucket, Key=result["key"])
+	return True
+
+
+def mark_migrated(file, result: dict) -> None:
+	file_url = FILE_URL.format(path=result["key"])
+	frappe.db.set_value(
+		"File",
+		file.name,
+		{
+			# the File may have been renamed to give it a key of its own
+			"file_name": file.file_name,
+			"file_url": file_url,
+			"s3_key": result["key"],
+			"content_hash": result["content_hash"],
+		},
+		update_modified=False,
+	)
+	update_attached_field(file, file_url)
+	# local Files were only linked through `attached_to_*`; the sidebar lists File Association rows
+	for link_doctype, link_name in get_associations(file.name, file):
+		add_association(file.name, link_doctype, link_name, file)
+	if result.get("version_id"):
+		add_child_row(
+			file.name,
+			"versions",
+			"File Version",
+			{
+				"version": result["version_id"],
+				"s3_key": result["key"],
+				"user": file.owner,
+				"timestamp": now_datetime(),
+			},
+		)
+
+
+def update_attached_field(file, file_url: str) -> None:
+	"""
+	Points the Attach field a File was uploaded through at its new URL, as Frappe does when a File's
+	privacy changes. The field is left alone if it no longer holds the File's previous URL.
+	"""
+	if not (file.attached_to_doctype and file.attached_to_name and file.attached_to_field):
+		return
+	reference = (file.attached_to_doctype, file.attached_to_name, file.attached_to_field)
+	if frappe.db.get_value(*reference) == file.file_url:
+		frappe.db.set_value(*reference, file_url, update_modified=False)
+
+
+def get_associations(name: str, file) -> list:
+	associations = frappe.get_all(
+		"File Association",
+		filters={"parent": name, "parenttype": "File"},
+		fields=["link_doctype", "link_name"],
+		as_list=True,
+	)
+	associations = [tuple(association) for association in associations]
+	if file.attached_to_doctype and file.attached_to_name:
+		reference = (file.attached_to_doctype, file.attached_to_name)
+		if reference not in associations:
+			associations.append(reference)
+	return associations
+
+
+def add_association(parent: str, link_doctype: str, link_name: str, file) -> None:
+	if frappe.db.exists(
+		"File Association",
+		{"parent": parent, "parenttype": "File", "link_doctype": link_doctype, "link_name": link_name},
+	):
+		return
+	add_child_row(
+		parent,
+		"file_association",
+		"File Association",
+		{
+			"link_doctype": link_doctype,
+			"link_name": link_name,
+			"user": file.owner,
+			"timestamp": file.creation,
+		},
+	)
+	clear_attachments_cache(link_doctype, link_name)
+
+
+def add_child_row(parent: str, parentfield: str, doctype: str, values: dict) -> None:
+	idx = frappe.db.count(doctype, {"parent": parent, "parentfield": parentfield}) + 1
+	row = frappe.get_doc(
+		{
+			"doctype": doctype,
+			"parent": parent,
+			"parenttype": "File",
+			"parentfield": parentfield,
+			"idx": idx,
+			**values,
+		}
+	)
+	row.db_insert()
+
+
+def estimate_migration(throughput: int = ESTIMATED_THROUGHPUT) -> dict:
+	"""Counts the local Files left to migrate and their size, and estimates how long uploading takes"""
+	settings = frappe.conf.cloud_storage_settings or {}
+	throughput = settings.get("migration_estimated_throughput", throughput)
+	cursor = load_checkpoint()["cursor"]
+	files, total_bytes, missing, duplicate_bytes = 0, 0, 0, 0
+	hashes = set()
+	while True:
+		batch = get_local_files(cursor, 1000)
+		if not batch:
+			break
+		for file in batch:
+			try:
+				size = os.path.getsize(get_local_path(file))
+			except OSError:
+				missing += 1
+				continue
+			files += 1
+			total_bytes += size
+			# Files with a known hash that was already seen will be merged rather than kept twice
+			if file.content_hash and file.content_hash in hashes:
+				duplicate_bytes += size
+			elif file.content_hash:
+				hashes.add(file.content_hash)
+		cursor = batch[-1].name
+
+	estimate = {
+		"dry_run": True,
+		"files": files,
+		"bytes": total_bytes,
+		"missing": missing,
+		"known_duplicate_bytes": duplicate_bytes,
+		"estimated_seconds": round(total_bytes / throughput, 1) if throughput else None,
+	}
+	report_progress(estimate)
+	return estimate
+
+
+def report_progress(progress: dict) -> None:
+	if progress.get("seconds"):
+		throughput = progress["bytes"] / progress["seconds"]
+		progress["throughput_mb_per_second"] = round(throughput / 1024**2, 2)
+	print(json.dumps(progress, default=str))
+
+
+@frappe.whitelist()
+def enqueue_migration(dry_run: bool = False, restart: bool = False) -> None:
+	frappe.only_for("System Manager")
+	frappe.enqueue(
+		"cloud_storage.cloud_storage.migration.migrate_local_files",
+		queue="long",
+		timeout=24 * 60 * 60,
+		job_name="cloud_storage_migration",
+		dry_run=frappe.parse_json(dry_run),
+		restart=frappe.parse_json(restart),
+	)
+
+
+@frappe.whitelist()
+def get_migration_progress() -> dict:
+	frappe.only_for("System Manager")
+	return load_checkpoint()
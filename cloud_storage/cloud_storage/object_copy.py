@@ -0,0 +1,68 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# S3 limits for server-side copies
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+COPY_PART_SIZE = 512 * 1024 * 1024
+
+
+def copy_object(
+	client, source_key: str, destination_key: str, version_id: Optional[str] = None
+) -> dict:
+	"""
+	Copies an object (or one of its versions) to another key within the bucket. The copy is made by the
+	storage provider, so the content never passes through the worker; objects over 5 GB are copied in
+	parts with `upload_part_copy`.
+	"""
+	source = {"Bucket": client.bucket, "Key": source_key}
+	if version_id:
+		source["VersionId"] = version_id
+
+	head = client.head_object(**source)
+	if head["ContentLength"] <= MAX_COPY_OBJECT_SIZE:
+		return client.copy_object(
+			Bucket=client.bucket, Key=destination_key, CopySource=source, MetadataDirective="COPY"
+		)
+	return copy_object_multipart(client, source, destination_key, head)
+
+
+def copy_object_multipart(client, source: dict, destination_key: str, head: dict) -> dict:
+	size = head["ContentLength"]
+	part_size = max(getattr(client, "copy_part_size", COPY_PART_SIZE), math.ceil(size / MAX_PARTS))
+	ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+	upload = client.create_multipart_upload(
+		Bucket=client.bucket,
+		Key=destination_key,
+		ContentType=head.get("ContentType", "application/octet-stream"),
+		Metadata=head.get("Metadata", {}),
+	)
+	upload_id = upload["UploadId"]
+
+	def copy_part(part_number: int) -> dict:
+		start, end = ranges[part_number - 1]
+		response = client.upload_part_copy(
+			Bucket=client.bucket,
+			Key=destination_key,
+			UploadId=upload_id,
+			PartNumber=part_number,
+			CopySource=source,
+			CopySourceRange=f"bytes={start}-{end}",
+		)
+		return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+
+	try:
+		workers = client.transfer_config.max_concurrency if hasattr(client, "transfer_config") else 4
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			parts = list(executor.map(copy_part, range(1, len(ranges) + 1)))
+		return client.complete_multipart_upload(
+			Bucket=client.bucket,
+			Key=destination_key,
+			UploadId=upload_id,
+			MultipartUpload={"Parts": parts},
+		)
+	except Exception:
+		client.abort_multipart_upload(Bucket=client.bucket, Key=destination_key, UploadId=upload_id)
+		raise
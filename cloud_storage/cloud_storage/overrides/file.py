@@ -1,29 +1,92 @@
+import hashlib
+import io
 import json
+import mimetypes
+import mmap
 import os
 import re
+import tempfile
+import threading
+import time
 import types
 import uuid
+from collections import defaultdict
+from functools import partial
 from mimetypes import guess_type
-from typing import Optional, Union
+from typing import Iterator, Optional, Union
 
 import frappe
 from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from boto3.session import Session
 from botocore.config import Config
 from botocore.exceptions import ClientError
 from frappe import DoesNotExistError, _
 from frappe.core.doctype.file.file import File, get_files_path
-from frappe.core.doctype.file.utils import decode_file_content, get_content_hash
+from frappe.core.doctype.file.utils import decode_file_content, get_content_hash, get_file_name
+from frappe.model import log_types
 from frappe.model.rename_doc import rename_doc
 from frappe.permissions import has_user_permission
+from frappe.query_builder import Criterion, DocType
 from frappe.utils import get_datetime, get_url
-from frappe.utils.image import optimize_image, strip_exif_data
+from frappe.utils.image import strip_exif_data
 from magic import from_buffer
 from PIL import UnidentifiedImageError
+from pypika.terms import Case
 from werkzeug.datastructures import FileStorage
+from werkzeug.wrappers import Response
+
+from cloud_storage.cloud_storage.attachments import clear_attachments_cache
+from cloud_storage.cloud_storage.compression import (
+	compress,
+	compress_stream,
+	decompress,
+	get_content_encoding,
+	is_browser_encoding,
+	open_decompressed,
+)
+from cloud_storage.cloud_storage.content_cache import get_cached_object
+from cloud_storage.cloud_storage.derivatives import get_derivatives, queue_derivatives
+from cloud_storage.cloud_storage.doctype.pending_deletion.pending_deletion import (
+	queue_deletion,
+	queue_deletions,
+)
+from cloud_storage.cloud_storage.instrumentation import instrument_client, tag_operations
+from cloud_storage.cloud_storage.object_copy import COPY_PART_SIZE, copy_object
+from cloud_storage.cloud_storage.replication import (
+	SPOOLED_STATUSES,
+	remove_spooled_file,
+	spool_file,
+)
+from cloud_storage.cloud_storage.versions import (
+	get_version_count,
+	get_version_key,
+	insert_file_version,
+)
 
 FILE_URL = "/api/method/retrieve?key={path}"
 URL_PREFIXES = ("http://", "https://", "/api/method/retrieve")
+MB = 1024 * 1024
+STREAM_CHUNK_SIZE = 1 * MB
+PRESIGNED_URL_CACHE_KEY = "cloud_storage_presigned_url|{key}"
+SHARING_URL_CACHE_KEY = "cloud_storage_sharing_url|{key}"
+MAX_BATCH_SIZE = 500
+# number of documents whose associations are removed together
+REFERENCE_BATCH_SIZE = 100
+# documents whose deletion never affects attachments
+NON_ATTACHABLE_DOCTYPES = (
+	"File",
+	"File Association",
+	"File Version",
+	"Pending Deletion",
+	"Comment",
+	*log_types,
+)
+
+# S3 clients are thread-safe and hold the connection pool, so each worker process keeps one per site
+# and only rebuilds it when that site's `cloud_storage_settings` change
+_clients: dict = {}
+_clients_lock = threading.Lock()
 
 
 class CustomFile(File):
@@ -63,13 +126,11 @@ class CustomFile(File):
 			client = get_cloud_storage_client()
 			path = get_file_path(self, client.folder)
 			self.file_url = FILE_URL.format(path=path)
+		duplicates = get_duplicate_files(self, attached_to_doctype, attached_to_name)
 		if not self.content_hash and "/api/method/retrieve" in self.file_url:  # type: ignore
-			associated_doc = frappe.get_value("File", {"file_url": self.file_url}, "name")
+			associated_doc = duplicates.url_match
 		else:
-			associated_doc = frappe.get_value(
-				"File",
-				{"content_hash": self.content_hash, "name": ["!=", self.name], "is_folder": False},  # type: ignore
-			)
+			associated_doc = duplicates.hash_match
 		if associated_doc and associated_doc != self.name:
 			existing_file = frappe.get_doc("File", associated_doc)
 			existing_file.attached_to_doctype = attached_to_doctype
@@ -79,6 +140,12 @@ class CustomFile(File):
 			# the original File will then be removed in the after insert hook
 			self = existing_file
 
+		self.add_file_association(attached_to_doctype, attached_to_name)
+		# an existing File that already carries this association doesn't need to be saved again
+		if associated_doc and associated_doc != self.name and associated_doc not in duplicates.associated:
+			self.save()
+
+	def add_file_association(self, attached_to_doctype: str, attached_to_name: str) -> None:
 		existing_attachment = list(
 			filter(
 				lambda row: row.link_doctype == attached_to_doctype and row.link_name == attached_to_name,
@@ -95,8 +162,56 @@ class CustomFile(File):
 					"timestamp": get_datetime(),
 				},
 			)
-		if associated_doc and associated_doc != self.name:
-			self.save()
+			clear_attachments_cache(attached_to_doctype, attached_to_name)
+
+	def insert(self, ignore_permissions: Optional[bool] = None, *args, **kwargs) -> File:
+		if ignore_permissions:
+			self.flags.ignore_permissions = True
+		existing_file = self.get_existing_file()
+		if not existing_file:
+			return super().insert(ignore_permissions, *args, **kwargs)
+
+		# the insert is redirected to the existing File, so callers holding this document see that File
+		self.update(existing_file.as_dict())
+		self.set("__islocal", False)
+		self.flags.cloud_storage_existing_file = existing_file.name
+		return self
+
+	def get_existing_file(self) -> Optional[File]:
+		"""
+		Looks for a File that already holds this File's content before it is inserted. If one exists, the
+		association is appended to it and it is returned, so no temporary row is created and no merge
+		with `rename_doc` is needed in `after_insert`.
+		"""
+		if self.is_folder or not (self.attached_to_doctype and self.attached_to_name):  # type: ignore
+			return None
+		settings = frappe.conf.cloud_storage_settings
+		if not settings or settings.get("use_local", False) or self.attached_to_doctype == "Data Import":
+			return None
+
+		content = self.get("content")
+		if not self.content_hash and isinstance(content, (bytes, str)):
+			if self.decode:
+				content = decode_file_content(content)
+			self.content_hash = get_content_hash(content)
+
+		duplicates = get_duplicate_files(self)
+		if not self.content_hash and "/api/method/retrieve" in (self.file_url or ""):  # type: ignore
+			associated_doc = duplicates.url_match
+		else:
+			associated_doc = duplicates.hash_match
+		if not associated_doc:
+			return None
+
+		if not self.flags.ignore_permissions:
+			self.check_permission("create")
+		existing_file: File = frappe.get_doc("File", associated_doc)
+		if associated_doc not in duplicates.associated:
+			existing_file.attached_to_doctype = self.attached_to_doctype  # type: ignore
+			existing_file.attached_to_name = self.attached_to_name  # type: ignore
+			existing_file.add_file_association(self.attached_to_doctype, self.attached_to_name)  # type: ignore
+			existing_file.save(ignore_permissions=True)
+		return existing_file
 
 	def validate(self) -> None:
 		self.associate_files()
@@ -107,20 +222,31 @@ class CustomFile(File):
 		else:
 			self.validate_file_url()
 
+	def onload(self) -> None:
+		# the history is loaded on demand with `get_file_versions`
+		self.set_onload("version_count", get_version_count(self.name))
+
 	def after_insert(self) -> File:
+		for version in self.flags.pop("cloud_storage_versions", None) or []:
+			insert_file_version(self.name, version)
+
+		# duplicates are normally redirected before insert (see `get_existing_file`); this merge only
+		# catches those created concurrently between that check and the insert
 		if self.attached_to_doctype and self.attached_to_name and not self.file_association:  # type: ignore
+			duplicates = get_duplicate_files(self)
 			if not self.content_hash and "/api/method/retrieve" in self.file_url:
-				associated_doc = frappe.get_value("File", {"file_url": self.file_url}, "name")
+				associated_doc = duplicates.url_match
 			else:
-				associated_doc = frappe.get_value(
-					"File",
-					{"content_hash": self.content_hash, "name": ["!=", self.name], "is_folder": False},
-					"name",
-				)
+				associated_doc = duplicates.hash_match
 			if associated_doc:
 				self.db_set(
 					"file_url", ""
 				)  # this is done to prevent deletion of the remote file with the delete_file hook
+				# versions aren't a table on File, so `rename_doc` doesn't move them
+				FileVersion = DocType("File Version")
+				frappe.qb.update(FileVersion).set(FileVersion.parent, associated_doc).where(
+					FileVersion.parenttype == "File"
+				).where(FileVersion.parent == self.name).run()
 				rename_doc(
 					self.doctype,
 					self.name,
@@ -131,17 +257,22 @@ class CustomFile(File):
 					ignore_permissions=True,
 				)
 
-	def add_file_version(self, version_id):
-		self.append(
-			"versions",
-			{
-				"version": str(version_id),
-				"user": frappe.session.user,
-				"timestamp": get_datetime(),
-			},
-		)
+	def add_file_version(self, version_id, key: Optional[str] = None):
+		version = {
+			"version": str(version_id),
+			# versions stay under the key they were written to when the File is relocated
+			"s3_key": key or self.s3_key,
+			"user": frappe.session.user,
+			"timestamp": get_datetime(),
+		}
+		if self.is_new():
+			# recorded once the File is inserted
+			self.flags.cloud_storage_versions = [*(self.flags.cloud_storage_versions or []), version]
+		else:
+			insert_file_version(self.name, version)
 
 	def remove_file_association(self, dt: str, dn: str) -> None:
+		clear_attachments_cache(dt, dn)
 		if len(self.file_association) <= 1:
 			self.delete()
 			return
@@ -159,7 +290,64 @@ class CustomFile(File):
 			self.remove(row)
 		for idx, association in enumerate(self.file_association, start=1):
 			association.idx = idx
+		if frappe.conf.cloud_storage_settings and frappe.conf.cloud_storage_settings.get(
+			"relocate_on_reassociation", False
+		):
+			self.relocate()
+		self.save()
+
+	def relocate(self) -> None:
+		"""
+		Moves the File's object to the key its current attachment maps to, with a server-side copy.
+		The File's URL changes with its key, so links to the previous URL stop working. The previous
+		key is queued for deletion in the same transaction, so it is only removed once the File
+		pointing at the new key has been saved.
+		"""
+		if not self.s3_key or self.is_spooled:
+			return
+		client = get_cloud_storage_client()
+		if get_file_path(self, client.folder) == self.s3_key:
+			return
+		# another File attached to the same document may already hold this name
+		path = get_unique_file_path(client, self)
+		response = copy_object(client, self.s3_key, path)
+		queue_deletion(self.s3_key)
+		if response.get("VersionId"):
+			self.add_file_version(response.get("VersionId"), path)
+		self.relocate_derivatives(client, path)
+		self.s3_key = path
+		self.file_url = FILE_URL.format(path=path)
+
+	def relocate_derivatives(self, client, path: str) -> None:
+		"""Copies the File's renditions to go with its object's new key, like `relocate`"""
+		derivatives = get_derivatives(self)
+		for derivative in derivatives.values():
+			# renditions are stored under their original's key
+			key = f"{path}.derivatives/{derivative['key'].rsplit('.derivatives/', 1)[1]}"
+			copy_object(client, derivative["key"], key)
+			queue_deletion(derivative["key"])
+			derivative["key"] = key
+		if derivatives:
+			self.derivatives = json.dumps(derivatives)
+
+	def restore_version(self, version_id: str) -> None:
+		"""Makes a prior version the File's current content, with a server-side copy of that version"""
+		source_key = get_version_key(self.name, version_id)
+		if source_key is None:
+			frappe.throw(_("Version {0} does not belong to this File").format(version_id))
+		client = get_cloud_storage_client()
+		response = copy_object(client, source_key or self.s3_key, self.s3_key, version_id)
+		if response.get("VersionId"):
+			self.add_file_version(response.get("VersionId"))
+		# the restored version may have been stored with a different encoding
+		head = client.head_object(Bucket=client.bucket, Key=self.s3_key)
+		self.content_encoding = head.get("ContentEncoding")
+		# the hashes describe the content that was just replaced
+		for fieldname in ("content_hash", "upload_hash", "stripped_content_hash", "original_content_hash"):
+			self.set(fieldname, None)
 		self.save()
+		# the renditions show the content that was just replaced
+		queue_derivatives(self)
 
 	@property
 	def is_remote_file(self) -> bool:
@@ -167,6 +355,11 @@ class CustomFile(File):
 			return self.file_url.startswith(URL_PREFIXES)
 		return not self.content
 
+	@property
+	def is_spooled(self) -> bool:
+		"""Whether the File's content is still in the local spool, waiting to be replicated"""
+		return self.get("replication_status") in SPOOLED_STATUSES and bool(self.get("spool_path"))
+
 	def get_content(self) -> bytes:
 		if self.is_folder:
 			frappe.throw(_("Cannot get file contents of a Folder"))
@@ -183,10 +376,19 @@ class CustomFile(File):
 			self.validate_file_url()
 		file_path = self.get_full_path()
 
-		if self.is_remote_file:
+		if self.is_spooled:
+			with open(self.spool_path, mode="rb") as f:
+				self._content = f.read()
+		elif self.is_remote_file:
 			client = get_cloud_storage_client()
-			file_object = client.get_object(Bucket=client.bucket, Key=self.s3_key)
-			self._content = file_object.get("Body").read()
+			cached = open_cached_object(client, self.s3_key)
+			if cached is not None:
+				with cached:
+					self._content = cached[:] if isinstance(cached, mmap.mmap) else cached.read()
+			else:
+				file_object = client.get_object(Bucket=client.bucket, Key=self.s3_key)
+				self._content = file_object.get("Body").read()
+			self._content = decompress(self._content, self.get("content_encoding"))
 		else:
 			# read the file
 			with open(file_path, mode="rb") as f:
@@ -200,6 +402,89 @@ class CustomFile(File):
 
 		return self._content
 
+	def open_content(self):
+		"""
+		Returns a seekable, read-only file-like object over the File's content without loading it
+		into memory. Remote files are read with ranged requests as the object is read; local files
+		are memory-mapped.
+		"""
+		if self.is_folder:
+			frappe.throw(_("Cannot get file contents of a Folder"))
+
+		if self.get("content"):
+			return io.BytesIO(self._get_content_bytes())
+
+		if self.file_url:
+			self.validate_file_url()
+		file_path = self.get_full_path()
+
+		if self.is_spooled:
+			return open_local_file(self.spool_path)
+		if self.is_remote_file:
+			client = get_cloud_storage_client()
+			cached = open_cached_object(client, self.s3_key)
+			if self.get("content_encoding"):
+				# compressed content can't be read by range, so it is decompressed up front
+				if cached is None:
+					cached = client.get_object(Bucket=client.bucket, Key=self.s3_key).get("Body")
+				try:
+					return open_decompressed(cached, self.content_encoding)
+				finally:
+					cached.close()
+			if cached is not None:
+				return cached
+			return io.BufferedReader(
+				RemoteObjectReader(client, self.s3_key), buffer_size=STREAM_CHUNK_SIZE
+			)
+		return open_local_file(file_path)
+
+	def iter_content(
+		self, chunk_size: int = STREAM_CHUNK_SIZE, start: int = 0, end: Optional[int] = None
+	) -> Iterator[bytes]:
+		"""
+		Yields the File's content in chunks. `start` and `end` are inclusive byte offsets, as in an
+		HTTP Range header; if `end` is omitted the content is read to the end.
+		"""
+		if start < 0 or (end is not None and end < start):
+			frappe.throw(_("Invalid byte range {0}-{1}").format(start, end or ""))
+
+		content = None
+		if (
+			self.is_remote_file
+			and not self.get("content")
+			and not self.is_spooled
+			and not self.get("content_encoding")
+		):
+			if self.file_url:
+				self.validate_file_url()
+			client = get_cloud_storage_client()
+			content = open_cached_object(client, self.s3_key)
+			if content is None:
+				file_object = client.get_object(
+					Bucket=client.bucket, Key=self.s3_key, Range=f"bytes={start}-{'' if end is None else end}"
+				)
+				yield from file_object.get("Body").iter_chunks(chunk_size)
+				return
+
+		with content if content is not None else self.open_content() as f:
+			f.seek(start)
+			remaining = None if end is None else end - start + 1
+			while remaining is None or remaining > 0:
+				chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+				if not chunk:
+					break
+				if remaining is not None:
+					remaining -= len(chunk)
+				yield chunk
+
+	def get_content_range(self, start: int, end: Optional[int] = None) -> bytes:
+		"""Returns the bytes between the inclusive offsets `start` and `end`"""
+		return b"".join(self.iter_content(start=start, end=end))
+
+	def _get_content_bytes(self) -> bytes:
+		content = self.get_content()
+		return content.encode() if isinstance(content, str) else content
+
 	def get_full_path(self):
 		"""Returns file path from given file name"""
 
@@ -236,15 +521,163 @@ class CustomFile(File):
 		return file_path
 
 
+class RemoteObjectReader(io.RawIOBase):
+	"""Seekable, read-only view of an object in the bucket that fetches bytes with ranged requests"""
+
+	def __init__(self, client, key: str) -> None:
+		self.client = client
+		self.key = key
+		self.position = 0
+		self._size: Optional[int] = None
+
+	@property
+	def size(self) -> int:
+		if self._size is None:
+			response = self.client.head_object(Bucket=self.client.bucket, Key=self.key)
+			self._size = response.get("ContentLength", 0)
+		return self._size
+
+	def readable(self) -> bool:
+		return True
+
+	def seekable(self) -> bool:
+		return True
+
+	def tell(self) -> int:
+		return self.position
+
+	def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+		if whence == io.SEEK_SET:
+			position = offset
+		elif whence == io.SEEK_CUR:
+			position = self.position + offset
+		elif whence == io.SEEK_END:
+			position = self.size + offset
+		else:
+			raise ValueError(f"Invalid whence ({whence})")
+		if position < 0:
+			raise ValueError(f"Negative seek position {position}")
+		self.position = position
+		return position
+
+	def readinto(self, buffer) -> int:
+		if not len(buffer) or self.position >= self.size:
+			return 0
+		end = min(self.position + len(buffer), self.size) - 1
+		response = self.client.get_object(
+			Bucket=self.client.bucket, Key=self.key, Range=f"bytes={self.position}-{end}"
+		)
+		data = response.get("Body").read()
+		buffer[: len(data)] = data
+		self.position += len(data)
+		return len(data)
+
+	def readall(self) -> bytes:
+		if self.position >= self.size:
+			return b""
+		response = self.client.get_object(
+			Bucket=self.client.bucket, Key=self.key, Range=f"bytes={self.position}-"
+		)
+		data = response.get("Body").read()
+		self.position += len(data)
+		return data
+
+
+def open_cached_object(client, key: str):
+	"""Opens the local copy of an object in the content cache, or returns None to read it from the bucket"""
+	path = get_cached_object(client, key)
+	if path is None:
+		return None
+	try:
+		return open_local_file(path)
+	except FileNotFoundError:
+		# evicted by another worker in the meantime
+		return None
+
+
+def open_local_file(file_path: str):
+	with open(file_path, mode="rb") as f:
+		# empty files cannot be memory-mapped
+		if not os.fstat(f.fileno()).st_size:
+			return io.BytesIO()
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def get_duplicate_files(
+	file: File, attached_to_doctype: Optional[str] = None, attached_to_name: Optional[str] = None
+) -> frappe._dict:
+	"""
+	Finds the most recent File that shares this File's content hash, name or URL, with one limited
+	lookup for each, and which of them are already associated with the given document. The result is
+	kept on the File's flags for the rest of its save and is only looked up again if the values it
+	depends on change.
+	"""
+	attached_to_doctype = attached_to_doctype or file.attached_to_doctype
+	attached_to_name = attached_to_name or file.attached_to_name
+	key = (
+		file.name,
+		file.content_hash,
+		file.file_name,
+		file.file_url,
+		attached_to_doctype,
+		attached_to_name,
+	)
+	duplicates = file.flags.get("cloud_storage_duplicates")
+	if duplicates and duplicates.key == key:
+		return duplicates
+
+	File = DocType("File")
+	FileAssociation = DocType("File Association")
+
+	def first_match(fieldname: str) -> Optional[frappe._dict]:
+		# common names (eg. `image.png`) are shared by many Files, so each value is looked up on its own
+		# with a limit rather than fetching every File that matches any of them
+		value = file.get(fieldname)
+		if not value:
+			return None
+		query = (
+			frappe.qb.from_(File)
+			.left_join(FileAssociation)
+			.on(
+				(FileAssociation.parent == File.name)
+				& (FileAssociation.parenttype == "File")
+				& (FileAssociation.link_doctype == attached_to_doctype)
+				& (FileAssociation.link_name == attached_to_name)
+			)
+			.select(File.name, FileAssociation.name.as_("association"))
+			.where(File[fieldname] == value)
+			.where(File.is_folder == 0)
+			.orderby(File.modified, order=frappe.qb.desc)
+			.limit(1)
+		)
+		if file.name:
+			query = query.where(File.name != file.name)
+		rows = query.run(as_dict=True)
+		return rows[0] if rows else None
+
+	matches = {
+		fieldname: first_match(fieldname) for fieldname in ("content_hash", "file_name", "file_url")
+	}
+	duplicates = frappe._dict(
+		key=key,
+		hash_match=(matches["content_hash"] or {}).get("name"),
+		name_match=(matches["file_name"] or {}).get("name"),
+		url_match=(matches["file_url"] or {}).get("name"),
+		associated={row.name for row in matches.values() if row and row.association},
+	)
+	file.flags.cloud_storage_duplicates = duplicates
+	return duplicates
+
+
 def has_permission(doc, ptype: Optional[str] = None, user: Optional[str] = None) -> bool:
 	has_access = False
 	user = frappe.session.user if not user else user
+	references = get_file_references(doc)
 	# check if public
 	if doc.owner == user:
 		has_access = True
-	elif doc.attached_to_doctype and doc.attached_to_name:  # type: ignore
-		reference_doc = frappe.get_doc(doc.attached_to_doctype, doc.attached_to_name)  # type: ignore
-		has_access = reference_doc.has_permission()
+	elif references:
+		has_access = any(get_reference_permissions(references, user).values())
 		if not has_access:
 			has_access = has_user_permission(doc, user)
 	# elif True:
@@ -256,6 +689,62 @@ def has_permission(doc, ptype: Optional[str] = None, user: Optional[str] = None)
 	return has_access
 
 
+def get_file_references(doc) -> list:
+	"""Returns every document a File is attached to, from `attached_to_*` and its File Association rows"""
+	references = []
+	if doc.get("attached_to_doctype") and doc.get("attached_to_name"):
+		references.append((doc.attached_to_doctype, doc.attached_to_name))
+	for row in doc.get("file_association") or []:
+		if row.link_doctype and row.link_name and (row.link_doctype, row.link_name) not in references:
+			references.append((row.link_doctype, row.link_name))
+	return references
+
+
+def get_reference_permissions(
+	references: list, user: str, ptype: str = "read"
+) -> dict:
+	"""
+	Evaluates `ptype` permission on each referenced document, memoized for the rest of the request.
+	Documents that no longer exist are found with one query per DocType; the rest are checked with
+	`frappe.has_permission`, which loads them with their child tables for any permission hooks.
+	"""
+	if not hasattr(frappe.local, "cloud_storage_permissions"):
+		frappe.local.cloud_storage_permissions = {}
+	memo: dict = frappe.local.cloud_storage_permissions
+
+	missing = defaultdict(list)
+	for doctype, name in references:
+		if (user, doctype, name, ptype) not in memo:
+			missing[doctype].append(name)
+
+	for doctype, names in missing.items():
+		existing = get_existing_names(doctype, names)
+		for name in names:
+			memo[(user, doctype, name, ptype)] = name in existing and has_reference_permission(
+				doctype, name, ptype, user
+			)
+
+	return {(doctype, name): memo[(user, doctype, name, ptype)] for doctype, name in references}
+
+
+def get_existing_names(doctype: str, names: list) -> set:
+	try:
+		meta = frappe.get_meta(doctype)
+	except DoesNotExistError:
+		return set()
+	# Single and virtual DocTypes have no table to query
+	if meta.issingle or meta.is_virtual:
+		return set(names)
+	return set(frappe.get_all(doctype, filters={"name": ["in", names]}, pluck="name"))
+
+
+def has_reference_permission(doctype: str, name: str, ptype: str, user: str) -> bool:
+	try:
+		return bool(frappe.has_permission(doctype, ptype, doc=name, user=user))
+	except DoesNotExistError:
+		return False
+
+
 def is_safe_path(path: str) -> bool:
 	if path.startswith(URL_PREFIXES):
 		return True
@@ -278,10 +767,26 @@ def get_sharing_link(docname: str, reset: Optional[Union[str, bool]] = None) ->
 			doctype="File", ptype="share", doc=doc, user=frappe.session.user, throw=True
 		)
 	if reset or not doc.sharing_link:
+		invalidate_url_cache(doc)
 		doc.db_set("sharing_link", str(uuid.uuid4().int >> 64))
 	return f"{get_url()}/api/method/share?key={doc.sharing_link}"
 
 
+@frappe.whitelist()
+def restore_file_version(docname: str, version_id: str) -> None:
+	doc = frappe.get_doc("File", docname)
+	doc.check_permission("write")
+	doc.restore_version(version_id)
+
+
+@frappe.whitelist()
+def relocate_file(docname: str) -> None:
+	doc = frappe.get_doc("File", docname)
+	doc.check_permission("write")
+	doc.relocate()
+	doc.save()
+
+
 def strip_special_chars(file_name: str) -> str:
 	regex = re.compile(r"[^\w\s_.()-]")
 	return regex.sub("", file_name)
@@ -292,23 +797,71 @@ def get_cloud_storage_client():
 	validate_config()
 
 	config: dict = frappe.conf.cloud_storage_settings
+	site = getattr(frappe.local, "site", None)
+	config_hash = get_config_hash(config)
+
+	cached = _clients.get(site)
+	if cached and cached[0] == config_hash:
+		return cached[1]
+
+	with _clients_lock:
+		cached = _clients.get(site)
+		if cached and cached[0] == config_hash:
+			return cached[1]
+		client = build_cloud_storage_client(config)
+		_clients[site] = (config_hash, client)
+
+	return client
+
+
+def build_cloud_storage_client(config: dict):
 	session = Session(
 		aws_access_key_id=config.get("access_key"),
 		aws_secret_access_key=config.get("secret"),
 		region_name=config.get("region"),
 	)
-	client = session.client(
-		"s3", endpoint_url=config.get("endpoint_url"), config=Config(signature_version="s3v4")
+	client_config = Config(
+		signature_version="s3v4",
+		max_pool_connections=config.get("max_pool_connections", 10),
+		tcp_keepalive=config.get("tcp_keepalive", True),
+		retries={
+			"mode": config.get("retry_mode", "standard"),
+			"max_attempts": config.get("max_attempts", 3),
+		},
 	)
+	client = session.client("s3", endpoint_url=config.get("endpoint_url"), config=client_config)
 	client.bucket = config.get("bucket")
 	client.folder = config.get("folder", None)
 	client.expiration = config.get("expiration", 120)
+	# cached URLs must outlive the cache entry by a safe margin, so the TTL is capped at half the expiration
+	client.url_cache_ttl = min(config.get("url_cache_ttl", client.expiration // 2), client.expiration // 2)
+	# peak memory for a managed upload is roughly `multipart_chunksize * max_concurrency`
+	client.transfer_config = TransferConfig(
+		multipart_threshold=config.get("multipart_threshold", 8 * MB),
+		multipart_chunksize=config.get("multipart_chunksize", 8 * MB),
+		max_concurrency=config.get("max_concurrency", 4),
+		use_threads=True,
+	)
+	client.copy_part_size = config.get("copy_part_size", COPY_PART_SIZE)
 	client.get_presigned_url = types.MethodType(get_presigned_url, client)
 	client.get_sharing_url = types.MethodType(get_sharing_url, client)
+	instrument_client(client, config)
 
 	return client
 
 
+def get_config_hash(config: dict) -> str:
+	return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def clear_cloud_storage_client_cache(site: Optional[str] = None) -> None:
+	with _clients_lock:
+		if site:
+			_clients.pop(site, None)
+		else:
+			_clients.clear()
+
+
 def validate_config() -> None:
 	config: dict = frappe.conf.cloud_storage_settings
 
@@ -349,11 +902,23 @@ def validate_config() -> None:
 		)
 
 
-def get_presigned_url(client, key: str):
-	file = frappe.get_value("File", {"s3_key": key}, ["name", "is_private"], as_dict=True)
+def get_presigned_url(client, key: str, size: Optional[str] = None):
+	cache_key = PRESIGNED_URL_CACHE_KEY.format(key=key)
+	suffix = f"|{size}" if size else ""
+	signed_url = get_cached_url(cache_key, frappe.session.user + suffix) or get_cached_url(
+		cache_key, "public" + suffix
+	)
+	if signed_url:
+		return signed_url
+
+	file = frappe.get_value(
+		"File",
+		{"s3_key": key},
+		["name", "is_private", "replication_status", "derivatives", "content_encoding"],
+		as_dict=True,
+	)
 	if not file:
 		raise DoesNotExistError(frappe._("The file you are looking for is not available"))
-	expiration = client.expiration if file.is_private else None
 
 	if file.is_private:
 		file_doc = frappe.get_doc("File", file.name)
@@ -361,44 +926,273 @@ def get_presigned_url(client, key: str):
 			doctype="File", ptype="read", doc=file_doc, user=frappe.session.user, throw=True
 		)
 
-	return client.generate_presigned_url(
+	# there is nothing to sign until a write-behind upload has been replicated to the bucket, and
+	# content that clients can't decode is decompressed by `retrieve` instead
+	if file.replication_status in SPOOLED_STATUSES or not is_browser_encoding(
+		file.content_encoding
+	):
+		return
+
+	# a size that hasn't been generated (yet) is served by the original
+	derivative = get_derivatives(file).get(size) if size else None
+	if derivative:
+		return sign_url(client, derivative["key"], file.is_private, source_key=key, size=size)
+	return sign_url(client, key, file.is_private)
+
+
+def sign_url(
+	client, key: str, is_private: bool, source_key: Optional[str] = None, size: Optional[str] = None
+) -> str:
+	signed_url = client.generate_presigned_url(
 		ClientMethod="get_object",
 		Params={"Bucket": client.bucket, "Key": key},
-		ExpiresIn=expiration,
+		ExpiresIn=client.expiration if is_private else None,
 	)
+	# private URLs are only reused for the user whose permissions were checked
+	scope = frappe.session.user if is_private else "public"
+	# derivatives are cached with their original, so they are invalidated along with it
+	if size:
+		scope = f"{scope}|{size}"
+	cache_key = PRESIGNED_URL_CACHE_KEY.format(key=source_key or key)
+	set_cached_url(cache_key, scope, signed_url, client.url_cache_ttl)
+	return signed_url
+
+
+def get_presigned_urls(
+	client, keys: Optional[list] = None, names: Optional[list] = None, size: Optional[str] = None
+) -> dict:
+	"""
+	Returns signed URLs for many Files, keyed by the S3 key or File name they were requested by. Files
+	are fetched in one query; read permission is checked for each private File, while the documents
+	they reference are only evaluated once (see `get_reference_permissions`). Files that don't exist
+	or can't be read map to None. With `size`, images are signed at that derivative
+	size where it has been generated.
+	"""
+	keys, names = list(keys or []), list(names or [])
+	urls: dict = {identifier: None for identifier in keys + names}
+	if not urls:
+		return urls
+
+	File = DocType("File")
+	conditions = []
+	if keys:
+		conditions.append(File.s3_key.isin(keys))
+	if names:
+		conditions.append(File.name.isin(names))
+	files = (
+		frappe.qb.from_(File)
+		.select(
+			File.name,
+			File.s3_key,
+			File.is_private,
+			File.replication_status,
+			File.derivatives,
+			File.content_encoding,
+		)
+		.where(Criterion.any(conditions))
+	).run(as_dict=True)
+
+	user = frappe.session.user
+	for file in files:
+		if not file.s3_key:
+			continue
+		cache_key = PRESIGNED_URL_CACHE_KEY.format(key=file.s3_key)
+		derivative = get_derivatives(file).get(size) if size else None
+		suffix = f"|{size}" if derivative else ""
+		signed_url = get_cached_url(cache_key, user + suffix) or get_cached_url(
+			cache_key, "public" + suffix
+		)
+		if not signed_url:
+			# access depends on every association, sharing and ownership of the File, so it can't be
+			# shared between Files attached to the same document
+			if file.is_private and not frappe.has_permission(
+				doctype="File", ptype="read", doc=frappe.get_doc("File", file.name), user=user
+			):
+				continue
+			if file.replication_status in SPOOLED_STATUSES or not is_browser_encoding(
+				file.content_encoding
+			):
+				signed_url = FILE_URL.format(path=file.s3_key)
+			elif derivative:
+				signed_url = sign_url(
+					client, derivative["key"], file.is_private, source_key=file.s3_key, size=size
+				)
+			else:
+				signed_url = sign_url(client, file.s3_key, file.is_private)
+
+		if file.s3_key in urls:
+			urls[file.s3_key] = signed_url
+		if file.name in urls:
+			urls[file.name] = signed_url
+	return urls
+
 
+def get_sharing_url(client, key: str) -> Optional[str]:
+	cache_key = SHARING_URL_CACHE_KEY.format(key=key)
+	signed_url = get_cached_url(cache_key, "public")
+	if signed_url:
+		return signed_url
 
-def get_sharing_url(client, key: str) -> str:
-	file = frappe.get_value("File", {"sharing_link": key}, ["name", "s3_key"], as_dict=True)
+	file = frappe.get_value(
+		"File", {"sharing_link": key}, ["name", "s3_key", "content_encoding"], as_dict=True
+	)
 	if not file:
 		raise DoesNotExistError(frappe._("The file you are looking for is not available"))
+	# content that clients can't decode is decompressed by `share` instead
+	if not is_browser_encoding(file.content_encoding):
+		return
 
-	return client.generate_presigned_url(
+	signed_url = client.generate_presigned_url(
 		ClientMethod="get_object", Params={"Bucket": client.bucket, "Key": file.s3_key}
 	)
+	set_cached_url(cache_key, "public", signed_url, client.url_cache_ttl)
+	return signed_url
+
+
+def get_cached_url(cache_key: str, scope: str) -> Optional[str]:
+	cached = frappe.cache().hget(cache_key, scope)
+	if cached and cached.get("expires_at", 0) > time.time():
+		return cached.get("url")
+
+
+def set_cached_url(cache_key: str, scope: str, url: str, ttl: int) -> None:
+	if ttl <= 0:
+		return
+	frappe.cache().hset(cache_key, scope, {"url": url, "expires_at": time.time() + ttl})
+	frappe.cache().expire(frappe.cache().make_key(cache_key), ttl)
+
+
+def invalidate_url_cache(doc, method: Optional[str] = None) -> None:
+	"""Drops cached signed URLs for a File when its privacy, associations or sharing link change"""
+	keys = {doc.get("s3_key")}
+	doc_before_save = doc.get_doc_before_save()
+	if doc_before_save:
+		keys.add(doc_before_save.get("s3_key"))
+
+	cache_keys = [PRESIGNED_URL_CACHE_KEY.format(key=key) for key in keys if key]
+	if doc.get("sharing_link"):
+		cache_keys.append(SHARING_URL_CACHE_KEY.format(key=doc.sharing_link))
+	for cache_key in cache_keys:
+		frappe.cache().delete_value(cache_key)
+
+
+def invalidate_attachments_cache(doc, method: Optional[str] = None) -> None:
+	"""Drops the cached attachment lists of every document a File is associated with"""
+	for doctype, name in get_file_references(doc):
+		clear_attachments_cache(doctype, name)
 
 
 def upload_file(file: File) -> File:
 	client = get_cloud_storage_client()
 	path = get_file_path(file, client.folder)
 	file.db_set("file_url", FILE_URL.format(path=path))
-	content_type = file.content_type or from_buffer(file.content, mime=True)
+	stream = get_content_stream(file, client.transfer_config.multipart_threshold)
+	content_type = file.content_type or get_content_type(file, stream)
 	try:
-		response = client.put_object(
-			Body=file.content, Bucket=client.bucket, Key=path, ContentType=content_type
-		)
-		if response.get("VersionId"):
-			file.add_file_version(response.get("VersionId"))
+		with tag_operations(file.attached_to_doctype):
+			upload_content(client, file, path, stream, content_type)
 	except S3UploadFailedError:
 		frappe.throw(_("File Upload Failed. Please try again."))
 	except Exception as e:
 		frappe.log_error("File Upload Error", e)
-	file.db_set("s3_key", path)
+	file.db_set({"s3_key": path, "content_encoding": file.get("content_encoding")})
 	if not file.name:
 		file.save()
+	queue_derivatives(file)
 	return file
 
 
+def upload_content(client, file: File, path: str, stream, content_type: str) -> None:
+	encoding = get_content_encoding(content_type)
+	compressed = None
+	if stream is not None:
+		if encoding:
+			compressed = compress_stream(stream, encoding)
+		extra_args = {"ContentType": content_type}
+		if compressed is not None:
+			extra_args["ContentEncoding"] = encoding
+		try:
+			# managed transfer: parts are read from the stream and uploaded concurrently
+			client.upload_fileobj(
+				stream if compressed is None else compressed,
+				client.bucket,
+				path,
+				ExtraArgs=extra_args,
+				Config=client.transfer_config,
+			)
+		finally:
+			if compressed is not None:
+				compressed.close()
+		response = client.head_object(Bucket=client.bucket, Key=path)
+	else:
+		if encoding:
+			content = file.content.encode() if isinstance(file.content, str) else file.content
+			compressed = compress(content, encoding)
+		extra_args = {"ContentEncoding": encoding} if compressed is not None else {}
+		response = client.put_object(
+			Body=file.content if compressed is None else compressed,
+			Bucket=client.bucket,
+			Key=path,
+			ContentType=content_type,
+			**extra_args,
+		)
+	file.content_encoding = encoding if compressed is not None else None
+	if response.get("VersionId"):
+		file.add_file_version(response.get("VersionId"), path)
+
+
+def get_content_stream(file: File, multipart_threshold: int):
+	"""
+	Returns a file-like object to upload from, or None if the content is small enough to be sent
+	in a single `put_object` request
+	"""
+	stream = file.flags.get("content_stream")
+	if isinstance(stream, (io.IOBase, tempfile.SpooledTemporaryFile)):
+		stream.seek(0)
+		return stream
+
+	content = file.content
+	if isinstance(content, str):
+		content = content.encode()
+	if isinstance(content, bytes) and len(content) >= multipart_threshold:
+		return io.BytesIO(content)
+
+
+def get_content_type(file: File, stream=None) -> str:
+	if stream is None:
+		return from_buffer(file.content, mime=True)
+	header = stream.read(2048)
+	stream.seek(0)
+	return from_buffer(header, mime=True)
+
+
+def get_request_upload(file: File) -> Optional[FileStorage]:
+	"""Returns the file uploaded in the current request for this File, if any"""
+	request = getattr(frappe.local, "request", None)
+	files = getattr(request, "files", None)
+	if not files or not hasattr(files, "get"):
+		return
+	upload = files.get("file")
+	if isinstance(upload, FileStorage) and upload.filename == file.file_name:
+		return upload
+
+
+def get_request_file_stream(file: File):
+	"""
+	Returns the spooled stream of the uploaded file in the current request, if any, so that large
+	uploads can be sent to the bucket without another in-memory copy of their content
+	"""
+	upload = get_request_upload(file)
+	if not upload:
+		return
+	# the content may have been altered (eg. optimized) after it was read from the request
+	upload.stream.seek(0, os.SEEK_END)
+	size = upload.stream.tell()
+	upload.stream.seek(0)
+	if isinstance(file.content, bytes) and len(file.content) == size:
+		return upload.stream
+
+
 def get_file_path(file: File, folder: Optional[str] = None) -> str:
 	parent_doctype = file.attached_to_doctype or "No Doctype"
 
@@ -414,6 +1208,174 @@ def get_file_path(file: File, folder: Optional[str] = None) -> str:
 	return path
 
 
+def get_unique_file_path(client, file: File, reserved: Optional[set] = None) -> str:
+	"""
+	Returns the key to store a new File's content at. While that key belongs to another File, already
+	holds an object or is in `reserved`, the File is renamed with a random suffix, as Frappe does for
+	local files, so existing content is never overwritten.
+	"""
+	path = get_file_path(file, client.folder)
+	while path in (reserved or set()) or is_key_taken(client, path, file.name):
+		file.file_name = get_file_name(file.file_name)
+		path = get_file_path(file, client.folder)
+	return path
+
+
+def is_key_taken(client, key: str, name: Optional[str] = None) -> bool:
+	File = DocType("File")
+	query = (
+		frappe.qb.from_(File)
+		.select(File.name)
+		.where((File.s3_key == key) | (File.file_url == FILE_URL.format(path=key)))
+		.limit(1)
+	)
+	if name:
+		query = query.where(File.name != name)
+	if query.run():
+		return True
+	try:
+		client.head_object(Bucket=client.bucket, Key=key)
+	except ClientError:
+		return False
+	return True
+
+
+def get_upload_hash(content: Union[bytes, str]) -> str:
+	"""SHA-256 of the content as uploaded, which browsers can compute before sending any bytes"""
+	if isinstance(content, str):
+		content = content.encode()
+	return hashlib.sha256(content).hexdigest()
+
+
+def get_request_upload_hash(file: File) -> str:
+	"""
+	Returns the upload hash of the File as it was uploaded in the current request; Frappe may since
+	have stripped EXIF data from or optimized an image, which the browser's hash doesn't reflect
+	"""
+	upload = get_request_upload(file)
+	if not upload:
+		return get_upload_hash(file.content)
+	upload_hash = hashlib.sha256()
+	upload.stream.seek(0)
+	for chunk in iter(lambda: upload.stream.read(STREAM_CHUNK_SIZE), b""):
+		upload_hash.update(chunk)
+	upload.stream.seek(0)
+	return upload_hash.hexdigest()
+
+
+def backfill_upload_hashes(batch_size: int = 500) -> None:
+	"""
+	Stores the hash matched by `check_file_exists` for Files uploaded before it was recorded. It is
+	computed from the stored content, which differs from what was uploaded for optimized images.
+	"""
+	File = DocType("File")
+	last_name = ""
+	while True:
+		names = (
+			frappe.qb.from_(File)
+			.select(File.name)
+			.where(File.name > last_name)
+			.where(File.is_folder == 0)
+			.where(File.upload_hash.isnull())
+			.where(
+				File.s3_key.isnotnull()
+				| File.file_url.like("/files/%")
+				| File.file_url.like("/private/files/%")
+			)
+			.orderby(File.name)
+			.limit(batch_size)
+		).run(pluck=True)
+		if not names:
+			break
+
+		for name in names:
+			try:
+				file = frappe.get_doc("File", name)
+				upload_hash = hashlib.sha256()
+				for chunk in file.iter_content():
+					upload_hash.update(chunk)
+				file.db_set("upload_hash", upload_hash.hexdigest(), update_modified=False)
+			except Exception:
+				frappe.log_error(title=f"Cloud Storage: Could not hash {name}")
+		last_name = names[-1]
+		frappe.db.commit()
+
+
+@frappe.whitelist()
+def enqueue_backfill_upload_hashes() -> None:
+	frappe.only_for("System Manager")
+	frappe.enqueue(
+		"cloud_storage.cloud_storage.overrides.file.backfill_upload_hashes", queue="long", timeout=6 * 3600
+	)
+
+
+def set_image_hashes(file: File) -> None:
+	"""
+	Stores the EXIF-stripped hash of an image, and that of the image as it was uploaded before being
+	optimized, so `validate_file_content` can match them with an indexed lookup
+	"""
+	content_type = file.content_type or guess_type(file.file_name or "")[0]
+	if not content_type or not content_type.startswith("image/") or not isinstance(file.content, bytes):
+		return
+
+	file.stripped_content_hash = get_file_content_hash(file.content, content_type)
+	file.original_content_hash = file.stripped_content_hash
+	upload = get_request_upload(file)
+	if upload:
+		upload.stream.seek(0)
+		original_content = upload.stream.read()
+		upload.stream.seek(0)
+		if original_content != file.content:
+			file.original_content_hash = get_file_content_hash(original_content, content_type)
+
+
+def backfill_image_hashes(batch_size: int = 500) -> None:
+	"""Stores the image hashes used by `validate_file_content` for Files uploaded before they existed"""
+	File = DocType("File")
+	image_extensions = [ext for ext, mime in mimetypes.types_map.items() if mime.startswith("image/")]
+	last_name = ""
+	while True:
+		names = (
+			frappe.qb.from_(File)
+			.select(File.name)
+			.where(File.name > last_name)
+			.where(File.is_folder == 0)
+			.where(File.stripped_content_hash.isnull())
+			.where(Criterion.any([File.file_name.like(f"%{ext}") for ext in image_extensions]))
+			.orderby(File.name)
+			.limit(batch_size)
+		).run(pluck=True)
+		if not names:
+			break
+
+		for name in names:
+			try:
+				file = frappe.get_doc("File", name)
+				content = file.get_content()
+				content_type = guess_type(file.file_name)[0]
+				stripped_content_hash = get_file_content_hash(content, content_type)
+				# the content as it was uploaded is no longer available, so both hashes are the same
+				file.db_set(
+					{
+						"stripped_content_hash": stripped_content_hash,
+						"original_content_hash": stripped_content_hash,
+					},
+					update_modified=False,
+				)
+			except Exception:
+				frappe.log_error(title=f"Cloud Storage: Could not hash {name}")
+		last_name = names[-1]
+		frappe.db.commit()
+
+
+@frappe.whitelist()
+def enqueue_backfill_image_hashes() -> None:
+	frappe.only_for("System Manager")
+	frappe.enqueue(
+		"cloud_storage.cloud_storage.overrides.file.backfill_image_hashes", queue="long", timeout=6 * 3600
+	)
+
+
 def get_file_content_hash(content, content_type):
 	try:
 		stripped_content = strip_exif_data(content, content_type)
@@ -424,6 +1386,10 @@ def get_file_content_hash(content, content_type):
 
 @frappe.whitelist()
 def write_file(file: File, remove_spaces_in_file_name: bool = True) -> File:
+	if isinstance(file.content, (bytes, str)):
+		file.upload_hash = get_request_upload_hash(file)
+		set_image_hashes(file)
+
 	if not frappe.conf.cloud_storage_settings or frappe.conf.cloud_storage_settings.get(
 		"use_local", False
 	):
@@ -434,35 +1400,42 @@ def write_file(file: File, remove_spaces_in_file_name: bool = True) -> File:
 		file.save_file_on_filesystem()
 		return file
 
-	# if a hash-conflict is found, update the existing document with a new file association
-	existing_file_hashes = frappe.get_all(
-		"File", filters={"name": ["!=", file.name], "content_hash": file.content_hash}, pluck="name"
-	)
+	duplicates = get_duplicate_files(file)
 
-	if existing_file_hashes:
-		file_doc: File = frappe.get_doc("File", existing_file_hashes[0])
+	# if a hash-conflict is found, update the existing document with a new file association
+	if duplicates.hash_match:
+		file_doc: File = frappe.get_doc("File", duplicates.hash_match)
 		file_doc.associate_files(file.attached_to_doctype, file.attached_to_name)
 		file_doc.save()
 		return file_doc
 
 	# if a filename-conflict is found, update the existing document with a new version instead
-	existing_file_names = frappe.get_all(
-		"File", filters={"name": ["!=", file.name], "file_name": file.file_name}, pluck="name"
-	)
-
-	if existing_file_names:
-		file_doc = frappe.get_doc("File", existing_file_names[0])
+	if duplicates.name_match:
+		file_doc = frappe.get_doc("File", duplicates.name_match)
 		file_doc.update(
-			{"content": file.content, "content_hash": file.content_hash, "content_type": file.content_type}
+			{
+				"content": file.content,
+				"content_hash": file.content_hash,
+				"content_type": file.content_type,
+				"upload_hash": file.get("upload_hash"),
+				"stripped_content_hash": file.get("stripped_content_hash"),
+				"original_content_hash": file.get("original_content_hash"),
+			}
 		)
 		file_doc.associate_files(file.attached_to_doctype, file.attached_to_name)
 		file = file_doc
 
+	if not file.flags.get("content_stream"):
+		file.flags.content_stream = get_request_file_stream(file)
+
 	if remove_spaces_in_file_name:
 		file.file_name = file.file_name.replace(" ", "_")
 
 	file.file_name = strip_special_chars(file.file_name)
 	file.flags.cloud_storage = True
+	if frappe.conf.cloud_storage_settings.get("write_behind", False):
+		client = get_cloud_storage_client()
+		return spool_file(file, get_file_path(file, client.folder))
 	return upload_file(file)
 
 
@@ -477,12 +1450,22 @@ def delete_file(file: File, **kwargs) -> File:
 	if file.is_folder:
 		return file
 
+	if file.get("spool_path"):
+		remove_spooled_file(file.spool_path)
+
 	if file.file_url and "?key=" in file.file_url:
 		key = file.file_url.split("?key=")[1]
-		if key:
+		derivative_keys = [derivative["key"] for derivative in get_derivatives(file).values()]
+		keys = [key, *derivative_keys] if key else []
+		if keys and frappe.conf.cloud_storage_settings.get("background_deletion", False):
+			for key in keys:
+				queue_deletion(key)
+		elif keys:
 			client = get_cloud_storage_client()
 			try:
-				client.delete_object(Bucket=client.bucket, Key=key)
+				with tag_operations(file.attached_to_doctype):
+					for key in keys:
+						client.delete_object(Bucket=client.bucket, Key=key)
 			except ClientError:
 				frappe.throw(_("Access denied: Could not delete file"))
 			except Exception as e:
@@ -491,37 +1474,76 @@ def delete_file(file: File, **kwargs) -> File:
 	return file
 
 
+@frappe.whitelist()
+def check_file_exists(file_name: str, content_hash: Optional[str] = None) -> dict:
+	"""
+	Answers whether a file with this name or content already exists, from the name and SHA-256
+	computed by the browser, so that duplicate content never has to be uploaded
+	"""
+	File = DocType("File")
+	condition = File.file_name == file_name
+	if content_hash:
+		condition = condition | (File.upload_hash == content_hash)
+	files = (
+		frappe.qb.from_(File)
+		.select(File.name, File.file_name, File.file_url, File.upload_hash)
+		.where(condition)
+		.where(File.is_folder == 0)
+	).run(as_dict=True)
+
+	name_matches = [file for file in files if file.file_name == file_name]
+	content_matches = [file for file in files if content_hash and file.upload_hash == content_hash]
+
+	# only offer to reuse existing content that the user can already read
+	matched_file_url = None
+	if content_matches and frappe.has_permission(
+		doctype="File", ptype="read", doc=frappe.get_doc("File", content_matches[0].name)
+	):
+		matched_file_url = content_matches[0].file_url
+
+	return {
+		"filename_exists": len(name_matches) > 0,
+		"content_exists": len(content_matches) > 0,
+		"matched_files": list({file.file_name for file in name_matches + content_matches}),
+		"matched_file_url": matched_file_url,
+	}
+
+
 @frappe.whitelist()
 def validate_file_content(*args, **kwargs):
 	matched_files = []
+	existing_files_by_name, existing_files_by_hash = [], []
 	files = frappe.request.files
 
 	if "file" in files:
 		file: FileStorage = files["file"]
 		content_type = guess_type(file.filename)[0]
-
-		# validate filename
 		file_name = file.filename
-		existing_files_by_name = frappe.get_all(
-			"File", filters={"file_name": file_name}, pluck="file_name"
-		)
 
-		# validate content hash
 		file.stream.seek(0)
 		content = file.stream.read()
 		content_hash = get_file_content_hash(content, content_type)
 
-		existing_files_by_hash = frappe.get_all(
-			"File", filters={"content_hash": content_hash}, pluck="file_name"
-		)
-
-		# if no files are found by name or hash, and if the file is an image, match against optimized content
-		if not existing_files_by_hash and content_type.startswith("image/"):
-			optimized_content = optimize_image(content, content_type)
-			optimized_content_hash = get_file_content_hash(optimized_content, content_type)
-			existing_files_by_hash = frappe.get_all(
-				"File", filters={"content_hash": optimized_content_hash}, pluck="file_name"
+		# validate filename and content hash in one lookup; images are also matched against the hashes
+		# stored at upload time, which covers Files that were optimized or had EXIF data removed
+		File = DocType("File")
+		hash_columns = [File.content_hash]
+		if content_type and content_type.startswith("image/"):
+			hash_columns += [File.stripped_content_hash, File.original_content_hash]
+		existing_files = (
+			frappe.qb.from_(File)
+			.select(File.file_name, *hash_columns)
+			.where(
+				Criterion.any([File.file_name == file_name] + [col == content_hash for col in hash_columns])
 			)
+		).run(as_dict=True)
+
+		existing_files_by_name = [f.file_name for f in existing_files if f.file_name == file_name]
+		existing_files_by_hash = [
+			f.file_name
+			for f in existing_files
+			if content_hash in (f.content_hash, f.get("stripped_content_hash"), f.get("original_content_hash"))
+		]
 
 		# build a list of matched files
 		matched_files = list(set(existing_files_by_name + existing_files_by_hash))
@@ -534,21 +1556,81 @@ def validate_file_content(*args, **kwargs):
 
 
 @frappe.whitelist(allow_guest=True)
-def retrieve(key: str) -> None:
+def retrieve(key: str, size: Optional[str] = None) -> Optional[Response]:
 	if key:
 		client = get_cloud_storage_client()
-		signed_url = client.get_presigned_url(key)
+		signed_url = client.get_presigned_url(key, size)
+		if not signed_url:
+			return serve_spooled_file(key)
 		frappe.local.response["type"] = "redirect"
 		frappe.local.response["location"] = signed_url
 
 	frappe.local.response["body"] = "Key not found"
 
 
+def serve_spooled_file(key: str) -> Optional[Response]:
+	file = frappe.get_value(
+		"File",
+		{"s3_key": key},
+		["name", "file_name", "spool_path", "is_private", "content_encoding"],
+		as_dict=True,
+	)
+	if not file:
+		raise DoesNotExistError(frappe._("The file you are looking for is not available"))
+	if not is_browser_encoding(file.content_encoding):
+		return serve_decompressed_file(file.name)
+	try:
+		with open(file.spool_path, mode="rb") as f:
+			content = f.read()
+	except (TypeError, FileNotFoundError):
+		# replicated since its status was read, so it is served from the bucket
+		frappe.local.response["type"] = "redirect"
+		frappe.local.response["location"] = sign_url(get_cloud_storage_client(), key, file.is_private)
+		return
+	frappe.local.response["filecontent"] = content
+	frappe.local.response["filename"] = file.file_name
+	frappe.local.response["type"] = "binary"
+	frappe.local.response["display_content_as"] = "inline"
+
+
+def serve_decompressed_file(name: str) -> Response:
+	"""Streams a File's content, decompressed, for encodings that clients can't be relied on to decode"""
+	file = frappe.get_doc("File", name)
+	response = Response(
+		file.iter_content(),
+		mimetype=guess_type(file.file_name)[0] or "application/octet-stream",
+		direct_passthrough=True,
+	)
+	response.headers.add("Content-Disposition", "inline", filename=file.file_name)
+	return response
+
+
 @frappe.whitelist(allow_guest=True)
-def share(key: str) -> None:
+def retrieve_many(
+	keys: Optional[Union[str, list]] = None,
+	names: Optional[Union[str, list]] = None,
+	size: Optional[str] = None,
+) -> dict:
+	keys = frappe.parse_json(keys) if isinstance(keys, str) else keys
+	names = frappe.parse_json(names) if isinstance(names, str) else names
+	if len(keys or []) + len(names or []) > MAX_BATCH_SIZE:
+		frappe.throw(_("Cannot retrieve more than {0} files at once").format(MAX_BATCH_SIZE))
+
+	client = get_cloud_storage_client()
+	return {
+		"urls": get_presigned_urls(client, keys, names, size),
+		# cached URLs may be up to `url_cache_ttl` seconds old
+		"expires_in": client.expiration - client.url_cache_ttl,
+	}
+
+
+@frappe.whitelist(allow_guest=True)
+def share(key: str) -> Optional[Response]:
 	if key:
 		client = get_cloud_storage_client()
 		signed_url = client.get_sharing_url(key)
+		if not signed_url:
+			return serve_decompressed_file(frappe.get_value("File", {"sharing_link": key}))
 		frappe.local.response["type"] = "redirect"
 		frappe.local.response["location"] = signed_url
 
@@ -564,3 +1646,172 @@ def remove_attach():
 		return
 	doc = frappe.get_doc("File", fid)
 	doc.remove_file_association(dt, dn)
+
+
+def remove_document_associations(doc, method: Optional[str] = None) -> None:
+	"""Removes a deleted document's File associations before Frappe removes its attachments"""
+	# runs for every deletion, so documents that never have attachments are skipped without a query
+	if doc.doctype in NON_ATTACHABLE_DOCTYPES or doc.meta.istable:
+		return
+	remove_associations([(doc.doctype, doc.name)])
+
+
+def remove_associations(references: list) -> None:
+	"""
+	Removes the File associations of many documents at once, such as when they are deleted, with a
+	fixed number of queries per batch of documents instead of a save of every File. Files left with
+	other associations are re-attached to the first of them; remote Files left with none are removed
+	and their objects queued for background deletion, while local ones are left attached to the
+	document for Frappe's `remove_all`.
+	"""
+	references = list(dict.fromkeys((dt, dn) for dt, dn in references if dt and dn))
+	for start in range(0, len(references), REFERENCE_BATCH_SIZE):
+		remove_association_batch(references[start : start + REFERENCE_BATCH_SIZE])
+
+
+def remove_association_batch(references: list) -> None:
+	File = DocType("File")
+	FileAssociation = DocType("File Association")
+	linked = Criterion.any(
+		[(FileAssociation.link_doctype == dt) & (FileAssociation.link_name == dn) for dt, dn in references]
+	)
+	attached = Criterion.any(
+		[(File.attached_to_doctype == dt) & (File.attached_to_name == dn) for dt, dn in references]
+	)
+
+	names = set(
+		frappe.qb.from_(FileAssociation)
+		.select(FileAssociation.parent)
+		.where(FileAssociation.parenttype == "File")
+		.where(linked)
+		.run(pluck=True)
+	)
+	names.update(
+		frappe.qb.from_(File).select(File.name).where(File.is_folder == 0).where(attached).run(pluck=True)
+	)
+	for dt, dn in references:
+		clear_attachments_cache(dt, dn)
+	if not names:
+		return
+
+	frappe.qb.from_(FileAssociation).delete().where(FileAssociation.parenttype == "File").where(
+		linked
+	).run()
+
+	remaining = defaultdict(list)
+	for row in (
+		frappe.qb.from_(FileAssociation)
+		.select(
+			FileAssociation.name,
+			FileAssociation.parent,
+			FileAssociation.link_doctype,
+			FileAssociation.link_name,
+			FileAssociation.idx,
+		)
+		.where(FileAssociation.parenttype == "File")
+		.where(FileAssociation.parent.isin(list(names)))
+		.orderby(FileAssociation.parent)
+		.orderby(FileAssociation.idx)
+	).run(as_dict=True):
+		remaining[row.parent].append(row)
+
+	files = (
+		frappe.qb.from_(File)
+		.select(
+			File.name,
+			File.attached_to_doctype,
+			File.attached_to_name,
+			File.s3_key,
+			File.sharing_link,
+			File.spool_path,
+			File.derivatives,
+		)
+		.where(File.name.isin(list(names)))
+	).run(as_dict=True)
+
+	renumber_associations(remaining)
+	reattach_files([file for file in files if remaining[file.name]], remaining, set(references))
+	delete_unassociated_files([file for file in files if not remaining[file.name]])
+
+
+def renumber_associations(remaining: dict) -> None:
+	positions = {
+		row.name: idx
+		for rows in remaining.values()
+		for idx, row in enumerate(rows, start=1)
+		if row.idx != idx
+	}
+	if not positions:
+		return
+	FileAssociation = DocType("File Association")
+	idx = Case()
+	for name, position in positions.items():
+		idx = idx.when(FileAssociation.name == name, position)
+	frappe.qb.update(FileAssociation).set(FileAssociation.idx, idx).where(
+		FileAssociation.name.isin(list(positions))
+	).run()
+
+
+def reattach_files(files: list, remaining: dict, references: set) -> None:
+	"""Points Files attached to a removed document at their first remaining association"""
+	targets = {
+		file.name: remaining[file.name][0]
+		for file in files
+		if (file.attached_to_doctype, file.attached_to_name) in references
+	}
+	if not targets:
+		return
+
+	File = DocType("File")
+	attached_to_doctype, attached_to_name = Case(), Case()
+	for name, association in targets.items():
+		attached_to_doctype = attached_to_doctype.when(File.name == name, association.link_doctype)
+		attached_to_name = attached_to_name.when(File.name == name, association.link_name)
+	frappe.qb.update(File).set(File.attached_to_doctype, attached_to_doctype).set(
+		File.attached_to_name, attached_to_name
+	).where(File.name.isin(list(targets))).run()
+
+	if frappe.conf.cloud_storage_settings and frappe.conf.cloud_storage_settings.get(
+		"relocate_on_reassociation", False
+	):
+		for name in targets:
+			file = frappe.get_doc("File", name)
+			file.flags.ignore_permissions = True
+			file.relocate()
+			file.save()
+
+
+def delete_unassociated_files(files: list) -> None:
+	"""
+	Deletes remote Files that are no longer associated with any document. Nothing outside the
+	database is removed until the deletion commits, since it is rolled back if the document turns
+	out to be linked; local Files are deleted (with their content) by Frappe's `remove_all`, which
+	runs after that check.
+	"""
+	remote_files = [file for file in files if file.s3_key]
+	if not remote_files:
+		return
+
+	keys = []
+	cache_keys = []
+	for file in remote_files:
+		keys.append(file.s3_key)
+		keys.extend(derivative["key"] for derivative in get_derivatives(file).values())
+		cache_keys.append(PRESIGNED_URL_CACHE_KEY.format(key=file.s3_key))
+		if file.sharing_link:
+			cache_keys.append(SHARING_URL_CACHE_KEY.format(key=file.sharing_link))
+		# spooled content that hasn't been replicated is the only copy
+		if file.spool_path:
+			frappe.db.after_commit.add(partial(remove_spooled_file, file.spool_path))
+
+	names = [file.name for file in remote_files]
+	frappe.db.delete("File Version", {"parenttype": "File", "parent": ("in", names)})
+	frappe.db.delete("File", {"name": ("in", names)})
+	# the objects are removed once the deletion of their documents is committed
+	queue_deletions(keys)
+	frappe.cache().delete_value(cache_keys)
+
+
+def delete_file_versions(doc, method: Optional[str] = None) -> None:
+	"""Removes a deleted File's version rows, which Frappe doesn't remove since they aren't a table on File"""
+	frappe.db.delete("File Version", {"parenttype": "File", "parent": doc.name})
@@ -0,0 +1,220 @@
+import datetime
+import json
+from pathlib import Path
+from typing import Iterator, Optional
+
+import frappe
+from frappe.utils import now_datetime
+
+from cloud_storage.cloud_storage.doctype.pending_deletion.pending_deletion import queue_deletion
+from cloud_storage.cloud_storage.overrides.file import get_cloud_storage_client
+
+# number of Files read from the database per query
+PAGE_SIZE = 5000
+# number of examples of each kind of drift kept in the report
+SAMPLE_SIZE = 1000
+# objects younger than this may belong to an upload whose File hasn't been saved yet
+MIN_OBJECT_AGE = datetime.timedelta(hours=1)
+
+
+def iter_bucket_objects(client, prefix: str) -> Iterator[dict]:
+	"""Yields the objects under `prefix` in the bucket, one listing page at a time, in key order"""
+	paginator = client.get_paginator("list_objects_v2")
+	for page in paginator.paginate(Bucket=client.bucket, Prefix=prefix):
+		yield from page.get("Contents", [])
+
+
+def iter_file_rows(prefix: str, page_size: int = PAGE_SIZE) -> Iterator[dict]:
+	"""
+	Yields the Files with an S3 key under `prefix`, a page at a time, in the same (byte) order as
+	`list_objects_v2`. Keys are compared as bytes rather than by the column's collation, which may
+	order case and accents differently. Files can share a key, so pages are keyed on the key and name.
+	"""
+	if frappe.db.db_type == "postgres":
+		ordered_key = 's3_key COLLATE "C"'
+		value = "%({})s"
+	else:
+		ordered_key = "CAST(s3_key AS BINARY)"
+		value = "CAST(%({})s AS BINARY)"
+
+	cursor_key = value.format("cursor")
+	conditions = [
+		f"({ordered_key} > {cursor_key} OR ({ordered_key} = {cursor_key} AND name > %(cursor_name)s))"
+	]
+	if prefix:
+		# keys under the prefix sort between these bounds; LIKE would treat `_` and `%` in the folder
+		# as wildcards and match case-insensitively under most collations
+		conditions.append(f"{ordered_key} >= {value.format('prefix')}")
+		conditions.append(f"{ordered_key} < {value.format('prefix_end')}")
+
+	cursor, cursor_name = "", ""
+	while True:
+		rows = frappe.db.sql(
+			f"""
+			SELECT name, s3_key, file_size, replication_status, spool_path, content_encoding
+			FROM `tabFile`
+			WHERE {" AND ".join(conditions)}
+			ORDER BY {ordered_key}, name
+			LIMIT %(page_size)s
+			""",
+			{
+				"prefix": prefix,
+				"prefix_end": get_prefix_end(prefix),
+				"cursor": cursor,
+				"cursor_name": cursor_name,
+				"page_size": page_size,
+			},
+			as_dict=True,
+		)
+		yield from rows
+		if len(rows) < page_size:
+			return
+		cursor, cursor_name = rows[-1].s3_key, rows[-1].name
+
+
+def get_prefix_end(prefix: str) -> str:
+	"""Returns the smallest key that sorts after every key starting with `prefix`"""
+	if not prefix:
+		return ""
+	# UTF-8 sorts in code point order, so this holds for the keys' bytes as well
+	return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def reconcile(
+	delete_orphans: bool = False, repair: bool = False, output: Optional[str] = None
+) -> dict:
+	"""
+	Compares the objects in the bucket with the Files in the database by walking both in key order, so
+	memory use doesn't grow with the number of objects. Reports objects without a File, Files without
+	an object and size mismatches. `delete_orphans` queues orphaned objects for background deletion;
+	`repair` re-queues replication of missing objects that are still in the local spool and corrects
+	the recorded size of mismatched Files.
+	"""
+	client = get_cloud_storage_client()
+	prefix = f"{client.folder}/" if client.folder else ""
+	cutoff = datetime.datetime.now(datetime.timezone.utc) - MIN_OBJECT_AGE
+	report = {
+		"started": now_datetime(),
+		"objects": 0,
+		"files": 0,
+		"orphaned_objects": {"count": 0, "bytes": 0, "sample": []},
+		"missing_objects": {"count": 0, "sample": []},
+		"size_mismatches": {"count": 0, "sample": []},
+		"queued_deletions": 0,
+		"repairs": 0,
+	}
+
+	objects = iter_bucket_objects(client, prefix)
+	rows = iter_file_rows(prefix)
+	obj, row = next(objects, None), next(rows, None)
+	last_key = None
+	while obj or row:
+		object_key = obj["Key"].encode() if obj else None
+		row_key = row.s3_key.encode() if row else None
+
+		if row is None or (obj is not None and object_key < row_key):
+			report["objects"] += 1
+			if not is_derivative_of_file(obj["Key"], last_key):
+				handle_orphaned_object(obj, cutoff, delete_orphans, report)
+			obj = next(objects, None)
+		elif obj is None or row_key < object_key:
+			report["files"] += 1
+			# Files that share a key with the File matched before them share its object
+			if row.s3_key != last_key:
+				handle_missing_object(row, repair, report)
+			row = next(rows, None)
+		else:
+			report["objects"] += 1
+			report["files"] += 1
+			# the recorded size of compressed content is its uncompressed size
+			if (
+				row.file_size is not None
+				and not row.content_encoding
+				and row.file_size != obj["Size"]
+			):
+				handle_size_mismatch(row, obj, repair, report)
+			last_key = row.s3_key
+			obj, row = next(objects, None), next(rows, None)
+
+	frappe.db.commit()
+	report["finished"] = now_datetime()
+	if output:
+		Path(output).write_text(json.dumps(report, indent=2, default=str))
+	return report
+
+
+def is_derivative_of_file(key: str, last_key: Optional[str]) -> bool:
+	# renditions are stored under their original's key, which usually sorts right before them
+	if ".derivatives/" not in key:
+		return False
+	original_key = key.rsplit(".derivatives/", 1)[0]
+	return original_key == last_key or bool(frappe.db.exists("File", {"s3_key": original_key}))
+
+
+def add_sample(entry: dict, sample) -> None:
+	entry["count"] += 1
+	if len(entry["sample"]) < SAMPLE_SIZE:
+		entry["sample"].append(sample)
+
+
+def handle_orphaned_object(obj: dict, cutoff, delete_orphans: bool, report: dict) -> None:
+	if obj["LastModified"] > cutoff:
+		return
+	add_sample(report["orphaned_objects"], {"key": obj["Key"], "size": obj["Size"]})
+	report["orphaned_objects"]["bytes"] += obj["Size"]
+	if delete_orphans and not frappe.db.exists("Pending Deletion", {"s3_key": obj["Key"]}):
+		queue_deletion(obj["Key"])
+		report["queued_deletions"] += 1
+
+
+def handle_missing_object(row, repair: bool, report: dict) -> None:
+	# write-behind uploads are in the spool until they have been replicated
+	if row.replication_status == "Pending":
+		return
+	add_sample(report["missing_objects"], {"file": row.name, "key": row.s3_key})
+	if repair and row.spool_path and Path(row.spool_path).is_file():
+		frappe.db.set_value(
+			"File",
+			row.name,
+			{"replication_status": "Pending", "replication_attempts": 0},
+			update_modified=False,
+		)
+		report["repairs"] += 1
+
+
+def handle_size_mismatch(row, obj: dict, repair: bool, report: dict) -> None:
+	add_sample(
+		report["size_mismatches"],
+		{"file": row.name, "key": row.s3_key, "file_size": row.file_size, "object_size": obj["Size"]},
+	)
+	if repair:
+		# the object is what is served, so the recorded size follows it
+		frappe.db.set_value("File", row.name, "file_size", obj["Size"], update_modified=False)
+		report["repairs"] += 1
+
+
+def run_scheduled_reconciliation() -> None:
+	if not frappe.conf.cloud_storage_settings or not frappe.conf.cloud_storage_settings.get(
+		"reconciliation", False
+	):
+		return
+	report = reconcile()
+	if report["orphaned_objects"]["count"] or report["missing_objects"]["count"]:
+		frappe.log_error(
+			title="Cloud Storage Reconciliation",
+			message=json.dumps(report, indent=2, default=str),
+		)
+
+
+@frappe.whitelist()
+def enqueue_reconciliation(delete_orphans: bool = False, repair: bool = False) -> None:
+	frappe.only_for("System Manager")
+	frappe.enqueue(
+		"cloud_storage.cloud_storage.reconciliation.reconcile",
+		queue="long",
+		timeout=24 * 60 * 60,
+		job_name="cloud_storage_reconciliation",
+		delete_orphans=frappe.parse_json(delete_orphans),
+		repair=frappe.parse_json(repair),
+		output=frappe.get_site_path("private", "cloud_storage_reconciliation.json"),
+	)
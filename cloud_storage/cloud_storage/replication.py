@@ -0,0 +1,207 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from mimetypes import guess_type
+from pathlib import Path
+from typing import Optional
+
+import frappe
+from frappe.query_builder import DocType
+from frappe.utils import get_datetime, now_datetime
+
+from cloud_storage.cloud_storage.compression import compress_stream, get_content_encoding
+from cloud_storage.cloud_storage.derivatives import queue_derivatives
+
+# number of pending Files picked up by a single replication job
+BATCH_SIZE = 100
+# Files whose content is only in the spool; Failed Files stay there until they are retried
+SPOOLED_STATUSES = ("Pending", "Failed")
+
+
+def get_spool_directory() -> Path:
+	spool_directory = Path(frappe.get_site_path("private", "cloud_storage_spool")).resolve()
+	spool_directory.mkdir(parents=True, exist_ok=True)
+	return spool_directory
+
+
+def spool_file(file, path: str):
+	"""
+	Writes the File's content to the local spool and marks it as pending replication; the File is
+	saved right away and the content is uploaded to `path` in the bucket by a background job
+	"""
+	from cloud_storage.cloud_storage.overrides.file import FILE_URL
+
+	spool_path = get_spool_directory() / uuid.uuid4().hex
+	temp_path = spool_path.with_suffix(".tmp")
+	content = file.content.encode() if isinstance(file.content, str) else file.content
+	temp_path.write_bytes(content)
+	# the rename is atomic, so the replication job never sees a partially written file
+	os.replace(temp_path, spool_path)
+
+	file.file_url = FILE_URL.format(path=path)
+	file.s3_key = path
+	file.replication_status = "Pending"
+	file.replication_attempts = 0
+	file.spool_path = str(spool_path)
+	if file.name:
+		file.db_set(
+			{
+				"file_url": file.file_url,
+				"s3_key": file.s3_key,
+				"replication_status": file.replication_status,
+				"replication_attempts": file.replication_attempts,
+				"spool_path": file.spool_path,
+			}
+		)
+	else:
+		file.save()
+
+	if not frappe.flags.cloud_storage_replication_queued:
+		frappe.flags.cloud_storage_replication_queued = True
+		frappe.enqueue(
+			"cloud_storage.cloud_storage.replication.replicate_pending_files",
+			queue="long",
+			enqueue_after_commit=True,
+		)
+	return file
+
+
+def replicate_pending_files() -> None:
+	"""
+	Uploads spooled Files to the bucket in parallel and marks them as replicated. Files that fail are
+	retried by later runs until `replication_max_attempts` is reached, and are then marked as Failed.
+	"""
+	from cloud_storage.cloud_storage.overrides.file import get_cloud_storage_client
+
+	if not frappe.conf.cloud_storage_settings or not frappe.db.count(
+		"File", {"replication_status": "Pending"}
+	):
+		return
+
+	client = get_cloud_storage_client()
+	workers = frappe.conf.cloud_storage_settings.get("replication_workers", 4)
+	max_attempts = frappe.conf.cloud_storage_settings.get("replication_max_attempts", 5)
+	run_started = now_datetime()
+
+	File = DocType("File")
+
+	while True:
+		# the claimed rows stay locked until the batch is committed, so overlapping jobs skip them
+		files = (
+			frappe.qb.from_(File)
+			.select(
+				File.name, File.file_name, File.s3_key, File.spool_path, File.replication_attempts
+			)
+			.where(File.replication_status == "Pending")
+			.where(File.modified < run_started)
+			.orderby(File.creation)
+			.limit(BATCH_SIZE)
+			.for_update(skip_locked=True)
+		).run(as_dict=True)
+		if not files:
+			break
+
+		# uploads run in threads, but database updates stay on this thread's connection; the site's
+		# settings aren't available to the threads either, so each File's encoding is resolved here
+		encodings = [get_content_encoding(guess_type(file.file_name or "")[0]) for file in files]
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			results = list(
+				executor.map(
+					lambda file, encoding: upload_spooled_file(client, file, encoding), files, encodings
+				)
+			)
+
+		for file, (version_id, content_encoding, error) in zip(files, results):
+			if error:
+				frappe.log_error(title="Cloud Storage Replication Error", message=error)
+				attempts = (file.replication_attempts or 0) + 1
+				frappe.db.set_value(
+					"File",
+					file.name,
+					{
+						"replication_status": "Failed" if attempts >= max_attempts else "Pending",
+						"replication_attempts": attempts,
+						"modified": now_datetime(),
+					},
+					update_modified=False,
+				)
+				continue
+			mark_replicated(file, version_id, content_encoding)
+		frappe.db.commit()
+
+
+def upload_spooled_file(client, file, encoding: Optional[str] = None) -> tuple:
+	"""Uploads a spooled File, compressed with `encoding` if given; runs on a replication thread"""
+	content_type = guess_type(file.file_name or "")[0]
+	extra_args = {"ContentType": content_type} if content_type else {}
+	try:
+		with open(file.spool_path, mode="rb") as f:
+			compressed = compress_stream(f, encoding) if encoding else None
+			if compressed is not None:
+				extra_args["ContentEncoding"] = encoding
+			with f if compressed is None else compressed as body:
+				client.upload_fileobj(
+					body,
+					client.bucket,
+					file.s3_key,
+					ExtraArgs=extra_args or None,
+					Config=client.transfer_config,
+				)
+		response = client.head_object(Bucket=client.bucket, Key=file.s3_key)
+		return response.get("VersionId"), extra_args.get("ContentEncoding"), None
+	except Exception:
+		return None, None, frappe.get_traceback()
+
+
+def mark_replicated(
+	file, version_id: Optional[str] = None, content_encoding: Optional[str] = None
+) -> None:
+	# a re-upload may have spooled newer content while this content was being replicated; that
+	# content stays pending and is uploaded by the next run
+	if frappe.db.get_value("File", file.name, "spool_path", for_update=True) != file.spool_path:
+		remove_spooled_file(file.spool_path)
+		return
+
+	file_doc = frappe.get_doc("File", file.name)
+	if version_id:
+		file_doc.add_file_version(version_id)
+	file_doc.content_encoding = content_encoding
+	file_doc.replication_status = "Replicated"
+	file_doc.replication_attempts = 0
+	file_doc.spool_path = None
+	file_doc.flags.cloud_storage = True
+	file_doc.flags.ignore_permissions = True
+	file_doc.save()
+	remove_spooled_file(file.spool_path)
+	queue_derivatives(file_doc)
+
+
+def remove_spooled_file(spool_path: Optional[str]) -> None:
+	if not spool_path:
+		return
+	spool_path = Path(spool_path).resolve()
+	# never remove anything outside of the spool
+	if spool_path.parent == get_spool_directory() and spool_path.is_file():
+		spool_path.unlink()
+
+
+@frappe.whitelist()
+def get_replication_metrics() -> dict:
+	frappe.only_for("System Manager")
+
+	pending = frappe.get_all(
+		"File",
+		filters={"replication_status": "Pending"},
+		fields=["count(name) as depth", "min(creation) as oldest"],
+	)[0]
+	failed = frappe.db.count("File", {"replication_status": "Failed"})
+	spool_bytes = sum(path.stat().st_size for path in get_spool_directory().iterdir() if path.is_file())
+	lag = (now_datetime() - get_datetime(pending.oldest)).total_seconds() if pending.oldest else 0
+	return {
+		"spool_depth": pending.depth,
+		"failed": failed,
+		"spool_bytes": spool_bytes,
+		"replication_lag_seconds": round(lag, 3),
+		"timestamp": time.time(),
+	}
@@ -0,0 +1,251 @@
+import datetime
+import json
+from typing import Optional, Union
+
+import frappe
+from botocore.exceptions import ClientError
+from frappe.query_builder import DocType
+from frappe.query_builder.functions import Count
+from frappe.utils import get_datetime, now_datetime
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# number of Files whose versions are pruned between commits
+PRUNE_BATCH_SIZE = 100
+# the maximum number of versions accepted by a single `delete_objects` request
+DELETE_BATCH_SIZE = 1000
+
+
+def insert_file_version(file_name: str, version: dict) -> None:
+	"""
+	Records a version of a File's object. Versions are stored as File Version rows but aren't a table
+	on the File, so a File with a long history loads as fast as one without.
+	"""
+	frappe.get_doc(
+		{
+			"doctype": "File Version",
+			"parent": file_name,
+			"parenttype": "File",
+			"parentfield": "versions",
+			**version,
+		}
+	).db_insert()
+
+
+def get_version_count(file_name: str) -> int:
+	FileVersion = DocType("File Version")
+	return (
+		frappe.qb.from_(FileVersion)
+		.select(Count("*"))
+		.where(FileVersion.parenttype == "File")
+		.where(FileVersion.parent == file_name)
+	).run()[0][0]
+
+
+def get_version_key(file_name: str, version_id: str) -> Optional[str]:
+	"""
+	Returns the key a version of the File was stored under, or None if it isn't one of the File's
+	versions. Versions recorded before their key was stored return an empty string.
+	"""
+	version = frappe.db.get_value(
+		"File Version",
+		{"parenttype": "File", "parent": file_name, "version": version_id},
+		["name", "s3_key"],
+		as_dict=True,
+	)
+	if not version:
+		return None
+	return version.s3_key or ""
+
+
+def version_exists(file_name: str, version_id: str) -> bool:
+	return bool(
+		frappe.db.exists(
+			"File Version", {"parenttype": "File", "parent": file_name, "version": version_id}
+		)
+	)
+
+
+def get_version_page(file_name: str, after: Optional[list] = None, limit: int = PAGE_SIZE) -> dict:
+	"""
+	Returns a page of a File's versions, newest first. Each version carries the `cursor` to pass as
+	`after` for the page following it.
+	"""
+	FileVersion = DocType("File Version")
+	query = (
+		frappe.qb.from_(FileVersion)
+		.select(FileVersion.name, FileVersion.version, FileVersion.user, FileVersion.timestamp)
+		.where(FileVersion.parenttype == "File")
+		.where(FileVersion.parent == file_name)
+		.orderby(FileVersion.timestamp, order=frappe.qb.desc)
+		.orderby(FileVersion.name, order=frappe.qb.desc)
+		.limit(limit + 1)
+	)
+	if after:
+		timestamp, name = after
+		query = query.where(
+			(FileVersion.timestamp < timestamp)
+			| ((FileVersion.timestamp == timestamp) & (FileVersion.name < name))
+		)
+
+	rows = query.run(as_dict=True)
+	versions = rows[:limit]
+	for version in versions:
+		version.cursor = [str(version.timestamp), version.pop("name")]
+	return {"versions": versions, "has_more": len(rows) > limit}
+
+
+@frappe.whitelist()
+def get_file_versions(
+	docname: str, after: Optional[Union[str, list]] = None, limit: int = PAGE_SIZE
+) -> dict:
+	frappe.get_doc("File", docname).check_permission("read")
+	if isinstance(after, str):
+		after = json.loads(after)
+	limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+	return {"count": get_version_count(docname), **get_version_page(docname, after, limit)}
+
+
+def get_retention() -> tuple:
+	"""Returns the number of versions and the number of days of versions to keep; either may be 0"""
+	settings = frappe.conf.cloud_storage_settings or {}
+	return (
+		int(settings.get("version_retention_count", 0) or 0),
+		int(settings.get("version_retention_days", 0) or 0),
+	)
+
+
+def get_expired_versions(
+	versions: list, keep_count: int, keep_days: int, now: Optional[datetime.datetime] = None
+) -> list:
+	"""
+	Returns the versions, ordered newest first, that fall outside the retention policy. A version is
+	kept if it is one of the newest `keep_count` or younger than `keep_days`; the newest version is the
+	File's current content and is always kept.
+	"""
+	cutoff = (now or now_datetime()) - datetime.timedelta(days=keep_days) if keep_days else None
+	return [
+		version
+		for position, version in enumerate(versions)
+		if position > 0
+		and not (keep_count and position < keep_count)
+		and not (cutoff and get_datetime(version.timestamp) >= cutoff)
+	]
+
+
+def get_files_with_old_versions(
+	cursor: str, keep_count: int, keep_days: int, limit: int = PRUNE_BATCH_SIZE
+) -> list:
+	FileVersion = DocType("File Version")
+	query = (
+		frappe.qb.from_(FileVersion)
+		.select(FileVersion.parent)
+		.where(FileVersion.parenttype == "File")
+		.where(FileVersion.parent > cursor)
+		.groupby(FileVersion.parent)
+		.orderby(FileVersion.parent)
+		.limit(limit)
+	)
+	if keep_days:
+		cutoff = now_datetime() - datetime.timedelta(days=keep_days)
+		query = query.where(FileVersion.timestamp < cutoff)
+	else:
+		query = query.having(Count("*") > keep_count)
+	return query.run(pluck=True)
+
+
+def prune_file_versions() -> None:
+	"""
+	Deletes the object versions that fall outside the retention policy from the bucket and removes
+	their File Version rows, a batch of Files at a time
+	"""
+	from cloud_storage.cloud_storage.overrides.file import get_cloud_storage_client
+
+	keep_count, keep_days = get_retention()
+	settings = frappe.conf.cloud_storage_settings
+	if not settings or settings.get("use_local", False) or not (keep_count or keep_days):
+		return
+
+	client = get_cloud_storage_client()
+	cursor = ""
+	while True:
+		names = get_files_with_old_versions(cursor, keep_count, keep_days)
+		if not names:
+			break
+		prune_versions(client, names, keep_count, keep_days)
+		frappe.db.commit()
+		cursor = names[-1]
+
+
+def prune_versions(client, names: list, keep_count: int, keep_days: int) -> None:
+	keys = dict(
+		frappe.get_all(
+			"File",
+			filters={"name": ["in", names], "s3_key": ["is", "set"]},
+			fields=["name", "s3_key"],
+			as_list=True,
+		)
+	)
+	if not keys:
+		return
+
+	FileVersion = DocType("File Version")
+	versions = {}
+	for row in (
+		frappe.qb.from_(FileVersion)
+		.select(
+			FileVersion.name,
+			FileVersion.parent,
+			FileVersion.version,
+			FileVersion.timestamp,
+			FileVersion.s3_key,
+		)
+		.where(FileVersion.parenttype == "File")
+		.where(FileVersion.parent.isin(list(keys)))
+		.orderby(FileVersion.parent)
+		.orderby(FileVersion.timestamp, order=frappe.qb.desc)
+		.orderby(FileVersion.name, order=frappe.qb.desc)
+	).run(as_dict=True):
+		# versions recorded before a relocation are stored under the File's earlier key
+		row.s3_key = row.s3_key or keys[row.parent]
+		versions.setdefault(row.parent, []).append(row)
+
+	expired = [
+		version
+		for rows in versions.values()
+		for version in get_expired_versions(rows, keep_count, keep_days)
+	]
+	for start in range(0, len(expired), DELETE_BATCH_SIZE):
+		batch = expired[start : start + DELETE_BATCH_SIZE]
+		errors = delete_object_versions(client, [(version.s3_key, version.version) for version in batch])
+		deleted = [version.name for version in batch if (version.s3_key, version.version) not in errors]
+		if deleted:
+			frappe.db.delete("File Version", {"name": ("in", deleted)})
+		if errors:
+			frappe.log_error(
+				title="Cloud Storage Version Pruning Error",
+				message="\n".join(f"{key} ({version}): {error}" for (key, version), error in errors.items()),
+			)
+
+
+def delete_object_versions(client, versions: list) -> dict:
+	"""
+	Deletes (key, version ID) pairs from the bucket and returns a map of those that could not be deleted
+	to their error messages. Versions that no longer exist count as deleted.
+	"""
+	try:
+		response = client.delete_objects(
+			Bucket=client.bucket,
+			Delete={
+				"Objects": [{"Key": key, "VersionId": version} for key, version in versions],
+				"Quiet": True,
+			},
+		)
+	except ClientError as e:
+		return {(key, version): str(e) for key, version in versions}
+
+	return {
+		(error.get("Key"), error.get("VersionId")): f"{error.get('Code')}: {error.get('Message')}"
+		for error in response.get("Errors", [])
+		if error.get("Code") not in ("NoSuchKey", "NoSuchVersion")
+	}
@@ -0,0 +1,52 @@
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("migrate-files-to-cloud-storage")
+@click.option(
+	"--dry-run", is_flag=True, default=False, help="Only estimate the files, bytes and time"
+)
+@click.option("--workers", type=int, help="Number of files uploaded in parallel")
+@click.option("--batch-size", type=int, default=100, help="Number of files between checkpoints")
+@click.option("--restart", is_flag=True, default=False, help="Ignore the checkpoint and start over")
+@pass_context
+def migrate_files_to_cloud_storage(context, dry_run, workers, batch_size, restart):
+	"Upload the site's existing local files to the cloud storage bucket"
+	from cloud_storage.cloud_storage.migration import migrate_local_files
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		migrate_local_files(dry_run=dry_run, workers=workers, batch_size=batch_size, restart=restart)
+	finally:
+		frappe.destroy()
+
+
+@click.command("reconcile-cloud-storage")
+@click.option(
+	"--delete-orphans", is_flag=True, default=False, help="Queue objects without a File for deletion"
+)
+@click.option(
+	"--repair", is_flag=True, default=False, help="Re-queue spooled uploads and correct file sizes"
+)
+@click.option("--output", help="Write the report to this JSON file")
+@pass_context
+def reconcile_cloud_storage(context, delete_orphans, repair, output):
+	"Compare the objects in the cloud storage bucket with the site's Files"
+	import json
+
+	from cloud_storage.cloud_storage.reconciliation import reconcile
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		report = reconcile(delete_orphans=delete_orphans, repair=repair, output=output)
+		print(json.dumps(report, indent=2, default=str))
+	finally:
+		frappe.destroy()
+
+
+commands = [migrate_files_to_cloud_storage, reconcile_cloud_storage]
@@ -5,6 +5,12 @@ import frappe
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 from frappe.custom.doctype.property_setter.property_setter import make_property_setter
 
+# lookups by these columns are made on every upload, retrieve, share and form load
+INDEXES = {
+	"File": [["s3_key"], ["sharing_link"], ["content_hash"], ["file_name"]],
+	"File Association": [["link_doctype", "link_name", "creation", "name"]],
+}
+
 
 def load_customizations():
 	print("Loading Cloud Storage customizations")
@@ -45,3 +51,12 @@ def load_customizations():
 			)
 			property_setter.flags.ignore_permissions = True
 			property_setter.insert()
+
+
+def create_indexes():
+	print("Creating Cloud Storage indexes")
+	for doctype, indexes in INDEXES.items():
+		for fields in indexes:
+			# single-column indexes share the name Frappe gives to `search_index` fields
+			index_name = fields[0] if len(fields) == 1 else f"{'_'.join(fields)}_index"
+			frappe.db.add_index(doctype, fields, index_name)
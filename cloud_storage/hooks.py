@@ -34,6 +34,11 @@ doctype_js = {"File": "public/js/file.js"}
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
 
+# Boot
+# ----------
+
+extend_bootinfo = "cloud_storage.boot.extend_bootinfo"
+
 # Home Pages
 # ----------
 
@@ -100,34 +105,35 @@ override_doctype_class = {"File": "cloud_storage.cloud_storage.overrides.file.Cu
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-# 	}
-# }
+doc_events = {
+	"File": {
+		"on_update": [
+			"cloud_storage.cloud_storage.overrides.file.invalidate_url_cache",
+			"cloud_storage.cloud_storage.overrides.file.invalidate_attachments_cache",
+		],
+		"on_trash": [
+			"cloud_storage.cloud_storage.overrides.file.invalidate_url_cache",
+			"cloud_storage.cloud_storage.overrides.file.invalidate_attachments_cache",
+			"cloud_storage.cloud_storage.overrides.file.delete_file_versions",
+		],
+	},
+	"*": {
+		"on_trash": "cloud_storage.cloud_storage.overrides.file.remove_document_associations",
+	},
+}
 
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-# 	"all": [
-# 		"cloud_storage.tasks.all"
-# 	],
-# 	"daily": [
-# 		"cloud_storage.tasks.daily"
-# 	],
-# 	"hourly": [
-# 		"cloud_storage.tasks.hourly"
-# 	],
-# 	"weekly": [
-# 		"cloud_storage.tasks.weekly"
-# 	],
-# 	"monthly": [
-# 		"cloud_storage.tasks.monthly"
-# 	],
-# }
+scheduler_events = {
+	"all": ["cloud_storage.cloud_storage.replication.replicate_pending_files"],
+	"hourly": [
+		"cloud_storage.cloud_storage.doctype.pending_deletion.pending_deletion.process_pending_deletions",
+		"cloud_storage.cloud_storage.derivatives.generate_pending_derivatives",
+	],
+	"daily_long": ["cloud_storage.cloud_storage.versions.prune_file_versions"],
+	"weekly_long": ["cloud_storage.cloud_storage.reconciliation.run_scheduled_reconciliation"],
+}
 
 # Testing
 # -------
@@ -194,4 +200,7 @@ delete_file_data_content = "cloud_storage.cloud_storage.overrides.file.delete_fi
 
 # After Migrate
 # --------------------------------
-after_migrate = "cloud_storage.customize.load_customizations"
+after_migrate = [
+	"cloud_storage.customize.load_customizations",
+	"cloud_storage.customize.create_indexes",
+]
@@ -6,6 +6,9 @@ frappe.ui.form.on('File', {
 			if (frm.doc.sharing_link) {
 				frm.add_custom_button(__('Reset Sharing Link', 'Share'), () => get_sharing_link(frm, true))
 			}
+			if (frm.doc.__onload && frm.doc.__onload.version_count > 1) {
+				frm.add_custom_button(__('Restore Version'), () => restore_version(frm))
+			}
 		}
 	},
 })
@@ -17,3 +20,28 @@ function get_sharing_link(frm, reset) {
 			frappe.msgprint(r, __('Sharing Link'))
 		})
 }
+
+async function restore_version(frm) {
+	// the newest version is the File's current content
+	const { versions: history } = await frappe.xcall('cloud_storage.cloud_storage.versions.get_file_versions', {
+		docname: frm.doc.name,
+		limit: 100,
+	})
+	const versions = history.slice(1).map(row => ({
+		label: `${frappe.datetime.str_to_user(row.timestamp)} (${row.user})`,
+		value: row.version,
+	}))
+	frappe.prompt(
+		{ fieldname: 'version_id', fieldtype: 'Select', label: __('Version'), options: versions, reqd: 1 },
+		({ version_id }) => {
+			frappe
+				.xcall('cloud_storage.cloud_storage.overrides.file.restore_file_version', {
+					docname: frm.doc.name,
+					version_id,
+				})
+				.then(() => frm.reload_doc())
+		},
+		__('Restore Version'),
+		__('Restore')
+	)
+}
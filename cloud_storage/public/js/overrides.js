@@ -1,4 +1,5 @@
 frappe.provide('frappe.ui')
+frappe.provide('cloud_storage')
 
 import FileUploaderComponent from './components/FileUploader.vue'
 
@@ -12,11 +13,15 @@ function page_changed(event) {
 			frappe.ui.form.on(route[1], {
 				refresh: frm => {
 					disallow_attachment_delete(frm)
+					resolve_attachment_urls(frm)
+					render_more_attachments(frm)
 				},
 			})
 
 			if (event.type == 'load') {
 				disallow_attachment_delete(cur_frm)
+				resolve_attachment_urls(cur_frm)
+				render_more_attachments(cur_frm)
 			}
 		}
 	})
@@ -28,6 +33,80 @@ function disallow_attachment_delete(frm) {
 	}
 }
 
+// resolve signed URLs for many files in one request; keys are S3 keys or File names
+// `size` ('thumbnail' or 'web') resolves images to that rendition where one has been generated
+cloud_storage.retrieve_many = ({ keys = [], names = [], size = null } = {}) => {
+	return frappe.xcall('cloud_storage.cloud_storage.overrides.file.retrieve_many', { keys, names, size }).then(r => {
+		const expires_at = Date.now() + r.expires_in * 1000
+		return { urls: r.urls, expires_at }
+	})
+}
+
+function resolve_attachment_urls(frm) {
+	if (!frm || !frm.$wrapper) {
+		return
+	}
+	const prefix = '/api/method/retrieve?key='
+	const links = frm.$wrapper.find(`.attachment-row a[href^="${prefix}"]`).toArray()
+	if (!links.length) {
+		return
+	}
+	const keys = links.map(link => decodeURIComponent(link.getAttribute('href').slice(prefix.length)))
+	cloud_storage.retrieve_many({ keys }).then(({ urls, expires_at }) => {
+		links.forEach((link, i) => {
+			const retrieve_url = link.getAttribute('href')
+			if (!urls[keys[i]]) {
+				return
+			}
+			link.setAttribute('href', urls[keys[i]])
+			// signed URLs expire; fall back to the redirect endpoint once they have
+			$(link).one('click', () => {
+				if (Date.now() > expires_at) {
+					link.setAttribute('href', retrieve_url)
+				}
+			})
+		})
+	})
+}
+
+// the form loads the first page of attachments; the rest are fetched a page at a time from the sidebar
+function render_more_attachments(frm) {
+	if (!frm || !frm.attachments || !frm.attachments.parent || frm.is_new()) {
+		return
+	}
+	const page_size = (frappe.boot.cloud_storage || {}).attachments_page_size
+	const docinfo = frm.get_docinfo()
+	const attachments = docinfo.attachments || []
+	const has_more =
+		docinfo.cloud_storage_has_more !== undefined ? docinfo.cloud_storage_has_more : attachments.length >= page_size
+
+	frm.attachments.parent.find('.cloud-storage-more-attachments').remove()
+	if (!page_size || !has_more || !attachments.length) {
+		return
+	}
+	const $more = $(`<li class="cloud-storage-more-attachments">
+		<a class="text-muted small">${__('Load more attachments')}</a>
+	</li>`).appendTo(frm.attachments.parent)
+
+	$more.find('a').one('click', () => {
+		frappe
+			.xcall('cloud_storage.cloud_storage.attachments.get_attachments_page', {
+				doctype: frm.doctype,
+				name: frm.docname,
+				after: attachments[attachments.length - 1].cursor,
+				limit: page_size,
+			})
+			.then(r => {
+				docinfo.cloud_storage_has_more = r.has_more
+				attachments.push(...r.files)
+				frm.attachments.refresh()
+				disallow_attachment_delete(frm)
+				resolve_attachment_urls(frm)
+				render_more_attachments(frm)
+			})
+	})
+}
+
 // TODO: full class override from Frappe's FileUploader.vue file; keep in sync
 frappe.ui.FileUploader = class CloudStorageFileUploader {
 	constructor({
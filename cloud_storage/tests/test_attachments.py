@@ -0,0 +1,51 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from cloud_storage.cloud_storage.attachments import (
+	clear_attachments_cache,
+	get_attachment_page,
+	get_attachments,
+)
+
+
+class TestAttachments(FrappeTestCase):
+	@patch("frappe.qb")
+	def test_get_attachment_page(self, qb):
+		rows = [
+			frappe._dict(
+				name=f"file-{idx}",
+				file_name=f"file-{idx}.png",
+				file_url=f"/api/method/retrieve?key=file-{idx}.png",
+				is_private=1,
+				association_creation=f"2024-01-01 00:00:0{9 - idx}",
+				association=f"association-{idx}",
+			)
+			for idx in range(3)
+		]
+		query = qb.from_.return_value.inner_join.return_value.on.return_value.select.return_value
+		query = query.where.return_value.where.return_value.where.return_value
+		query = query.orderby.return_value.orderby.return_value.limit.return_value
+		query.run.return_value = rows
+
+		page = get_attachment_page("User", "Administrator", limit=2)
+		assert [file.name for file in page["files"]] == ["file-0", "file-1"]
+		assert page["files"][-1].cursor == ["2024-01-01 00:00:08", "association-1"]
+		assert page["has_more"] is True
+
+	@patch("cloud_storage.cloud_storage.attachments.get_attachment_page")
+	@patch("cloud_storage.cloud_storage.attachments.get_attachment_count")
+	def test_get_attachments_cache(self, get_attachment_count, get_attachment_page):
+		get_attachment_count.return_value = 1
+		get_attachment_page.return_value = {"files": [frappe._dict(name="file-0")], "has_more": False}
+		clear_attachments_cache("User", "Administrator")
+
+		assert get_attachments("User", "Administrator")["count"] == 1
+		assert get_attachments("User", "Administrator")["count"] == 1
+		assert get_attachment_page.call_count == 1
+
+		clear_attachments_cache("User", "Administrator")
+		get_attachments("User", "Administrator")
+		assert get_attachment_page.call_count == 2
+		clear_attachments_cache("User", "Administrator")
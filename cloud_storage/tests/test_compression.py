@@ -0,0 +1,48 @@
+import io
+import os
+from unittest.mock import patch
+
+import frappe
+
+from cloud_storage.cloud_storage.compression import (
+	compress,
+	compress_stream,
+	decompress,
+	get_content_encoding,
+	open_decompressed,
+)
+
+CSV = b"".join(f"{idx},customer-{idx % 50},{idx * 3.5}\n".encode() for idx in range(20000))
+
+
+def test_get_content_encoding():
+	with patch.dict(frappe.conf, {"cloud_storage_settings": {"compression": "gzip"}}):
+		assert get_content_encoding("text/csv") == "gzip"
+		assert get_content_encoding("application/xml; charset=utf-8") == "gzip"
+		assert get_content_encoding("application/pdf") is None
+		assert get_content_encoding(None) is None
+
+	with patch.dict(frappe.conf, {"cloud_storage_settings": {}}):
+		assert get_content_encoding("text/csv") is None
+
+
+def test_compress():
+	compressed = compress(CSV, "gzip")
+	assert compressed is not None and len(compressed) < len(CSV) / 2
+	assert decompress(compressed, "gzip") == CSV
+	assert decompress(CSV, None) == CSV
+	# random content doesn't compress, and tiny content isn't worth it
+	assert compress(os.urandom(64 * 1024), "gzip") is None
+	assert compress(b"a,b\n", "gzip") is None
+
+
+def test_compress_stream():
+	stream = io.BytesIO(CSV)
+	compressed = compress_stream(stream, "gzip")
+	assert stream.tell() == 0
+	with open_decompressed(compressed, "gzip") as f:
+		assert f.read() == CSV
+
+	stream = io.BytesIO(os.urandom(512 * 1024))
+	assert compress_stream(stream, "gzip") is None
+	assert stream.tell() == 0
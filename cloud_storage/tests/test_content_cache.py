@@ -0,0 +1,63 @@
+import os
+import tempfile
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from frappe.tests.utils import FrappeTestCase
+
+from cloud_storage.cloud_storage.content_cache import evict, get_cached_object
+
+
+def get_client(content: bytes, etag: str = '"etag-1"') -> MagicMock:
+	client = MagicMock()
+	client.bucket = "test-bucket"
+	client.head_object.return_value = {"ContentLength": len(content), "ETag": etag}
+	client.get_object.return_value = {"Body": MagicMock()}
+	client.get_object.return_value["Body"].iter_chunks.return_value = [content]
+	return client
+
+
+class TestContentCache(FrappeTestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		patches = [
+			patch(
+				"cloud_storage.cloud_storage.content_cache.get_cache_directory",
+				return_value=Path(self.directory.name),
+			),
+			patch("cloud_storage.cloud_storage.content_cache.get_cache_size", return_value=100),
+			patch("cloud_storage.cloud_storage.content_cache.record_metric"),
+		]
+		for p in patches:
+			p.start()
+			self.addCleanup(p.stop)
+		self.addCleanup(self.directory.cleanup)
+
+	def test_get_cached_object(self):
+		# a miss downloads the object, a hit reads the local copy
+		client = get_client(b"content")
+		path = get_cached_object(client, "folder/file.txt")
+		assert path.read_bytes() == b"content"
+		assert get_cached_object(client, "folder/file.txt") == path
+		assert client.get_object.call_count == 1
+
+		# a new ETag is a new entry
+		client = get_client(b"content 2", etag='"etag-2"')
+		assert get_cached_object(client, "folder/file.txt") != path
+		assert client.get_object.call_count == 1
+
+		# objects larger than a tenth of the budget are not cached
+		client = get_client(b"x" * 11)
+		assert get_cached_object(client, "folder/large.txt") is None
+		client.get_object.assert_not_called()
+
+	def test_evict(self):
+		directory = Path(self.directory.name)
+		for idx in range(5):
+			path = directory / f"entry-{idx}"
+			path.write_bytes(b"x" * 30)
+			# older entries were used less recently
+			os.utime(path, (1000 + idx, 1000 + idx))
+
+		evict(100)
+		assert sorted(path.name for path in directory.iterdir()) == ["entry-2", "entry-3", "entry-4"]
@@ -0,0 +1,78 @@
+import io
+import json
+from unittest.mock import MagicMock
+
+from frappe.tests.utils import FrappeTestCase
+from PIL import Image
+
+from cloud_storage.cloud_storage.derivatives import (
+	render_derivatives,
+	store_derivatives,
+	store_file_derivatives,
+)
+
+
+def get_image(width: int, height: int, image_format: str = "PNG") -> bytes:
+	output = io.BytesIO()
+	Image.new("RGB", (width, height), color="red").save(output, format=image_format)
+	return output.getvalue()
+
+
+class TestDerivatives(FrappeTestCase):
+	def test_render_derivatives(self):
+		renditions, error = render_derivatives(
+			get_image(2000, 1000), {"thumbnail": 128, "web": 1280}, "webp"
+		)
+		assert error is None
+		assert (renditions["thumbnail"]["width"], renditions["thumbnail"]["height"]) == (128, 64)
+		assert (renditions["web"]["width"], renditions["web"]["height"]) == (1280, 640)
+		assert Image.open(io.BytesIO(renditions["web"]["content"])).format == "WEBP"
+
+		# sizes at or above the original's are skipped
+		renditions, error = render_derivatives(
+			get_image(500, 500), {"thumbnail": 128, "web": 1280}, "jpeg"
+		)
+		assert list(renditions) == ["thumbnail"]
+		assert Image.open(io.BytesIO(renditions["thumbnail"]["content"])).format == "JPEG"
+
+		# content that isn't an image is reported as an error
+		renditions, error = render_derivatives(b"not an image", {"thumbnail": 128}, "webp")
+		assert renditions == {} and error
+
+	def test_store_derivatives(self):
+		client = MagicMock()
+		client.bucket = "test-bucket"
+		file = MagicMock()
+		file.s3_key = "folder/User/Administrator/image.png"
+		file.get.return_value = json.dumps(
+			{"web": {"key": "folder/User/Administrator/image.png.derivatives/web.webp"}}
+		)
+		renditions = {"thumbnail": {"content": b"thumbnail", "width": 128, "height": 64}}
+
+		store_derivatives(client, file, renditions, "webp")
+		client.put_object.assert_called_once_with(
+			Body=b"thumbnail",
+			Bucket="test-bucket",
+			Key="folder/User/Administrator/image.png.derivatives/thumbnail.webp",
+			ContentType="image/webp",
+		)
+		# the web rendition from a previous, larger image is removed
+		client.delete_object.assert_called_once_with(
+			Bucket="test-bucket", Key="folder/User/Administrator/image.png.derivatives/web.webp"
+		)
+		derivatives = json.loads(file.db_set.call_args.args[0]["derivatives"])
+		assert derivatives["thumbnail"]["width"] == 128
+		assert file.db_set.call_args.args[0]["derivative_status"] == "Generated"
+
+	def test_store_file_derivatives(self):
+		client = MagicMock()
+		file = MagicMock()
+		file.s3_key = "folder/User/Administrator/image.png"
+		file.get.return_value = None
+		renditions = {"thumbnail": {"content": b"thumbnail", "width": 128, "height": 64}}
+
+		assert store_file_derivatives(client, file, renditions, "webp") is None
+
+		# an upload error is returned so the rest of the batch is still processed
+		client.put_object.side_effect = Exception("Service unavailable")
+		assert "Service unavailable" in store_file_derivatives(client, file, renditions, "webp")
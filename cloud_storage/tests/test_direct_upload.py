@@ -0,0 +1,111 @@
+from unittest.mock import MagicMock, patch
+
+import frappe
+from botocore.exceptions import ClientError
+from frappe.tests.utils import FrappeTestCase
+
+from cloud_storage.cloud_storage.direct_upload import (
+	complete_multipart_upload,
+	create_multipart_upload,
+)
+from cloud_storage.cloud_storage.overrides.file import get_unique_file_path
+
+SETTINGS = {"direct_upload": True, "upload_expiration": 600}
+MB = 1024 * 1024
+
+
+def get_client():
+	client = MagicMock()
+	client.bucket = "test-bucket"
+	client.folder = "folder"
+	client.transfer_config.multipart_chunksize = 8 * MB
+	client.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+	client.generate_presigned_url.side_effect = lambda **kwargs: str(kwargs["Params"]["PartNumber"])
+	return client
+
+
+class TestDirectUpload(FrappeTestCase):
+	def tearDown(self):
+		frappe.cache().delete_value("cloud_storage_multipart_upload|upload-1")
+
+	@patch("cloud_storage.cloud_storage.overrides.file.is_key_taken")
+	def test_get_unique_file_path(self, is_key_taken):
+		client = get_client()
+		file = frappe._dict(
+			name=None, file_name="report.pdf", attached_to_doctype="ToDo", attached_to_name="TD-0001"
+		)
+		is_key_taken.return_value = False
+		assert get_unique_file_path(client, file) == "folder/ToDo/TD-0001/report.pdf"
+
+		# a key held by another File or object, or reserved in the same batch, is not reused
+		is_key_taken.side_effect = lambda client, key, name: key == "folder/ToDo/TD-0001/report.pdf"
+		path = get_unique_file_path(client, file)
+		assert path != "folder/ToDo/TD-0001/report.pdf"
+		assert path == f"folder/ToDo/TD-0001/{file.file_name}"
+		assert file.file_name.startswith("report") and file.file_name.endswith(".pdf")
+
+		reserved = {path}
+		assert get_unique_file_path(client, file, reserved) not in reserved
+
+	@patch("cloud_storage.cloud_storage.direct_upload.get_max_file_size", return_value=1024 * MB)
+	@patch("cloud_storage.cloud_storage.overrides.file.is_key_taken", return_value=False)
+	@patch("cloud_storage.cloud_storage.direct_upload.get_cloud_storage_client")
+	@patch.dict(frappe.conf, {"cloud_storage_settings": SETTINGS})
+	def test_create_multipart_upload(self, get_client_, is_key_taken, get_max_file_size):
+		client = get_client_.return_value = get_client()
+
+		upload = create_multipart_upload("large report.pdf", 20 * MB, "application/pdf", 1)
+		assert upload["key"] == "folder/No Doctype/large_report.pdf"
+		assert upload["part_size"] == 8 * MB
+		assert upload["urls"] == ["1", "2", "3"]
+		client.create_multipart_upload.assert_called_once_with(
+			Bucket="test-bucket", Key=upload["key"], ContentType="application/pdf"
+		)
+
+		with self.assertRaises(frappe.ValidationError):
+			create_multipart_upload("huge.pdf", 2048 * MB)
+
+	@patch("cloud_storage.cloud_storage.direct_upload.queue_derivatives")
+	@patch("cloud_storage.cloud_storage.direct_upload.get_max_file_size", return_value=10 * MB)
+	@patch("cloud_storage.cloud_storage.overrides.file.is_key_taken", return_value=False)
+	@patch("cloud_storage.cloud_storage.direct_upload.get_cloud_storage_client")
+	@patch.dict(frappe.conf, {"cloud_storage_settings": SETTINGS})
+	def test_complete_multipart_upload(
+		self, get_client_, is_key_taken, get_max_file_size, queue_derivatives
+	):
+		client = get_client_.return_value = get_client()
+		client.complete_multipart_upload.return_value = {"VersionId": "v1"}
+		parts = [{"PartNumber": 2, "ETag": "b"}, {"PartNumber": 1, "ETag": "a"}]
+
+		# the browser declared a small file but uploaded more than the site allows
+		create_multipart_upload("report.pdf", 6 * MB)
+		client.head_object.return_value = {"ContentLength": 11 * MB}
+		with self.assertRaises(frappe.ValidationError):
+			complete_multipart_upload("upload-1", parts)
+		assert client.complete_multipart_upload.call_args.kwargs["MultipartUpload"]["Parts"] == [
+			{"PartNumber": 1, "ETag": "a"},
+			{"PartNumber": 2, "ETag": "b"},
+		]
+		client.delete_object.assert_called_once_with(
+			Bucket="test-bucket", Key="folder/No Doctype/report.pdf", VersionId="v1"
+		)
+
+		# the stored size is the object's, not the declared one
+		create_multipart_upload("report.pdf", 6 * MB)
+		client.head_object.return_value = {"ContentLength": 7 * MB}
+		with patch("frappe.get_doc") as get_doc:
+			file = complete_multipart_upload("upload-1", parts)
+		assert file is get_doc.return_value
+		assert file.file_size == 7 * MB
+		assert file.s3_key == "folder/No Doctype/report.pdf"
+		file.add_file_version.assert_called_once_with("v1")
+		file.insert.assert_called_once()
+
+	def test_is_key_taken(self):
+		from cloud_storage.cloud_storage.overrides.file import is_key_taken
+
+		client = get_client()
+		client.head_object.side_effect = ClientError({"Error": {"Code": "404"}}, "HeadObject")
+		assert is_key_taken(client, "folder/No Doctype/never-uploaded.pdf") is False
+		client.head_object.side_effect = None
+		assert is_key_taken(client, "folder/No Doctype/never-uploaded.pdf") is True
@@ -1,3 +1,5 @@
+import hashlib
+import json
 from unittest.mock import MagicMock, patch
 
 import frappe
@@ -6,8 +8,16 @@ from botocore.exceptions import ClientError
 from frappe.tests.utils import FrappeTestCase
 
 from cloud_storage.cloud_storage.overrides.file import (
+	FILE_URL,
 	CustomFile,
+	RemoteObjectReader,
+	backfill_upload_hashes,
+	check_file_exists,
 	delete_file,
+	get_duplicate_files,
+	get_presigned_urls,
+	get_reference_permissions,
+	serve_decompressed_file,
 	upload_file,
 	write_file,
 )
@@ -16,9 +26,9 @@ from cloud_storage.cloud_storage.overrides.file import (
 class TestFile(FrappeTestCase):
 	@patch("cloud_storage.cloud_storage.overrides.file.upload_file")
 	@patch("cloud_storage.cloud_storage.overrides.file.strip_special_chars")
-	@patch("frappe.get_all")
+	@patch("cloud_storage.cloud_storage.overrides.file.get_duplicate_files")
 	@patch("frappe.conf")
-	def test_write_file(self, config, get_all, strip_chars, upload_file):
+	def test_write_file(self, config, get_duplicate_files, strip_chars, upload_file):
 		file = MagicMock()
 
 		# test local fallback
@@ -41,7 +51,7 @@ class TestFile(FrappeTestCase):
 		file.file_name = "test_file.png"
 		strip_chars.return_value = "test_file.png"
 		upload_file.return_value = file
-		get_all.return_value = []
+		get_duplicate_files.return_value = frappe._dict(hash_match=None, name_match=None)
 		write_file(file)
 		upload_file.assert_called_with(file)
 
@@ -52,6 +62,45 @@ class TestFile(FrappeTestCase):
 		write_file(file)
 		upload_file.assert_called_with(file)
 
+	@patch("cloud_storage.cloud_storage.overrides.file.get_duplicate_files")
+	@patch("frappe.conf")
+	def test_get_existing_file(self, config, get_duplicate_files):
+		config.cloud_storage_settings = {"use_local": False}
+		file = frappe.get_doc(
+			{
+				"doctype": "File",
+				"file_name": "test_file.txt",
+				"content": b"test content",
+				"attached_to_doctype": "User",
+				"attached_to_name": "Administrator",
+			}
+		)
+		file.flags.ignore_permissions = True
+
+		# no duplicate: the File is inserted as usual
+		get_duplicate_files.return_value = frappe._dict(hash_match=None, url_match=None, associated=set())
+		assert file.get_existing_file() is None
+		assert file.content_hash
+
+		# duplicate without the association: it is appended to the existing File
+		existing_file = MagicMock()
+		get_duplicate_files.return_value = frappe._dict(
+			hash_match="existing_file", url_match=None, associated=set()
+		)
+		with patch("frappe.get_doc", return_value=existing_file):
+			assert file.get_existing_file() == existing_file
+		existing_file.add_file_association.assert_called_with("User", "Administrator")
+		existing_file.save.assert_called_once()
+
+		# duplicate already associated: the existing File is returned without being saved
+		existing_file.reset_mock()
+		get_duplicate_files.return_value = frappe._dict(
+			hash_match="existing_file", url_match=None, associated={"existing_file"}
+		)
+		with patch("frappe.get_doc", return_value=existing_file):
+			assert file.get_existing_file() == existing_file
+		existing_file.save.assert_not_called()
+
 	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
 	@patch("cloud_storage.cloud_storage.overrides.file.get_file_path")
 	def test_upload_file(self, file_path, client):
@@ -76,6 +125,50 @@ class TestFile(FrappeTestCase):
 		upload_file(file)
 		assert client.return_value.put_object.call_count == 3
 
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
+	@patch("cloud_storage.cloud_storage.overrides.file.get_file_path")
+	def test_upload_file_multipart(self, file_path, client):
+		client.return_value.transfer_config.multipart_threshold = 8
+		client.return_value.head_object.return_value = {"VersionId": "v1"}
+		file_path.return_value = "/path/to/s3/bucket/location"
+
+		# test small content is sent in a single request
+		file = MagicMock()
+		file.content_type = "text/plain"
+		file.content = b"small"
+		upload_file(file)
+		assert client.return_value.put_object.call_count == 1
+		assert client.return_value.upload_fileobj.call_count == 0
+
+		# test large content is streamed as a managed transfer and its version is recorded
+		file.content = b"larger than the threshold"
+		upload_file(file)
+		assert client.return_value.put_object.call_count == 1
+		assert client.return_value.upload_fileobj.call_count == 1
+		file.add_file_version.assert_called_with("v1", "/path/to/s3/bucket/location")
+
+	def test_remote_object_reader(self):
+		content = b"0123456789"
+
+		def get_object(Bucket, Key, Range):
+			start, end = Range.split("=")[1].split("-")
+			body = MagicMock()
+			body.read.return_value = content[int(start) : int(end) + 1 if end else None]
+			return {"Body": body}
+
+		client = MagicMock()
+		client.head_object.return_value = {"ContentLength": len(content)}
+		client.get_object.side_effect = get_object
+
+		reader = RemoteObjectReader(client, "key")
+		assert reader.read(4) == b"0123"
+		reader.seek(-3, 2)
+		assert reader.read() == b"789"
+		assert reader.read(1) == b""
+		reader.seek(5)
+		assert reader.read(2) == b"56"
+		assert client.get_object.call_count == 3
+
 	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
 	@patch("frappe.conf")
 	def test_delete_file(self, config, client):
@@ -132,10 +225,17 @@ class TestFile(FrappeTestCase):
 		delete_file(file)
 		assert client.return_value.delete_object.call_count == 3
 
+		# test background deletion is queued instead
+		config.cloud_storage_settings = {"use_local": False, "background_deletion": True}
+		with patch("cloud_storage.cloud_storage.overrides.file.queue_deletion") as queue_deletion:
+			delete_file(file)
+			queue_deletion.assert_called_with("/path/to/s3/bucket/location")
+		assert client.return_value.delete_object.call_count == 3
+
 	@patch("cloud_storage.cloud_storage.overrides.file.has_user_permission")
 	@patch("frappe.has_permission")
-	@patch("frappe.get_doc")
-	def test_file_permission(self, get_doc, has_permission, has_user_permission):
+	@patch("cloud_storage.cloud_storage.overrides.file.get_reference_permissions")
+	def test_file_permission(self, get_reference_permissions, has_permission, has_user_permission):
 		# test file access for owner
 		file = CustomFile({"doctype": "File", "owner": "Administrator"})
 		self.assertEqual(file.has_permission(), True)
@@ -160,16 +260,323 @@ class TestFile(FrappeTestCase):
 		)
 
 		# test file access for doc permissions
-		get_doc.return_value = MagicMock()
-		get_doc.return_value.has_permission.return_value = True
+		get_reference_permissions.return_value = {("Sales Order", "SO-0001"): True}
 		assert file.has_permission(user="Administrator") is True
 		assert file.has_permission(user="support@agritheory.dev") is True
 
+		# test file access through any associated document
+		file.append("file_association", {"link_doctype": "Sales Order", "link_name": "SO-0002"})
+		get_reference_permissions.return_value = {
+			("Sales Order", "SO-0001"): False,
+			("Sales Order", "SO-0002"): True,
+		}
+		assert file.has_permission(user="support@agritheory.dev") is True
+		get_reference_permissions.assert_called_with(
+			[("Sales Order", "SO-0001"), ("Sales Order", "SO-0002")], "support@agritheory.dev"
+		)
+
 		# test file access for custom user permissions
-		get_doc.return_value.has_permission.return_value = False
+		get_reference_permissions.return_value = {
+			("Sales Order", "SO-0001"): False,
+			("Sales Order", "SO-0002"): False,
+		}
 		has_user_permission.return_value = True
 		assert file.has_permission(user="Administrator") is True
 		assert file.has_permission(user="support@agritheory.dev") is True
 		has_user_permission.return_value = False
 		assert file.has_permission(user="Administrator") is True
 		assert file.has_permission(user="support@agritheory.dev") is False
+
+	@patch("frappe.has_permission")
+	@patch("frappe.get_all")
+	def test_get_reference_permissions(self, get_all, has_permission):
+		frappe.local.cloud_storage_permissions = {}
+		get_all.return_value = ["Administrator"]
+		has_permission.return_value = True
+		references = [("User", "Administrator"), ("User", "missing")]
+
+		permissions = get_reference_permissions(references, "Administrator")
+		assert permissions == {("User", "Administrator"): True, ("User", "missing"): False}
+		assert get_all.call_count == 1
+		assert has_permission.call_count == 1
+
+		# memoized for the rest of the request
+		assert get_reference_permissions(references, "Administrator") == permissions
+		assert get_all.call_count == 1
+		assert has_permission.call_count == 1
+		has_permission.assert_called_with("User", "read", doc="Administrator", user="Administrator")
+
+	def test_get_reference_permissions_single(self):
+		# Single DocTypes have no table, and are checked as documents like any other reference
+		frappe.local.cloud_storage_permissions = {}
+		references = [("Website Settings", "Website Settings")]
+		assert get_reference_permissions(references, "Administrator") == {references[0]: True}
+		assert get_reference_permissions(references, "Guest") == {references[0]: False}
+
+		file = CustomFile(
+			{
+				"doctype": "File",
+				"owner": "Administrator",
+				"attached_to_doctype": "Website Settings",
+				"attached_to_name": "Website Settings",
+			}
+		)
+		assert file.has_permission(user="Administrator") is True
+
+	def test_get_duplicate_files(self):
+		content_hash = frappe.generate_hash()
+		for idx, (name, file_hash) in enumerate(
+			[("dup-older", content_hash), ("dup-newer", None), ("dup-other", None)]
+		):
+			frappe.get_doc(
+				{
+					"doctype": "File",
+					"name": name,
+					"file_name": "dup-image.png" if name != "dup-other" else "dup-other.png",
+					"file_url": f"/api/method/retrieve?key=test_folder/{name}.png",
+					"content_hash": file_hash,
+					"modified": f"2024-01-0{idx + 1} 00:00:00",
+				}
+			).db_insert()
+
+		file = frappe._dict(
+			name=None,
+			content_hash=content_hash,
+			file_name="dup-image.png",
+			file_url="/api/method/retrieve?key=test_folder/dup-other.png",
+			attached_to_doctype=None,
+			attached_to_name=None,
+			flags=frappe._dict(),
+		)
+		duplicates = get_duplicate_files(file)
+		assert duplicates.hash_match == "dup-older"
+		# the most recent of the Files sharing the name
+		assert duplicates.name_match == "dup-newer"
+		assert duplicates.url_match == "dup-other"
+		assert duplicates.associated == set()
+
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cached_url")
+	@patch("cloud_storage.cloud_storage.overrides.file.sign_url")
+	@patch("frappe.has_permission")
+	@patch("frappe.get_doc")
+	@patch("frappe.qb")
+	def test_get_presigned_urls(self, qb, get_doc, has_permission, sign_url, get_cached_url):
+		files = [
+			frappe._dict(
+				name=f"file-{idx}",
+				s3_key=f"folder/Sales Order/SO-0001/file-{idx}.png",
+				is_private=1,
+				owner="Administrator",
+				attached_to_doctype="Sales Order",
+				attached_to_name="SO-0001",
+			)
+			for idx in range(3)
+		]
+		# browsers can't be relied on to decode zstd, so it is served decompressed by `retrieve`
+		files[2].content_encoding = "zstd"
+		qb.from_.return_value.select.return_value.where.return_value.run.return_value = files
+		get_cached_url.return_value = None
+		sign_url.side_effect = lambda client, key, is_private: f"https://signed/{key}"
+		has_permission.return_value = True
+
+		urls = get_presigned_urls(MagicMock(), keys=[files[0].s3_key], names=["file-1", "file-2", "missing"])
+		assert urls[files[0].s3_key] == f"https://signed/{files[0].s3_key}"
+		assert urls["file-1"] == f"https://signed/{files[1].s3_key}"
+		assert urls["file-2"] == FILE_URL.format(path=files[2].s3_key)
+		assert urls["missing"] is None
+		assert has_permission.call_count == 3
+
+	@patch("frappe.get_doc")
+	def test_serve_decompressed_file(self, get_doc):
+		get_doc.return_value.file_name = "report.csv"
+		get_doc.return_value.iter_content.return_value = iter([b"a,b\n", b"1,2\n"])
+
+		response = serve_decompressed_file("file-1")
+		assert response.mimetype == "text/csv"
+		assert response.headers["Content-Disposition"] == "inline; filename=report.csv"
+		assert "Content-Encoding" not in response.headers
+		assert b"".join(response.response) == b"a,b\n1,2\n"
+
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cached_url")
+	@patch("cloud_storage.cloud_storage.overrides.file.sign_url")
+	@patch("frappe.has_permission")
+	@patch("frappe.get_doc")
+	@patch("frappe.qb")
+	def test_get_presigned_urls_per_file(self, qb, get_doc, has_permission, sign_url, get_cached_url):
+		# both Files are attached to SO-0001, but only the first is also associated with SO-0002,
+		# which is the only document the user can read
+		files = [
+			frappe._dict(
+				name=name,
+				s3_key=f"folder/Sales Order/SO-0001/{name}.png",
+				is_private=1,
+				attached_to_doctype="Sales Order",
+				attached_to_name="SO-0001",
+			)
+			for name in ("associated", "unassociated")
+		]
+		qb.from_.return_value.select.return_value.where.return_value.run.return_value = files
+		get_cached_url.return_value = None
+		get_doc.side_effect = lambda doctype, name: frappe._dict(doctype=doctype, name=name)
+		has_permission.side_effect = lambda doctype, ptype, doc, user: doc.name == "associated"
+		sign_url.side_effect = lambda client, key, is_private: f"https://signed/{key}"
+
+		urls = get_presigned_urls(MagicMock(), names=["associated", "unassociated"])
+		assert urls["associated"] == f"https://signed/{files[0].s3_key}"
+		assert urls["unassociated"] is None
+
+	@patch("frappe.has_permission")
+	@patch("frappe.get_doc")
+	@patch("frappe.qb")
+	def test_check_file_exists(self, qb, get_doc, has_permission):
+		run = qb.from_.return_value.select.return_value.where.return_value.where.return_value.run
+		run.return_value = [
+			frappe._dict(
+				name="file-1", file_name="report.pdf", file_url="/api/method/retrieve?key=a", upload_hash="x"
+			),
+			frappe._dict(
+				name="file-2", file_name="scan.pdf", file_url="/api/method/retrieve?key=b", upload_hash="abc"
+			),
+		]
+
+		# the content matches a File the user can read
+		has_permission.return_value = True
+		result = check_file_exists("report.pdf", "abc")
+		assert result["filename_exists"] is True
+		assert result["content_exists"] is True
+		assert sorted(result["matched_files"]) == ["report.pdf", "scan.pdf"]
+		assert result["matched_file_url"] == "/api/method/retrieve?key=b"
+		get_doc.assert_called_with("File", "file-2")
+
+		# content the user can't read is reported but not offered for reuse
+		has_permission.return_value = False
+		result = check_file_exists("report.pdf", "abc")
+		assert result["content_exists"] is True
+		assert result["matched_file_url"] is None
+
+		# without a hash, only the name is matched
+		result = check_file_exists("report.pdf")
+		assert result["content_exists"] is False
+		assert result["matched_files"] == ["report.pdf"]
+
+	@patch("frappe.get_doc")
+	@patch("frappe.qb")
+	def test_backfill_upload_hashes(self, qb, get_doc):
+		query = qb.from_.return_value.select.return_value
+		for _ in range(4):
+			query = query.where.return_value
+		query.orderby.return_value.limit.return_value.run.side_effect = [["file-1"], []]
+		get_doc.return_value.iter_content.return_value = iter([b"first chunk,", b" second chunk"])
+
+		backfill_upload_hashes()
+		get_doc.return_value.db_set.assert_called_once_with(
+			"upload_hash",
+			hashlib.sha256(b"first chunk, second chunk").hexdigest(),
+			update_modified=False,
+		)
+
+	@patch("cloud_storage.cloud_storage.overrides.file.insert_file_version")
+	@patch("cloud_storage.cloud_storage.overrides.file.queue_deletion")
+	@patch("cloud_storage.cloud_storage.overrides.file.copy_object")
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
+	def test_relocate(self, get_client, copy_object, queue_deletion, insert_file_version):
+		client = get_client.return_value
+		client.folder = "folder"
+		client.head_object.side_effect = ClientError({"Error": {"Code": "404"}}, "HeadObject")
+		copy_object.return_value = {"VersionId": "v2"}
+		file = CustomFile(
+			{
+				"doctype": "File",
+				"name": "file-1",
+				"file_name": "report.pdf",
+				"attached_to_doctype": "ToDo",
+				"attached_to_name": "TD-0002",
+				"s3_key": "folder/ToDo/TD-0001/report.pdf",
+				"derivatives": json.dumps(
+					{"thumbnail": {"key": "folder/ToDo/TD-0001/report.pdf.derivatives/thumbnail.webp"}}
+				),
+			}
+		)
+
+		file.relocate()
+		assert [call.args[1:] for call in copy_object.call_args_list] == [
+			("folder/ToDo/TD-0001/report.pdf", "folder/ToDo/TD-0002/report.pdf"),
+			(
+				"folder/ToDo/TD-0001/report.pdf.derivatives/thumbnail.webp",
+				"folder/ToDo/TD-0002/report.pdf.derivatives/thumbnail.webp",
+			),
+		]
+		# the previous objects are only removed once the File is saved with its new key
+		client.delete_object.assert_not_called()
+		assert [call.args[0] for call in queue_deletion.call_args_list] == [
+			"folder/ToDo/TD-0001/report.pdf",
+			"folder/ToDo/TD-0001/report.pdf.derivatives/thumbnail.webp",
+		]
+		assert json.loads(file.derivatives)["thumbnail"]["key"] == (
+			"folder/ToDo/TD-0002/report.pdf.derivatives/thumbnail.webp"
+		)
+		assert file.s3_key == "folder/ToDo/TD-0002/report.pdf"
+		assert file.file_url == "/api/method/retrieve?key=folder/ToDo/TD-0002/report.pdf"
+		assert insert_file_version.call_args.args[1]["s3_key"] == "folder/ToDo/TD-0002/report.pdf"
+
+	@patch("cloud_storage.cloud_storage.overrides.file.insert_file_version")
+	@patch("cloud_storage.cloud_storage.overrides.file.queue_deletion")
+	@patch("cloud_storage.cloud_storage.overrides.file.copy_object")
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
+	def test_relocate_onto_existing_key(
+		self, get_client, copy_object, queue_deletion, insert_file_version
+	):
+		client = get_client.return_value
+		client.folder = "folder"
+		# another File's object already exists at the key the attachment maps to
+		client.head_object.side_effect = [{}, ClientError({"Error": {"Code": "404"}}, "HeadObject")]
+		copy_object.return_value = {}
+		file = CustomFile(
+			{
+				"doctype": "File",
+				"name": "file-1",
+				"file_name": "report.pdf",
+				"attached_to_doctype": "ToDo",
+				"attached_to_name": "TD-0002",
+				"s3_key": "folder/ToDo/TD-0001/report.pdf",
+			}
+		)
+
+		file.relocate()
+		destination = copy_object.call_args.args[2]
+		assert destination != "folder/ToDo/TD-0002/report.pdf"
+		assert destination == f"folder/ToDo/TD-0002/{file.file_name}"
+		assert file.s3_key == destination
+
+	@patch("cloud_storage.cloud_storage.overrides.file.insert_file_version")
+	@patch("cloud_storage.cloud_storage.overrides.file.get_version_key")
+	@patch("cloud_storage.cloud_storage.overrides.file.copy_object")
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
+	def test_restore_version(self, get_client, copy_object, get_version_key, insert_file_version):
+		client = get_client.return_value
+		client.head_object.return_value = {}
+		copy_object.return_value = {"VersionId": "v3"}
+		file = CustomFile(
+			{"doctype": "File", "name": "file-1", "s3_key": "folder/ToDo/TD-0002/report.pdf"}
+		)
+
+		# a version recorded before the File was relocated is copied from its own key
+		get_version_key.return_value = "folder/ToDo/TD-0001/report.pdf"
+		with patch.object(CustomFile, "save") as save:
+			file.restore_version("v1")
+		copy_object.assert_called_once_with(
+			client, "folder/ToDo/TD-0001/report.pdf", "folder/ToDo/TD-0002/report.pdf", "v1"
+		)
+		save.assert_called_once()
+
+		# versions recorded without a key were stored under the File's key
+		get_version_key.return_value = ""
+		with patch.object(CustomFile, "save"):
+			file.restore_version("v0")
+		copy_object.assert_called_with(
+			client, "folder/ToDo/TD-0002/report.pdf", "folder/ToDo/TD-0002/report.pdf", "v0"
+		)
+
+		get_version_key.return_value = None
+		with self.assertRaises(frappe.ValidationError):
+			file.restore_version("not-a-version")
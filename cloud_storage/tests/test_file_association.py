@@ -1,11 +1,18 @@
 from io import BytesIO
 from pathlib import Path
+from unittest.mock import patch
 
 import pytest
 from moto import mock_s3
 
 import frappe
 
+from cloud_storage.cloud_storage.overrides.file import (
+	delete_unassociated_files,
+	get_cloud_storage_client,
+	remove_document_associations,
+)
+
 
 @pytest.fixture
 def example_file_record_0():
@@ -27,6 +34,20 @@ def test_config(get_cloud_storage_client_fixture):
 	assert c._endpoint.host == "https://test.imgainarys3.edu"
 
 
+@mock_s3
+def test_client_cache(monkeypatch, get_cloud_storage_client_fixture):
+	c = get_cloud_storage_client_fixture
+	assert get_cloud_storage_client() is c
+
+	settings = dict(frappe.conf.cloud_storage_settings)
+	settings["expiration"] = 60
+	monkeypatch.setattr("frappe.conf.cloud_storage_settings", settings)
+	new_client = get_cloud_storage_client()
+	assert new_client is not c
+	assert new_client.expiration == 60
+	assert get_cloud_storage_client() is new_client
+
+
 # helper function
 def create_upload_file(file_path, **kwargs):
 	f = BytesIO(file_path.resolve().read_bytes())
@@ -87,3 +108,65 @@ def test_upload_file(example_file_record_0):
 # 	assert len(file.file_association) == 1
 # 	assert file.file_association[0].link_doctype == 'User'
 # 	assert file.file_association[0].link_name == 'Administrator'
+
+
+@mock_s3
+def test_remove_associations_on_delete():
+	frappe.set_user("Administrator")
+	todos = [
+		frappe.get_doc({"doctype": "ToDo", "description": f"Attachment test {idx}"}).insert()
+		for idx in range(2)
+	]
+	file = frappe.get_doc(
+		{
+			"doctype": "File",
+			"file_name": "association-test.txt",
+			"content": b"attached to two documents",
+			"attached_to_doctype": "ToDo",
+			"attached_to_name": todos[0].name,
+			"is_private": 1,
+		}
+	).insert()
+	file.associate_files("ToDo", todos[1].name)
+	file.save()
+	assert len(file.file_association) == 2
+
+	frappe.delete_doc("ToDo", todos[0].name)
+	file.reload()
+	assert file.attached_to_name == todos[1].name
+	assert [(row.link_name, row.idx) for row in file.file_association] == [(todos[1].name, 1)]
+
+	frappe.delete_doc("ToDo", todos[1].name)
+	assert not frappe.db.exists("File", file.name)
+	assert not frappe.db.exists("File Association", {"parent": file.name})
+	assert frappe.db.exists("Pending Deletion", {"s3_key": file.s3_key})
+
+
+@patch("cloud_storage.cloud_storage.overrides.file.remove_associations")
+def test_remove_document_associations_skips_logs(remove_associations):
+	remove_document_associations(frappe.get_doc({"doctype": "Error Log", "name": "log-1"}))
+	remove_document_associations(frappe.get_doc({"doctype": "Has Role", "name": "row-1"}))
+	remove_associations.assert_not_called()
+
+	remove_document_associations(frappe.get_doc({"doctype": "ToDo", "name": "todo-1"}))
+	remove_associations.assert_called_once_with([("ToDo", "todo-1")])
+
+
+@patch("cloud_storage.cloud_storage.overrides.file.queue_deletions")
+@patch("cloud_storage.cloud_storage.overrides.file.remove_spooled_file")
+@patch("frappe.delete_doc")
+def test_delete_unassociated_files_after_commit(delete_doc, remove_spooled_file, queue_deletions):
+	files = [
+		frappe._dict(name="local", s3_key=None),
+		frappe._dict(name="spooled", s3_key="test_folder/spooled.txt", spool_path="/spool/spooled"),
+	]
+	with patch.object(frappe.db, "after_commit") as after_commit:
+		delete_unassociated_files(files)
+		# the deletion may still be rolled back, so the only copy of spooled content is kept until then
+		remove_spooled_file.assert_not_called()
+		callback = after_commit.add.call_args.args[0]
+	callback()
+	remove_spooled_file.assert_called_once_with("/spool/spooled")
+	# local Files are left to Frappe's `remove_all`
+	delete_doc.assert_not_called()
+	queue_deletions.assert_called_once_with(["test_folder/spooled.txt"])
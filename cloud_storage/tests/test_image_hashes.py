@@ -0,0 +1,135 @@
+import hashlib
+import io
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils.image import strip_exif_data
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from cloud_storage.cloud_storage.overrides.file import (
+	backfill_image_hashes,
+	get_file_content_hash,
+	set_image_hashes,
+	validate_file_content,
+	write_file,
+)
+
+
+def get_photo(description: str = "", quality: int = 95) -> bytes:
+	image = Image.new("RGB", (64, 64), color="blue")
+	exif = Image.Exif()
+	if description:
+		exif[0x010E] = description  # ImageDescription
+	output = io.BytesIO()
+	image.save(output, format="JPEG", exif=exif, quality=quality)
+	return output.getvalue()
+
+
+def insert_file(name: str, **hashes) -> None:
+	frappe.get_doc(
+		{
+			"doctype": "File",
+			"name": name,
+			"file_name": f"{name}.jpg",
+			"file_url": f"/api/method/retrieve?key=test_folder/{name}.jpg",
+			**hashes,
+		}
+	).db_insert()
+
+
+def validate_upload(file_name: str, content: bytes) -> dict:
+	frappe.local.request = frappe._dict(
+		files={"file": FileStorage(io.BytesIO(content), filename=file_name)}
+	)
+	return validate_file_content()
+
+
+class TestImageHashes(FrappeTestCase):
+	def test_set_image_hashes(self):
+		original = get_photo("original upload")
+		optimized = get_photo(quality=60)
+		file = frappe._dict(content_type="image/jpeg", file_name="photo.jpg", content=optimized)
+
+		upload = FileStorage(io.BytesIO(original), filename="photo.jpg")
+		with patch("cloud_storage.cloud_storage.overrides.file.get_request_upload", return_value=upload):
+			set_image_hashes(file)
+		assert file.stripped_content_hash == get_file_content_hash(optimized, "image/jpeg")
+		assert file.original_content_hash == get_file_content_hash(original, "image/jpeg")
+
+		# content that isn't an image isn't hashed
+		file = frappe._dict(content_type="text/plain", file_name="notes.txt", content=b"notes")
+		set_image_hashes(file)
+		assert not file.get("stripped_content_hash")
+
+	def test_write_file_upload_hash(self):
+		original = get_photo("taken with camera A")
+		file = MagicMock()
+		file.file_name = "photo.jpg"
+		file.content_type = "image/jpeg"
+		# Frappe strips EXIF data before the File is written
+		file.content = strip_exif_data(original, "image/jpeg")
+		assert file.content != original
+
+		upload = FileStorage(io.BytesIO(original), filename="photo.jpg")
+		with patch(
+			"cloud_storage.cloud_storage.overrides.file.get_request_upload", return_value=upload
+		), patch.dict(frappe.conf, {"cloud_storage_settings": None}):
+			write_file(file)
+		# the browser hashes the file it is about to send, EXIF data included
+		assert file.upload_hash == hashlib.sha256(original).hexdigest()
+		assert upload.stream.tell() == 0
+
+	def test_validate_file_content_stripped_match(self):
+		stored = get_photo("taken with camera A")
+		insert_file(
+			"image-hash-stripped",
+			content_hash=frappe.generate_hash(),
+			stripped_content_hash=get_file_content_hash(stored, "image/jpeg"),
+		)
+
+		# the same image with different EXIF data is a duplicate
+		result = validate_upload("renamed.jpg", get_photo("edited with app B"))
+		assert result["content_exists"] is True
+		assert "image-hash-stripped.jpg" in result["matched_files"]
+		assert result["filename_exists"] is False
+
+	def test_validate_file_content_original_match(self):
+		original = get_photo("original upload")
+		file = frappe._dict(content_type="image/jpeg", file_name="photo.jpg", content=get_photo(quality=60))
+		upload = FileStorage(io.BytesIO(original), filename="photo.jpg")
+		with patch("cloud_storage.cloud_storage.overrides.file.get_request_upload", return_value=upload):
+			set_image_hashes(file)
+		insert_file(
+			"image-hash-original",
+			content_hash=frappe.generate_hash(),
+			stripped_content_hash=file.stripped_content_hash,
+			original_content_hash=file.original_content_hash,
+		)
+
+		# the File was optimized after upload, but uploading the original again still matches it
+		result = validate_upload("photo-again.jpg", original)
+		assert result["content_exists"] is True
+		assert "image-hash-original.jpg" in result["matched_files"]
+
+	@patch("frappe.get_doc")
+	@patch("frappe.qb")
+	def test_backfill_image_hashes(self, qb, get_doc):
+		query = qb.from_.return_value.select.return_value
+		for _ in range(4):
+			query = query.where.return_value
+		query.orderby.return_value.limit.return_value.run.side_effect = [["file-1"], []]
+		content = get_photo("backfilled")
+		get_doc.return_value.file_name = "photo.jpg"
+		get_doc.return_value.get_content.return_value = content
+
+		backfill_image_hashes()
+		stripped_content_hash = get_file_content_hash(content, "image/jpeg")
+		get_doc.return_value.db_set.assert_called_once_with(
+			{
+				"stripped_content_hash": stripped_content_hash,
+				"original_content_hash": stripped_content_hash,
+			},
+			update_modified=False,
+		)
@@ -0,0 +1,81 @@
+import io
+from unittest.mock import MagicMock, patch
+
+from cloud_storage.cloud_storage.instrumentation import S3Metrics, render_metrics
+
+
+def get_metrics() -> S3Metrics:
+	with patch("frappe.cache"):
+		metrics = S3Metrics("test_site")
+	metrics.record = MagicMock()
+	return metrics
+
+
+def test_s3_metrics_call():
+	metrics = get_metrics()
+	model = MagicMock(http={"method": "PUT"})
+	model.name = "PutObject"
+	context = {}
+	# uploads are measured from the body, since the Content-Length header isn't set yet
+	metrics.before_call(
+		model=model, params={"headers": {}, "body": io.BytesIO(b"x" * 1024)}, context=context
+	)
+	metrics.after_call(
+		http_response=MagicMock(headers={"Content-Length": "0"}),
+		parsed={"ResponseMetadata": {"RetryAttempts": 1}},
+		model=model,
+		context=context,
+	)
+	operation = metrics.record.call_args.args[0]
+	assert operation == "PutObject"
+	assert metrics.record.call_args.kwargs["transferred"] == 1024
+	assert metrics.record.call_args.kwargs["retries"] == 1
+
+	# a HEAD response reports the object's length without sending it
+	model = MagicMock(http={"method": "HEAD"})
+	model.name = "HeadObject"
+	context = {}
+	metrics.before_call(model=model, params={"headers": {}, "body": b""}, context=context)
+	metrics.after_call(
+		http_response=MagicMock(headers={"Content-Length": "4096"}),
+		parsed={},
+		model=model,
+		context=context,
+	)
+	assert metrics.record.call_args.kwargs["transferred"] == 0
+
+
+def test_s3_metrics_call_error():
+	metrics = get_metrics()
+	model = MagicMock()
+	model.name = "GetObject"
+	context = {}
+	metrics.before_call(model=model, params={"headers": {}, "body": b""}, context=context)
+	# botocore emits `after-call-error` with only the exception and the context
+	metrics.after_call_error(exception=ConnectionError("reset"), context=context)
+	assert metrics.record.call_args.args[0] == "GetObject"
+	assert metrics.record.call_args.kwargs["error"] == "ConnectionError"
+
+
+def test_render_metrics():
+	values = {
+		"bucket|PutObject|Sales Invoice|0.05": 2.0,
+		"bucket|PutObject|Sales Invoice|+Inf": 1.0,
+		"count|PutObject|Sales Invoice": 3.0,
+		"sum|PutObject|Sales Invoice": 75.5,
+		"bytes|PutObject|Sales Invoice": 4096.0,
+		"retries|PutObject|Sales Invoice": 1.0,
+		"errors|PutObject|Sales Invoice|SlowDown": 1.0,
+	}
+	metrics = render_metrics(values, "test_site")
+	labels = 'site="test_site",operation="PutObject",doctype="Sales Invoice"'
+
+	assert "# TYPE cloud_storage_s3_request_duration_seconds histogram" in metrics
+	assert f'cloud_storage_s3_request_duration_seconds_bucket{{{labels},le="0.025"}} 0' in metrics
+	assert f'cloud_storage_s3_request_duration_seconds_bucket{{{labels},le="0.05"}} 2' in metrics
+	assert f'cloud_storage_s3_request_duration_seconds_bucket{{{labels},le="60"}} 2' in metrics
+	assert f'cloud_storage_s3_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3' in metrics
+	assert f"cloud_storage_s3_request_duration_seconds_count{{{labels}}} 3" in metrics
+	assert f"cloud_storage_s3_bytes_total{{{labels}}} 4096" in metrics
+	assert f"cloud_storage_s3_retries_total{{{labels}}} 1" in metrics
+	assert f'cloud_storage_s3_errors_total{{{labels},code="SlowDown"}} 1' in metrics
@@ -0,0 +1,198 @@
+import hashlib
+import io
+import os
+import tempfile
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import frappe
+from botocore.exceptions import ClientError
+from frappe.core.doctype.file.file import get_files_path
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import now_datetime
+
+from cloud_storage.cloud_storage.migration import (
+	HashingReader,
+	assign_keys,
+	load_checkpoint,
+	mark_migrated,
+	merge_duplicate,
+	migrate_local_files,
+	save_checkpoint,
+)
+from cloud_storage.cloud_storage.overrides.file import FILE_URL
+
+
+def insert_file(name: str, file_url: str, **values) -> frappe._dict:
+	file = frappe._dict(
+		name=name,
+		file_name=file_url.rsplit("/", 1)[1],
+		file_url=file_url,
+		is_private=1,
+		is_folder=0,
+		owner="Administrator",
+		creation=now_datetime(),
+		**values,
+	)
+	frappe.get_doc({"doctype": "File", **file}).db_insert()
+	return file
+
+
+def get_local_file(name: str, file_name: str, content_hash: str) -> frappe._dict:
+	# the values returned by `get_local_files` for a File uploaded through the User's image field
+	frappe.db.set_value(
+		"User", "Administrator", "user_image", f"/private/files/{file_name}", update_modified=False
+	)
+	return insert_file(
+		name,
+		f"/private/files/{file_name}",
+		content_hash=content_hash,
+		attached_to_doctype="User",
+		attached_to_name="Administrator",
+		attached_to_field="user_image",
+	)
+
+
+class TestMigration(FrappeTestCase):
+	def test_hashing_reader(self):
+		content = b"x" * (3 * 1024 * 1024 + 7)
+		reader = HashingReader(io.BytesIO(content))
+		chunks = []
+		while True:
+			chunk = reader.read(1024 * 1024)
+			if not chunk:
+				break
+			chunks.append(chunk)
+
+		assert b"".join(chunks) == content
+		assert reader.size == len(content)
+		assert reader.hash.hexdigest() == hashlib.md5(content).hexdigest()
+
+	@patch("cloud_storage.cloud_storage.overrides.file.is_key_taken", return_value=False)
+	def test_assign_keys(self, is_key_taken):
+		client = MagicMock(folder="test_folder")
+		files = [
+			frappe._dict(
+				name=f"file-{idx}",
+				file_name="scan.pdf",
+				attached_to_doctype="ToDo",
+				attached_to_name="TD-0001",
+			)
+			for idx in range(2)
+		]
+
+		# two local Files with the same name on the same document get keys of their own
+		assign_keys(client, files)
+		assert files[0].key == "test_folder/ToDo/TD-0001/scan.pdf"
+		assert files[1].key != files[0].key
+		assert files[1].key == f"test_folder/ToDo/TD-0001/{files[1].file_name}"
+
+	def test_mark_migrated(self):
+		file = get_local_file("migration-mark", "migration-mark.png", None)
+		key = "test_folder/User/Administrator/migration-mark.png"
+
+		mark_migrated(file, {"key": key, "content_hash": "migration-hash", "size": 3, "version_id": "v1"})
+		migrated = frappe.db.get_value(
+			"File", file.name, ["file_url", "s3_key", "content_hash"], as_dict=True
+		)
+		assert migrated == {
+			"file_url": FILE_URL.format(path=key),
+			"s3_key": key,
+			"content_hash": "migration-hash",
+		}
+		# the image field keeps resolving to the File
+		assert frappe.db.get_value("User", "Administrator", "user_image") == FILE_URL.format(path=key)
+		assert frappe.db.exists(
+			"File Association",
+			{"parent": file.name, "link_doctype": "User", "link_name": "Administrator"},
+		)
+		assert frappe.db.get_value("File Version", {"parent": file.name}, ["version", "s3_key"]) == (
+			"v1",
+			key,
+		)
+
+	def test_merge_duplicate(self):
+		existing_key = "test_folder/ToDo/TD-0001/original.png"
+		existing_file = insert_file(
+			"migration-existing",
+			FILE_URL.format(path=existing_key),
+			s3_key=existing_key,
+			content_hash="duplicate-hash",
+		)
+		file = get_local_file("migration-duplicate", "migration-duplicate.png", "duplicate-hash")
+		client = MagicMock(bucket="test-bucket")
+		uploaded_key = "test_folder/User/Administrator/migration-duplicate.png"
+
+		assert merge_duplicate(client, file, {"key": uploaded_key, "content_hash": "duplicate-hash"})
+		assert not frappe.db.exists("File", file.name)
+		assert frappe.db.exists(
+			"File Association",
+			{"parent": existing_file.name, "link_doctype": "User", "link_name": "Administrator"},
+		)
+		assert frappe.db.get_value("User", "Administrator", "user_image") == existing_file.file_url
+		client.delete_object.assert_called_once_with(Bucket="test-bucket", Key=uploaded_key)
+
+		# content without a File in the bucket isn't merged
+		file = get_local_file("migration-unique", "migration-unique.png", "unique-hash")
+		assert not merge_duplicate(client, file, {"key": "unused", "content_hash": "unique-hash"})
+
+	@patch("cloud_storage.cloud_storage.migration.get_cloud_storage_client")
+	@patch("cloud_storage.cloud_storage.migration.get_local_files", return_value=[])
+	def test_checkpoint_resume(self, get_local_files, get_client):
+		with tempfile.TemporaryDirectory() as directory, patch(
+			"cloud_storage.cloud_storage.migration.get_checkpoint_path",
+			return_value=Path(directory) / "checkpoint.json",
+		):
+			assert load_checkpoint()["cursor"] == ""
+			save_checkpoint({**load_checkpoint(), "cursor": "file-0100", "migrated": 100})
+
+			# an interrupted run resumes after the last checkpointed File
+			checkpoint = migrate_local_files(workers=1)
+			get_local_files.assert_called_once_with("file-0100", 100)
+			assert checkpoint["migrated"] == 100
+
+			# a restart starts over
+			migrate_local_files(workers=1, restart=True)
+			get_local_files.assert_called_with("", 100)
+
+	@patch("cloud_storage.cloud_storage.migration.report_progress")
+	@patch("cloud_storage.cloud_storage.migration.get_cloud_storage_client")
+	@patch("cloud_storage.cloud_storage.migration.get_local_files")
+	def test_migrate_local_files(self, get_local_files, get_client, report_progress):
+		content = b"migrated through the upload threads"
+		file = get_local_file("migration-upload", "migration-upload.txt", None)
+		local_path = get_files_path("migration-upload.txt", is_private=1)
+		Path(local_path).write_bytes(content)
+		get_local_files.side_effect = [[file], []]
+
+		uploaded = {}
+		client = get_client.return_value
+		client.folder = "test_folder"
+		client.upload_fileobj.side_effect = lambda reader, bucket, key, **kwargs: uploaded.update(
+			{key: reader.read()}
+		)
+
+		def head_object(Bucket, Key):
+			if Key not in uploaded:
+				raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+			return {"VersionId": "v1"}
+
+		client.head_object.side_effect = head_object
+
+		try:
+			with tempfile.TemporaryDirectory() as directory, patch(
+				"cloud_storage.cloud_storage.migration.get_checkpoint_path",
+				return_value=Path(directory) / "checkpoint.json",
+			):
+				checkpoint = migrate_local_files(workers=2)
+		finally:
+			os.remove(local_path)
+
+		key = "test_folder/User/Administrator/migration-upload.txt"
+		assert checkpoint["failed"] == []
+		assert checkpoint["migrated"] == 1
+		assert uploaded == {key: content}
+		assert frappe.db.get_value("File", file.name, ["s3_key", "content_hash"]) == (
+			key,
+			hashlib.md5(content).hexdigest(),
+		)
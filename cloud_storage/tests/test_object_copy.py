@@ -0,0 +1,49 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from cloud_storage.cloud_storage.object_copy import MAX_COPY_OBJECT_SIZE, copy_object
+
+
+def get_client(size: int) -> MagicMock:
+	client = MagicMock()
+	client.bucket = "test-bucket"
+	client.copy_part_size = 1024 * 1024 * 1024
+	client.transfer_config.max_concurrency = 2
+	client.head_object.return_value = {"ContentLength": size, "ContentType": "application/pdf"}
+	client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+	client.upload_part_copy.side_effect = lambda **kwargs: {
+		"CopyPartResult": {"ETag": f"etag-{kwargs['PartNumber']}"}
+	}
+	return client
+
+
+def test_copy_object():
+	client = get_client(1024)
+	copy_object(client, "source.pdf", "destination.pdf", version_id="v1")
+	client.copy_object.assert_called_once_with(
+		Bucket="test-bucket",
+		Key="destination.pdf",
+		CopySource={"Bucket": "test-bucket", "Key": "source.pdf", "VersionId": "v1"},
+		MetadataDirective="COPY",
+	)
+	client.upload_part_copy.assert_not_called()
+
+
+def test_copy_object_multipart():
+	size = MAX_COPY_OBJECT_SIZE + 1
+	client = get_client(size)
+	copy_object(client, "source.pdf", "destination.pdf")
+	client.copy_object.assert_not_called()
+	assert client.upload_part_copy.call_count == 6
+	ranges = sorted(call.kwargs["CopySourceRange"] for call in client.upload_part_copy.call_args_list)
+	assert f"bytes={5 * 1024 ** 3}-{size - 1}" in ranges
+	parts = client.complete_multipart_upload.call_args.kwargs["MultipartUpload"]["Parts"]
+	assert [part["PartNumber"] for part in parts] == [1, 2, 3, 4, 5, 6]
+
+	# a failed part aborts the upload
+	client = get_client(size)
+	client.upload_part_copy.side_effect = Exception("copy failed")
+	with pytest.raises(Exception):
+		copy_object(client, "source.pdf", "destination.pdf")
+	client.abort_multipart_upload.assert_called_once()
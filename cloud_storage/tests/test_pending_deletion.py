@@ -0,0 +1,29 @@
+from unittest.mock import patch
+
+from frappe.tests.utils import FrappeTestCase
+
+from cloud_storage.cloud_storage.doctype.pending_deletion.pending_deletion import (
+	get_referenced_keys,
+)
+
+
+class TestPendingDeletion(FrappeTestCase):
+	@patch("frappe.get_all")
+	def test_get_referenced_keys(self, get_all):
+		# a File with the same name was uploaded to the same document after the first one was deleted
+		get_all.return_value = ["folder/ToDo/TD-0001/report.png"]
+		keys = [
+			"folder/ToDo/TD-0001/report.png",
+			"folder/ToDo/TD-0001/report.png.derivatives/thumbnail.webp",
+			"folder/ToDo/TD-0002/report.png",
+		]
+
+		assert get_referenced_keys(keys) == {
+			"folder/ToDo/TD-0001/report.png",
+			"folder/ToDo/TD-0001/report.png.derivatives/thumbnail.webp",
+		}
+		filters = get_all.call_args.kwargs["filters"]
+		assert sorted(filters["s3_key"][1]) == [
+			"folder/ToDo/TD-0001/report.png",
+			"folder/ToDo/TD-0002/report.png",
+		]
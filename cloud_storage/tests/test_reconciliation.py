@@ -0,0 +1,91 @@
+import datetime
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from cloud_storage.cloud_storage.reconciliation import get_prefix_end, iter_file_rows, reconcile
+
+
+def get_object(key, size, age=datetime.timedelta(days=1)):
+	modified = datetime.datetime.now(datetime.timezone.utc) - age
+	return {"Key": key, "Size": size, "LastModified": modified}
+
+
+def get_row(name, key, file_size, replication_status=None):
+	return frappe._dict(
+		name=name,
+		s3_key=key,
+		file_size=file_size,
+		replication_status=replication_status,
+		spool_path=None,
+		content_encoding=None,
+	)
+
+
+class TestReconciliation(FrappeTestCase):
+	@patch("cloud_storage.cloud_storage.reconciliation.iter_file_rows")
+	@patch("cloud_storage.cloud_storage.reconciliation.iter_bucket_objects")
+	@patch("cloud_storage.cloud_storage.reconciliation.get_cloud_storage_client")
+	def test_reconcile(self, get_client, iter_bucket_objects, iter_file_rows):
+		get_client.return_value = MagicMock(folder="files")
+		iter_bucket_objects.return_value = iter(
+			[
+				get_object("files/A.png", 10),
+				get_object("files/A.png.derivatives/thumbnail.webp", 2),
+				get_object("files/a.txt", 5),
+				get_object("files/new.txt", 3, age=datetime.timedelta(minutes=1)),
+				get_object("files/orphan.txt", 7),
+			]
+		)
+		iter_file_rows.return_value = iter(
+			[
+				get_row("1", "files/A.png", 10),
+				get_row("2", "files/a.txt", 6),
+				# a second File with the same key shares the object
+				get_row("5", "files/a.txt", 5),
+				get_row("3", "files/missing.txt", 1),
+				get_row("4", "files/pending.txt", 1, replication_status="Pending"),
+			]
+		)
+
+		report = reconcile()
+
+		assert report["objects"] == 5
+		assert report["files"] == 5
+		assert report["orphaned_objects"]["count"] == 1
+		assert report["orphaned_objects"]["sample"] == [{"key": "files/orphan.txt", "size": 7}]
+		assert report["missing_objects"]["sample"] == [{"file": "3", "key": "files/missing.txt"}]
+		assert report["size_mismatches"]["count"] == 1
+		assert report["size_mismatches"]["sample"][0]["object_size"] == 5
+		assert report["repairs"] == 0
+
+	@patch("frappe.db.sql")
+	def test_iter_file_rows(self, sql):
+		sql.return_value = [get_row("1", "files_2024/a.txt", 1)]
+
+		assert list(iter_file_rows("files_2024/", page_size=10)) == sql.return_value
+		query, values = sql.call_args.args
+		# the folder's `_` must not act as a wildcard
+		assert "LIKE" not in query
+		assert values["prefix"] == "files_2024/"
+		assert values["prefix_end"] == "files_20240"
+
+	@patch("frappe.db.sql")
+	def test_iter_file_rows_shared_key(self, sql):
+		# a page that ends partway through Files sharing a key continues after the last File's name
+		pages = [
+			[get_row("1", "files/a.txt", 1), get_row("2", "files/a.txt", 1)],
+			[get_row("3", "files/a.txt", 1)],
+		]
+		sql.side_effect = pages
+
+		assert list(iter_file_rows("files/", page_size=2)) == pages[0] + pages[1]
+		query, values = sql.call_args.args
+		assert "name > %(cursor_name)s" in query
+		assert (values["cursor"], values["cursor_name"]) == ("files/a.txt", "2")
+
+	def test_get_prefix_end(self):
+		assert get_prefix_end("") == ""
+		assert get_prefix_end("files/") == "files0"
+		assert "files/z" < get_prefix_end("files/") and "files0" >= get_prefix_end("files/")
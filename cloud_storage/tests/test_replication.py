@@ -0,0 +1,148 @@
+import gzip
+import tempfile
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from cloud_storage.cloud_storage.overrides.file import serve_spooled_file
+from cloud_storage.cloud_storage.replication import (
+	mark_replicated,
+	replicate_pending_files,
+	upload_spooled_file,
+)
+
+
+class TestReplication(FrappeTestCase):
+	def test_upload_spooled_file(self):
+		client = MagicMock()
+		client.bucket = "test-bucket"
+		client.head_object.return_value = {"VersionId": "v1"}
+		with tempfile.NamedTemporaryFile(suffix=".png") as spooled:
+			spooled.write(b"spooled content")
+			spooled.flush()
+			file = frappe._dict(file_name="image.png", s3_key="folder/image.png", spool_path=spooled.name)
+			assert upload_spooled_file(client, file) == ("v1", None, None)
+		assert client.upload_fileobj.call_args.args[1:3] == ("test-bucket", "folder/image.png")
+
+		# a spool file that no longer exists is reported as an error
+		file.spool_path = "/nonexistent/spooled"
+		version_id, _, error = upload_spooled_file(client, file)
+		assert version_id is None and error
+
+	@patch("cloud_storage.cloud_storage.replication.queue_derivatives")
+	@patch("cloud_storage.cloud_storage.replication.remove_spooled_file")
+	@patch("frappe.get_doc")
+	@patch("frappe.db.get_value")
+	def test_mark_replicated(self, get_value, get_doc, remove_spooled_file, queue_derivatives):
+		file = frappe._dict(name="file-1", spool_path="/spool/first")
+
+		get_value.return_value = "/spool/first"
+		mark_replicated(file, "v1")
+		get_doc.return_value.add_file_version.assert_called_once_with("v1")
+		get_doc.return_value.save.assert_called_once()
+		assert get_doc.return_value.replication_status == "Replicated"
+		remove_spooled_file.assert_called_once_with("/spool/first")
+
+		# newer content spooled during the upload stays pending
+		get_doc.reset_mock()
+		remove_spooled_file.reset_mock()
+		get_value.return_value = "/spool/second"
+		mark_replicated(file, "v2")
+		get_doc.assert_not_called()
+		remove_spooled_file.assert_called_once_with("/spool/first")
+
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
+	@patch("cloud_storage.cloud_storage.overrides.file.sign_url")
+	@patch("frappe.get_value")
+	def test_serve_spooled_file(self, get_value, sign_url, get_client):
+		frappe.local.response = frappe._dict()
+		with tempfile.TemporaryDirectory() as directory:
+			spool_path = Path(directory) / "spooled"
+			spool_path.write_bytes(b"spooled content")
+			get_value.return_value = frappe._dict(
+				file_name="report.txt", spool_path=str(spool_path), is_private=1
+			)
+			serve_spooled_file("folder/report.txt")
+		assert frappe.local.response["filecontent"] == b"spooled content"
+		assert frappe.local.response["type"] == "binary"
+
+		# replicated between the status check and the read
+		frappe.local.response = frappe._dict()
+		get_value.return_value = frappe._dict(file_name="report.txt", spool_path=None, is_private=1)
+		sign_url.return_value = "https://signed/folder/report.txt"
+		serve_spooled_file("folder/report.txt")
+		assert frappe.local.response["type"] == "redirect"
+		assert frappe.local.response["location"] == "https://signed/folder/report.txt"
+
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
+	@patch("cloud_storage.cloud_storage.replication.upload_spooled_file")
+	@patch("frappe.log_error")
+	@patch("frappe.db.set_value")
+	@patch("frappe.db.count")
+	@patch("frappe.qb")
+	def test_replicate_pending_files_failed(
+		self, qb, count, set_value, log_error, upload_spooled_file, get_client
+	):
+		files = [
+			frappe._dict(name="retried", file_name="a.txt", s3_key="a.txt", replication_attempts=0),
+			frappe._dict(name="failed", file_name="b.txt", s3_key="b.txt", replication_attempts=4),
+		]
+		query = qb.from_.return_value.select.return_value.where.return_value.where.return_value
+		query.orderby.return_value.limit.return_value.for_update.return_value.run.side_effect = [
+			files,
+			[],
+		]
+		count.return_value = len(files)
+		upload_spooled_file.return_value = (None, None, "Traceback")
+
+		with patch.dict(frappe.conf, {"cloud_storage_settings": {"replication_max_attempts": 5}}):
+			replicate_pending_files()
+		updates = {call.args[1]: call.args[2] for call in set_value.call_args_list}
+		assert updates["retried"]["replication_status"] == "Pending"
+		assert updates["retried"]["replication_attempts"] == 1
+		# a File that keeps failing is no longer retried by every run
+		assert updates["failed"]["replication_status"] == "Failed"
+		assert updates["failed"]["replication_attempts"] == 5
+		assert log_error.call_count == 2
+
+	@patch("cloud_storage.cloud_storage.overrides.file.get_cloud_storage_client")
+	@patch("cloud_storage.cloud_storage.replication.mark_replicated")
+	@patch("frappe.db.count")
+	@patch("frappe.qb")
+	def test_replicate_pending_files(self, qb, count, mark_replicated, get_client):
+		content = b"".join(f"{idx},customer-{idx % 50}\n".encode() for idx in range(5000))
+		uploaded = {}
+		client = get_client.return_value
+		client.upload_fileobj.side_effect = lambda body, bucket, key, **kwargs: uploaded.update(
+			{key: (body.read(), kwargs["ExtraArgs"])}
+		)
+		client.head_object.return_value = {"VersionId": "v1"}
+
+		with tempfile.TemporaryDirectory() as directory:
+			spool_path = Path(directory) / "spooled"
+			spool_path.write_bytes(content)
+			file = frappe._dict(
+				name="file-1",
+				file_name="customers.csv",
+				s3_key="folder/customers.csv",
+				spool_path=str(spool_path),
+				replication_attempts=0,
+			)
+			query = qb.from_.return_value.select.return_value.where.return_value.where.return_value
+			query.orderby.return_value.limit.return_value.for_update.return_value.run.side_effect = [
+				[file],
+				[],
+			]
+			count.return_value = 1
+
+			# the uploads run through the real thread pool, where the site's settings aren't available
+			settings = {"compression": "gzip", "replication_workers": 2}
+			with patch.dict(frappe.conf, {"cloud_storage_settings": settings}):
+				replicate_pending_files()
+
+		mark_replicated.assert_called_once_with(file, "v1", "gzip")
+		body, extra_args = uploaded["folder/customers.csv"]
+		assert extra_args["ContentEncoding"] == "gzip"
+		assert gzip.decompress(body) == content
@@ -0,0 +1,61 @@
+import datetime
+from unittest.mock import ANY, MagicMock, patch
+
+import frappe
+
+from cloud_storage.cloud_storage.versions import get_expired_versions, prune_versions
+
+NOW = datetime.datetime(2024, 6, 30, 12)
+
+
+def get_versions(ages):
+	return [
+		frappe._dict(version=f"v{idx}", timestamp=NOW - datetime.timedelta(days=age))
+		for idx, age in enumerate(ages)
+	]
+
+
+def test_get_expired_versions_by_count():
+	versions = get_versions([0, 1, 2, 3, 4])
+	expired = get_expired_versions(versions, keep_count=2, keep_days=0, now=NOW)
+	assert [version.version for version in expired] == ["v2", "v3", "v4"]
+
+
+def test_get_expired_versions_by_age():
+	versions = get_versions([0, 10, 20, 40, 60])
+	expired = get_expired_versions(versions, keep_count=0, keep_days=30, now=NOW)
+	assert [version.version for version in expired] == ["v3", "v4"]
+
+
+def test_get_expired_versions_keeps_either():
+	versions = get_versions([0, 10, 20, 40, 60])
+	expired = get_expired_versions(versions, keep_count=4, keep_days=15, now=NOW)
+	assert [version.version for version in expired] == ["v4"]
+
+
+def test_get_expired_versions_keeps_current():
+	versions = get_versions([90, 120])
+	expired = get_expired_versions(versions, keep_count=1, keep_days=30, now=NOW)
+	assert [version.version for version in expired] == ["v1"]
+
+
+@patch("cloud_storage.cloud_storage.versions.delete_object_versions")
+@patch("frappe.db.delete")
+@patch("frappe.qb")
+@patch("frappe.get_all")
+def test_prune_versions_by_recorded_key(get_all, qb, delete, delete_object_versions):
+	get_all.return_value = [("file-1", "folder/ToDo/TD-2/report.txt")]
+	rows = [
+		frappe._dict(name="row-2", parent="file-1", version="v2", timestamp=NOW, s3_key=None),
+		# recorded before the File was relocated
+		frappe._dict(
+			name="row-1", parent="file-1", version="v1", timestamp=NOW, s3_key="folder/ToDo/TD-1/report.txt"
+		),
+	]
+	query = qb.from_.return_value.select.return_value.where.return_value.where.return_value
+	query.orderby.return_value.orderby.return_value.orderby.return_value.run.return_value = rows
+	delete_object_versions.return_value = {}
+
+	prune_versions(MagicMock(), ["file-1"], keep_count=1, keep_days=0)
+	delete_object_versions.assert_called_once_with(ANY, [("folder/ToDo/TD-1/report.txt", "v1")])
+	delete.assert_called_once_with("File Version", {"name": ("in", ["row-1"])})